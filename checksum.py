@@ -1,15 +1,95 @@
 """Python 3 script to calculate the checksums of files."""
 
+import collections
+import concurrent.futures
+import errno
 import hashlib
+import inspect
+import os
 import os.path
+import re
+import sqlite3
+import string
+import sys
+import tempfile
 import unittest
 
+from hash_cache import _CACHE_SIZE, DigestCache, InodeTable
+
 _DEFAULT_HASH = 'sha256'
 """String name of the default hash algorithm in hashlib to use."""
 
 # Set this larger than 2047 bytes so the Python GIL is released
 _SIZE = 2048
-"""Positive integer number of bytes to read from a file at a time."""
+"""Positive integer minimum number of bytes to read from a file at a time."""
+
+_MAX_SIZE = 1024 * 1024
+"""Positive integer number of bytes a read can grow to for large files."""
+
+_DEFAULT_JOBS = 1
+"""Positive integer number of files to checksum concurrently."""
+
+_OK = 'OK'
+"""String status of a manifest entry whose digest matches."""
+
+_FAILED = 'FAILED'
+"""String status of a manifest entry whose digest differs or is unreadable."""
+
+_MISSING = 'MISSING'
+"""String status of a manifest entry whose file does not exist."""
+
+_IMPROPER = 'IMPROPERLY FORMATTED'
+"""String status of a manifest line that cannot be parsed."""
+
+_TAGGED_LINE = re.compile(r'^([A-Za-z0-9_-]+) \((.*)\) = ([0-9A-Fa-f]+)$')
+"""Compiled regular expression for a BSD-style "ALGORITHM (file) = digest"."""
+
+def _cache_key(status):
+    """Return a tuple of the fields in status that identify file contents."""
+    return (status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns)
+
+def _block_size(status, size=_SIZE):
+    """Return the integer number of bytes to read at a time from a file.
+
+    Start from the larger of size and the preferred I/O size of the file
+    system, then double it until the file fits in a single read or the
+    block reaches _MAX_SIZE. Small files are read with one call while large
+    files amortize the Python overhead per read over a larger block.
+
+    Args:
+        status: os.stat_result of the file.
+        size: Optional positive int minimum number of bytes to read at a
+            time. Defaults to _SIZE.
+    Returns:
+        Integer number of bytes to read at a time.
+    """
+    block = max(size, getattr(status, 'st_blksize', 0) or 0)
+    while (block < status.st_size) and (block < _MAX_SIZE):
+        block *= 2
+    return block
+
+def _read_blocks(f, size=_SIZE):
+    """Yield memoryview blocks of the unbuffered binary file f.
+
+    One buffer is allocated and reused with readinto() so no new bytes
+    object is created per read. Each block is only valid until the next one
+    is yielded.
+
+    Args:
+        f: File object opened with open(path, 'rb', buffering=0).
+        size: Optional positive int minimum number of bytes to read at a
+            time. Defaults to _SIZE.
+    Yields:
+        memoryview of the bytes just read.
+    """
+    buffer = bytearray(_block_size(os.fstat(f.fileno()), size))
+    view = memoryview(buffer)
+    while True:
+        # readinto() returns 0 once EOF is reached and else breaks the loop
+        count = f.readinto(buffer)
+        if not count:
+            break
+        yield view[:count]
 
 def checksum(path, name=_DEFAULT_HASH, size=_SIZE):
     """Return the string hexadecimal digest checksum of the file at path.
@@ -18,8 +98,8 @@ def checksum(path, name=_DEFAULT_HASH, size=_SIZE):
         path: String path to the file.
         name: Optional string name of the hash algorithm in hashlib to use.
             Defaults to _DEFAULT_HASH.
-        size: Optional positive int number of bytes to read from the file at
-            a time. Defaults to _SIZE.
+        size: Optional positive int minimum number of bytes to read from the
+            file at a time. Defaults to _SIZE.
     Returns:
         String hexadecimal digest checksum of the file at path.
     """
@@ -29,25 +109,452 @@ def checksum(path, name=_DEFAULT_HASH, size=_SIZE):
         raise ValueError('path must be a valid string path to a file.')
     if not isinstance(name, str):
         raise TypeError('name must be a string.')
+    return multi_checksum(path, [name], size)[0]
+
+def multi_checksum(path, names=(_DEFAULT_HASH,), size=_SIZE, cache=None,
+                   inodes=None):
+    """Return a list of string hexadecimal digest checksums of a file.
+
+    The file is read once and every block is fed to one hash object per name,
+    so several algorithms cost a single pass over the file.
+
+    Args:
+        path: String path to the file.
+        names: Optional non-empty sequence of string names of the hash
+            algorithms in hashlib to use. Defaults to (_DEFAULT_HASH,).
+        size: Optional positive int minimum number of bytes to read from the
+            file at a time. Defaults to _SIZE.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the file.
+        inodes: Optional InodeTable of the hard linked files already hashed.
+            Defaults to None to read the file for every link.
+    Returns:
+        List of string hexadecimal digest checksums in the same order as names.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a valid string path to a file.')
+    if not os.path.isfile(path):
+        raise ValueError('path must be a valid string path to a file.')
+    if not isinstance(names, (list, tuple)):
+        raise TypeError('names must be a non-empty sequence of strings.')
+    if len(names) <= 0:
+        raise ValueError('names must be a non-empty sequence of strings.')
+    for name in names:
+        if not isinstance(name, str):
+            raise TypeError('names must be a non-empty sequence of strings.')
     if not isinstance(size, int):
         raise TypeError('size must be a positive int > 1024.')
     if size <= 1024:
         raise ValueError('size must be a positive int > 1024.')
 
+    digests = [None] * len(names)
+    status = None
+    if (cache is not None) or (inodes is not None):
+        status = os.stat(path)
+        if inodes is not None:
+            known = inodes.get(status, names)
+            if known is not None:
+                return known
+        if cache is not None:
+            digests = [cache.get(status, name) for name in names]
+            if None not in digests:
+                return digests
+
+    missing = [i for i, digest in enumerate(digests) if digest is None]
+    hashes = [hashlib.new(names[i].strip().lower()) for i in missing]
+    with open(path, 'rb', buffering=0) as f:
+        for block in _read_blocks(f, size):
+            for m in hashes:
+                m.update(block)
+    for i, m in zip(missing, hashes):
+        digests[i] = m.hexdigest()
+
+    # Only keep the digests if the file did not change while being read
+    if (status is not None) and (_cache_key(os.stat(path)) ==
+                                 _cache_key(status)):
+        for i in missing:
+            if cache is not None:
+                cache.put(status, names[i], digests[i])
+            if inodes is not None:
+                inodes.put(status, names[i], digests[i])
+    return digests
+
+def _ordered_map(function, items, jobs=_DEFAULT_JOBS):
+    """Yield a tuple of item and function(item) for each item in items.
+
+    The tuples are yielded in the same order as items. With more than one job,
+    function is called by a pool of threads. At most 2 * jobs items are in
+    flight at a time so items can be a lazy iterable of any length. Items not
+    started yet are cancelled if the generator is closed early.
+
+    Args:
+        function: Callable taking one item.
+        items: Iterable of items to pass to function.
+        jobs: Optional positive int number of items to process concurrently.
+            Defaults to _DEFAULT_JOBS.
+    Yields:
+        Tuple of item and the return value of function(item).
+    """
+    if not isinstance(jobs, int):
+        raise TypeError('jobs must be a positive int.')
+    if jobs <= 0:
+        raise ValueError('jobs must be a positive int.')
+
+    if jobs == 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append((item, executor.submit(function, item)))
+                if len(pending) >= 2 * jobs:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            for item, future in pending:
+                future.cancel()
+
+def checksums(paths, names=(_DEFAULT_HASH,), jobs=_DEFAULT_JOBS,
+              cache=None, inodes=None):
+    """Yield a tuple of path and its checksums for each path in paths.
+
+    The tuples are yielded in the same order as paths. With more than one job,
+    the files are hashed by a pool of threads. At most 2 * jobs files are in
+    flight at a time so paths can be a lazy iterable of any length.
+
+    Args:
+        paths: Iterable of string paths to files.
+        names: Optional non-empty sequence of string names of the hash
+            algorithms in hashlib to use. Defaults to (_DEFAULT_HASH,).
+        jobs: Optional positive int number of files to hash concurrently.
+            Defaults to _DEFAULT_JOBS.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+    Yields:
+        Tuple of string path and list of string hexadecimal digest checksums
+        in the same order as names.
+    """
+    def function(path):
+        return multi_checksum(path, names, cache=cache, inodes=inodes)
+    return _ordered_map(function, paths, jobs)
+
+def parse_manifest_line(line, name=_DEFAULT_HASH):
+    """Return a tuple of filename, algorithm and digest parsed from line.
+
+    Both the "digest  filename" format written by this script and sha256sum,
+    with an optional asterisk marking binary mode, and the BSD-style
+    "ALGORITHM (filename) = digest" format are accepted.
+
+    Args:
+        line: String line from a checksum manifest.
+        name: Optional string name of the hash algorithm in hashlib for lines
+            that do not name one. Defaults to _DEFAULT_HASH.
+    Returns:
+        Tuple of string filename, string lowercase algorithm name and string
+        lowercase hexadecimal digest. None if line is blank, a comment or
+        improperly formatted.
+    """
+    if not isinstance(line, str):
+        raise TypeError('line must be a string.')
+    if not isinstance(name, str):
+        raise TypeError('name must be a string.')
+
+    cleaned = line.rstrip('\r\n')
+    if (len(cleaned.strip()) <= 0) or cleaned.lstrip().startswith('#'):
+        return None
+    match = _TAGGED_LINE.match(cleaned)
+    if match is not None:
+        return (match.group(2), match.group(1).lower(),
+                match.group(3).lower())
+
+    fields = cleaned.strip().split(maxsplit=1)
+    if len(fields) < 2:
+        return None
+    digest, filename = fields
+    if not all(c in string.hexdigits for c in digest):
+        return None
+    if filename.startswith('*'):
+        # Remove the asterisk marking binary mode
+        filename = filename[1:]
+    return filename, name.strip().lower(), digest.lower()
+
+def check(lines, name=_DEFAULT_HASH, jobs=_DEFAULT_JOBS, cache=None,
+          inodes=None):
+    """Yield a tuple of filename and status for each entry in a manifest.
+
+    lines is consumed lazily and at most 2 * jobs files are verified at a time,
+    so memory use does not grow with the length of the manifest. Relative
+    filenames are resolved against the current working directory.
+
+    Args:
+        lines: Iterable of string lines from a checksum manifest.
+        name: Optional string name of the hash algorithm in hashlib for lines
+            that do not name one. Defaults to _DEFAULT_HASH.
+        jobs: Optional positive int number of files to verify concurrently.
+            Defaults to _DEFAULT_JOBS.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+    Yields:
+        Tuple of string filename and string status, one of _OK if the digest
+        matches, _FAILED if it differs, the file cannot be read or the
+        algorithm is not supported, and _MISSING if the file does not exist.
+        Lines that are not blank or comments but cannot be parsed are yielded
+        as the stripped line and _IMPROPER.
+    """
+    def verify(entry):
+        line, parsed = entry
+        if parsed is None:
+            return _IMPROPER
+        filename, algorithm, expected = parsed
+        if not os.path.isfile(filename):
+            return _MISSING
+        try:
+            digest = multi_checksum(filename, [algorithm], cache=cache,
+                                    inodes=inodes)[0]
+        except (OSError, ValueError):
+            # ValueError is an unsupported algorithm or a vanished file
+            return _FAILED
+        if digest == expected:
+            return _OK
+        return _FAILED
+
+    entries = ((line.strip(), parse_manifest_line(line, name))
+               for line in lines)
+    entries = (entry for entry in entries if (len(entry[0]) > 0) and
+               (not entry[0].startswith('#')))
+    for (line, parsed), status in _ordered_map(verify, entries, jobs):
+        yield (line if parsed is None else parsed[0]), status
+
+def _tree_nodes(path, name, cache=None, inodes=None, onerror=None):
+    """Yield a tuple for each node below the directory at path in post-order.
+
+    A file node's digest is the digest of its contents. A directory node's
+    digest is the digest of the kind, name and digest of each of its children
+    in sorted order, so it changes if anything below it changes. The
+    directory at path itself is yielded last. The tree is walked with a
+    stack of the open directories instead of recursion, so its depth is not
+    limited.
+
+    Args:
+        path: String path to the directory.
+        name: String name of the hash algorithm in hashlib to use.
+        cache: Optional DigestCache to reuse and store file digests in.
+            Defaults to None to always read the files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        onerror: Optional callable taking the OSError of a directory or file
+            that cannot be read, which is then left out of the tree.
+            Defaults to None to raise it.
+    Yields:
+        Tuple of string relative path, boolean whether it is a directory and
+        string hexadecimal digest.
+    """
+    def report(error):
+        if onerror is None:
+            raise error
+        onerror(error)
+
+    def listing(directory):
+        try:
+            with os.scandir(directory) as iterator:
+                return iter(sorted(iterator, key=lambda entry: entry.name))
+        except OSError as error:
+            report(error)
+            return None
+
+    entries = listing(path)
+    if entries is None:
+        return
+    # Each level holds its relative path, name, remaining entries and hash
+    stack = [('', '', entries, hashlib.new(name))]
+    while len(stack) > 0:
+        relative, base, entries, m = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            digest = m.hexdigest()
+            yield relative, True, digest
+            if len(stack) > 0:
+                stack[-1][3].update(b'\0'.join([b'd', os.fsencode(base),
+                                                 digest.encode('ascii'), b'']))
+            continue
+
+        if len(relative) <= 0:
+            child = entry.name
+        else:
+            child = relative + '/' + entry.name
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            is_file = (not is_dir) and entry.is_file()
+        except OSError as error:
+            report(error)
+            continue
+        if is_dir:
+            children = listing(entry.path)
+            if children is not None:
+                stack.append((child, entry.name, children, hashlib.new(name)))
+            continue
+        if not is_file:
+            # Skip sockets, devices and broken symbolic links
+            continue
+        try:
+            digest = multi_checksum(entry.path, [name], cache=cache,
+                                    inodes=inodes)[0]
+        except OSError as error:
+            report(error)
+            continue
+        yield child, False, digest
+        m.update(b'\0'.join([b'f', os.fsencode(entry.name),
+                             digest.encode('ascii'), b'']))
+
+def tree_checksum(path, name=_DEFAULT_HASH, cache=None, database='',
+                  inodes=None, onerror=None):
+    """Return the string hexadecimal Merkle tree digest of a directory.
+
+    Args:
+        path: String path to the directory.
+        name: Optional string name of the hash algorithm in hashlib to use.
+            Defaults to _DEFAULT_HASH.
+        cache: Optional DigestCache to reuse and store file digests in.
+            Defaults to None to always read the files.
+        database: Optional string path to an SQLite database to replace with
+            the digest of every node for compare_trees(). Defaults to the
+            empty string to not save the digests.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        onerror: Optional callable taking the OSError of a directory or file
+            that cannot be read, which is then left out of the tree.
+            Defaults to None to raise it.
+    Returns:
+        String hexadecimal digest of the directory at path or None if it
+        cannot be listed and onerror is given.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a valid string path to a directory.')
+    if not os.path.isdir(path):
+        raise ValueError('path must be a valid string path to a directory.')
+    if not isinstance(name, str):
+        raise TypeError('name must be a string.')
+    if not isinstance(database, str):
+        raise TypeError('database must be a string path to a file.')
+
     name = name.strip().lower()
-    m = hashlib.new(name)
-    with open(path, 'rb') as f:
-        while True:
-            # read() returns '' once EOF is reached and else breaks the loop
-            data = f.read(size)
-            if len(data) > 0:
-                m.update(data)
-            else:
-                break
-    return m.hexdigest()
+    nodes = _tree_nodes(path, name, cache, inodes, onerror)
+    digest = None
+    if len(database) <= 0:
+        for relative, is_dir, digest in nodes:
+            pass
+        return digest
+
+    connection = sqlite3.connect(database)
+    try:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS nodes')
+            connection.execute(
+                'CREATE TABLE nodes (path BLOB PRIMARY KEY, parent BLOB, '
+                'is_dir INTEGER, digest TEXT)')
+            for relative, is_dir, digest in nodes:
+                # Store bytes so names that are not valid UTF-8 are kept
+                relative = os.fsencode(relative)
+                parent = relative.rpartition(b'/')[0]
+                if len(relative) <= 0:
+                    # The root is its own parent so it is no one's child
+                    parent = None
+                connection.execute('INSERT INTO nodes VALUES (?, ?, ?, ?)',
+                                   (relative, parent, is_dir, digest))
+            connection.execute(
+                'CREATE INDEX nodes_parent ON nodes (parent)')
+    finally:
+        connection.close()
+    return digest
+
+def compare_trees(left, right):
+    """Yield the differences between two trees saved by tree_checksum().
+
+    The trees are compared top-down. A directory whose digest matches is
+    pruned after that one comparison, so only the differing paths are read
+    from the databases.
+
+    Args:
+        left: String path to the SQLite database of the first tree.
+        right: String path to the SQLite database of the second tree.
+    Yields:
+        Tuple of string relative path, string digest in left or None and
+        string digest in right or None. Directories found in only one tree
+        are yielded without their contents. ValueError is raised before any
+        tuple if either database holds no tree.
+    """
+    for database in [left, right]:
+        if not isinstance(database, str):
+            raise TypeError('database must be a valid string path to a file.')
+        if not os.path.isfile(database):
+            raise ValueError('database must be a valid string path to a file.')
+
+    connections = [sqlite3.connect(database) for database in [left, right]]
+    try:
+        def children(connection, parent):
+            return {os.fsdecode(path): (is_dir, digest)
+                    for path, is_dir, digest in connection.execute(
+                        'SELECT path, is_dir, digest FROM nodes '
+                        'WHERE parent = ?', (os.fsencode(parent),))}
+
+        roots = []
+        for database, connection in zip([left, right], connections):
+            try:
+                row = connection.execute(
+                    'SELECT digest FROM nodes WHERE path = ?',
+                    (b'',)).fetchone()
+            except sqlite3.DatabaseError:
+                row = None
+            if row is None:
+                # Not a database or the root of the tree could not be read
+                raise ValueError('{0} has no tree saved by '
+                                 'tree_checksum().'.format(database))
+            roots.append(row[0])
+        if roots[0] == roots[1]:
+            return
+        stack = ['']
+        while len(stack) > 0:
+            parent = stack.pop()
+            left_nodes, right_nodes = [children(connection, parent)
+                                       for connection in connections]
+            differences = []
+            for path in sorted(left_nodes.keys() | right_nodes.keys()):
+                left_node = left_nodes.get(path, (None, None))
+                right_node = right_nodes.get(path, (None, None))
+                if left_node == right_node:
+                    continue
+                if left_node[0] and right_node[0]:
+                    differences.append(path)
+                else:
+                    yield path, left_node[1], right_node[1]
+            # Reverse so the stack pops the subdirectories in sorted order
+            stack.extend(reversed(differences))
+    finally:
+        for connection in connections:
+            connection.close()
 
 
 class _UnitTest(unittest.TestCase):
+    def test_block_size(self):
+        """Test choosing the number of bytes to read at a time."""
+        status = os.stat('LICENSE')
+        self.assertGreaterEqual(_block_size(status), status.st_size)
+        self.assertGreaterEqual(_block_size(status), status.st_blksize)
+        self.assertEqual(_block_size(status, _MAX_SIZE * 4), _MAX_SIZE * 4)
+        status = os.stat_result((0,) * 6 + (_MAX_SIZE * 100,) + (0,) * 3)
+        self.assertEqual(_block_size(status), _MAX_SIZE)
+
     def test_checksum(self):
         """Test calculating the checksum for a file."""
         for value in [None, 42.0, []]:
@@ -60,26 +567,432 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(TypeError, checksum, 'checksum.py', size=value)
         for value in range(-1, 1025):
             self.assertRaises(ValueError, checksum, 'checksum.py', size=value)
+        with open('LICENSE', 'rb') as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        for value in [1025, 2048, 4096, _MAX_SIZE]:
+            self.assertEqual(checksum('LICENSE', size=value), expected)
+
+    def test_multi_checksum(self):
+        """Test calculating several checksums for a file in one pass."""
+        for value in [None, 42.0, 'sha256', [None], ['md5', 42]]:
+            self.assertRaises(TypeError, multi_checksum, 'checksum.py', value)
+        for value in [[], (), ['foobar'], ['md5', '']]:
+            self.assertRaises(ValueError, multi_checksum, 'checksum.py', value)
+        names = ['md5', 'sha1', 'sha256']
+        expected = [checksum('LICENSE', name) for name in names]
+        self.assertEqual(multi_checksum('LICENSE', names), expected)
+        self.assertEqual(multi_checksum('LICENSE', tuple(names)), expected)
+        self.assertEqual(multi_checksum('LICENSE', names[::-1]),
+                         expected[::-1])
+
+    def test_inode_table(self):
+        """Test hashing each hard linked file once with an InodeTable."""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, str(i)) for i in range(3)]
+            with open(paths[0], 'w') as f:
+                f.write('foo' * 1000)
+            os.link(paths[0], paths[1])
+            with open(paths[2], 'w') as f:
+                f.write('foo' * 1000)
+
+            inodes = InodeTable()
+            names = ['md5', 'sha256']
+            expected = multi_checksum(paths[0], names)
+            for path in paths:
+                self.assertEqual(multi_checksum(path, names, inodes=inodes),
+                                 expected)
+            # Only the second link is found in the table
+            self.assertEqual((inodes.hits, inodes.saved), (1, 3000))
+            self.assertEqual([digests for path, digests in
+                              checksums(paths, names, 2, inodes=inodes)],
+                             [expected] * 3)
+            self.assertEqual((inodes.hits, inodes.saved), (3, 9000))
+
+            # A file changed since it was hashed is read again
+            with open(paths[1], 'w') as f:
+                f.write('bar')
+            self.assertEqual(multi_checksum(paths[0], ['md5'], inodes=inodes),
+                             [checksum(paths[1], 'md5')])
+            self.assertEqual(inodes.hits, 3)
+            self.assertIsNone(inodes.get(os.stat(paths[2]), ['md5']))
+
+    def test_digest_cache(self):
+        """Test reusing digests stored in a DigestCache."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, DigestCache, value)
+            self.assertRaises(TypeError, DigestCache, 'cache.db', value)
+        self.assertRaises(ValueError, DigestCache, '')
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, DigestCache, 'cache.db', value)
+
+        names = ['md5', 'sha256']
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'cache.db')
+            paths = []
+            for i in range(3):
+                path = os.path.join(directory, '{0}.txt'.format(i))
+                with open(path, 'w') as f:
+                    f.write('foobar' * (i + 1))
+                os.utime(path, ns=(0, 0))
+                paths.append(path)
+            expected = multi_checksum(paths[0], names)
+
+            with DigestCache(database) as cache:
+                self.assertEqual(multi_checksum(paths[0], names, cache=cache),
+                                 expected)
+                self.assertEqual((cache.hits, cache.misses), (0, 2))
+                self.assertEqual(multi_checksum(paths[0], names, cache=cache),
+                                 expected)
+                self.assertEqual((cache.hits, cache.misses), (2, 2))
+            with DigestCache(database) as cache:
+                self.assertEqual(multi_checksum(paths[0], names, cache=cache),
+                                 expected)
+                self.assertEqual((cache.hits, cache.misses), (2, 0))
+
+                # A changed file must be rehashed
+                with open(paths[0], 'a') as f:
+                    f.write('baz')
+                os.utime(paths[0], ns=(0, 1))
+                expected = multi_checksum(paths[0], names)
+                self.assertEqual(multi_checksum(paths[0], names, cache=cache),
+                                 expected)
+                self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+                # Recently modified files are not stored
+                os.utime(paths[0])
+                multi_checksum(paths[0], names, cache=cache)
+                multi_checksum(paths[0], names, cache=cache)
+                self.assertEqual((cache.hits, cache.misses), (2, 6))
+
+            # Evict the least recently used digests beyond max_entries
+            with DigestCache(database, 1) as cache:
+                for path in paths[1:]:
+                    multi_checksum(path, ['md5'], cache=cache)
+            with DigestCache(database) as cache:
+                self.assertIsNone(cache.get(os.stat(paths[1]), 'md5'))
+                self.assertIsNotNone(cache.get(os.stat(paths[2]), 'md5'))
+
+    def test_checksums(self):
+        """Test calculating the checksums for several files."""
+        paths = ['LICENSE', 'README.md', 'checksum.py']
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, list, checksums(paths, jobs=value))
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, list, checksums(paths, jobs=value))
+        names = ['md5', 'sha256']
+        expected = [(path, [checksum(path)]) for path in paths]
+        expected_names = [(path, multi_checksum(path, names))
+                          for path in paths]
+        for jobs in range(1, 5):
+            self.assertEqual(list(checksums(paths, jobs=jobs)), expected)
+            self.assertEqual(list(checksums(iter(paths), jobs=jobs)),
+                             expected)
+            self.assertEqual(list(checksums(paths, names, jobs)),
+                             expected_names)
+
+    def test_parse_manifest_line(self):
+        """Test parsing a line from a checksum manifest."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, parse_manifest_line, value)
+            self.assertRaises(TypeError, parse_manifest_line, '', value)
+        for value in ['', '\n', '   ', '# comment', 'foobar', 'abc',
+                      'xyz  foobar.txt', 'MD5 (foobar.txt) = xyz']:
+            self.assertIsNone(parse_manifest_line(value))
+        for value, expected in [
+            ('abc123  foobar.txt', ('foobar.txt', 'sha256', 'abc123')),
+            ('ABC123  foobar.txt\n', ('foobar.txt', 'sha256', 'abc123')),
+            ('abc123 *foobar.txt', ('foobar.txt', 'sha256', 'abc123')),
+            ('abc123  foo bar.txt', ('foo bar.txt', 'sha256', 'abc123')),
+            ('MD5 (foobar.txt) = ABC123', ('foobar.txt', 'md5', 'abc123')),
+            ('SHA1 (foo (1).txt) = abc123\r\n',
+             ('foo (1).txt', 'sha1', 'abc123'))]:
+            self.assertEqual(parse_manifest_line(value), expected)
+        self.assertEqual(parse_manifest_line('abc123  foobar.txt', ' MD5 '),
+                         ('foobar.txt', 'md5', 'abc123'))
+
+    def test_check(self):
+        """Test verifying the entries in a checksum manifest."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, list, check([], jobs=value))
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, list, check([], jobs=value))
+
+        lines = ['{0}  LICENSE\n'.format(checksum('LICENSE')),
+                 '\n',
+                 '{0}  README.md\n'.format('0' * 64),
+                 '{0}  foobar.txt\n'.format(checksum('LICENSE')),
+                 'MD5 (LICENSE) = {0}\n'.format(checksum('LICENSE', 'md5'))]
+        expected = [('LICENSE', _OK), ('README.md', _FAILED),
+                    ('foobar.txt', _MISSING), ('LICENSE', _OK)]
+        for jobs in range(1, 5):
+            self.assertEqual(list(check(lines, jobs=jobs)), expected)
+            self.assertEqual(list(check(iter(lines), jobs=jobs)), expected)
+        self.assertEqual(list(check(lines[-1:], 'sha1')), expected[-1:])
+        self.assertEqual(list(check(lines[:1], 'md5')),
+                         [('LICENSE', _FAILED)])
+        self.assertEqual(list(check(['# comment\n', 'foobar\n',
+                                     'FOO (LICENSE) = abc123\n'])),
+                         [('foobar', _IMPROPER), ('LICENSE', _FAILED)])
+        with open('README.md', 'r', encoding='utf-8') as f:
+            statuses = {status for filename, status in check(f)}
+        self.assertEqual(statuses, {_IMPROPER})
+
+    def test_tree_checksum(self):
+        """Test calculating the Merkle tree digest of a directory."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, tree_checksum, value)
+            self.assertRaises(TypeError, tree_checksum, 'tests', value)
+            self.assertRaises(TypeError, tree_checksum, 'tests',
+                              database=value)
+        for value in ['', 'foobar', 'checksum.py']:
+            self.assertRaises(ValueError, tree_checksum, value)
+        self.assertRaises(ValueError, tree_checksum, 'tests', 'foobar')
+
+        with tempfile.TemporaryDirectory() as directory:
+            trees = []
+            for tree in ['left', 'right']:
+                trees.append(os.path.join(directory, tree))
+                for subdirectory in ['foo', 'bar', os.path.join('bar', 'baz')]:
+                    os.makedirs(os.path.join(directory, tree, subdirectory))
+                for filename in [os.path.join('foo', '1.txt'),
+                                 os.path.join('bar', '2.txt'),
+                                 os.path.join('bar', 'baz', '3.txt')]:
+                    with open(os.path.join(directory, tree, filename),
+                              'w') as f:
+                        f.write(filename)
+            left, right = trees
+            self.assertEqual(tree_checksum(left), tree_checksum(right))
+            self.assertEqual(tree_checksum(left, 'md5'),
+                             tree_checksum(right, 'md5'))
+            self.assertNotEqual(tree_checksum(left, 'md5'),
+                                tree_checksum(left))
+
+            databases = [os.path.join(directory, 'left.db'),
+                         os.path.join(directory, 'right.db')]
+            self.assertEqual(tree_checksum(left, database=databases[0]),
+                             tree_checksum(right, database=databases[1]))
+            self.assertEqual(list(compare_trees(*databases)), [])
+
+            with open(os.path.join(right, 'bar', 'baz', '3.txt'), 'a') as f:
+                f.write('foobar')
+            os.rename(os.path.join(right, 'foo', '1.txt'),
+                      os.path.join(right, 'foo', '4.txt'))
+            os.mkdir(os.path.join(right, 'qux'))
+            self.assertNotEqual(tree_checksum(left), tree_checksum(right))
+            tree_checksum(right, database=databases[1])
+            expected = [('foo/1.txt', checksum(os.path.join(left, 'foo',
+                                                            '1.txt')), None),
+                        ('foo/4.txt', None, checksum(os.path.join(
+                            right, 'foo', '4.txt'))),
+                        ('qux', None, tree_checksum(os.path.join(right,
+                                                                 'qux'))),
+                        ('bar/baz/3.txt',
+                         checksum(os.path.join(left, 'bar', 'baz', '3.txt')),
+                         checksum(os.path.join(right, 'bar', 'baz', '3.txt')))]
+            self.assertCountEqual(list(compare_trees(*databases)), expected)
+            self.assertCountEqual(
+                list(compare_trees(*reversed(databases))),
+                [(path, right, left) for path, left, right in expected])
+
+            # A database without a tree is rejected before any difference
+            empty = os.path.join(directory, 'empty.db')
+            self.assertEqual(tree_checksum(left, database=empty),
+                             tree_checksum(left))
+            with sqlite3.connect(empty) as connection:
+                connection.execute('DELETE FROM nodes')
+            connection.close()
+            for pair in [(empty, databases[1]), (databases[0], empty),
+                               (databases[0], 'checksum.py')]:
+                self.assertRaises(ValueError, list, compare_trees(*pair))
+            os.remove(empty)
+            open(empty, 'w').close()
+            self.assertRaises(ValueError, list, compare_trees(empty, empty))
+
+            # Names that are not valid UTF-8 are kept
+            path = os.path.join(right, 'bar', os.fsdecode(b'\xff.txt'))
+            with open(path, 'w') as f:
+                f.write('foobar')
+            tree_checksum(right, database=databases[1])
+            self.assertIn(('bar/' + os.fsdecode(b'\xff.txt'), None,
+                           checksum(path)), list(compare_trees(*databases)))
+            os.remove(path)
+
+            # Errors are passed to onerror and the paths left out
+            digest = tree_checksum(left)
+            os.symlink('loop', os.path.join(left, 'foo', 'loop'))
+            self.assertRaises(OSError, tree_checksum, left)
+            errors = []
+            self.assertEqual(tree_checksum(left, onerror=errors.append),
+                             digest)
+            self.assertEqual([error.errno for error in errors], [errno.ELOOP])
+
+            # The walk does not recurse, so it is deeper than the limit
+            deep = os.path.join(directory, 'deep')
+            os.makedirs(os.path.join(deep, *(['d'] * 200)))
+            limit = sys.getrecursionlimit()
+            sys.setrecursionlimit(len(inspect.stack(0)) + 50)
+            try:
+                self.assertEqual(len(tree_checksum(deep)), 64)
+            finally:
+                sys.setrecursionlimit(limit)
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-a', '--algorithm', action='append', default=[],
+                        help='string name of a hash algorithm to use, '
+                        'repeat to calculate several in a single pass')
+    parser.add_argument('-m', '--manifest', default='',
+                        help='write one "PREFIX.algorithm" file per '
+                        'algorithm instead of printing')
+    parser.add_argument('-j', '--jobs', type=int, default=_DEFAULT_JOBS,
+                        help='number of files to checksum concurrently')
+    parser.add_argument('-c', '--check', default='',
+                        help='verify the files listed in the manifest at '
+                        'path instead')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='stop checking at the first failed file')
+    parser.add_argument('-t', '--tree', action='store_true',
+                        help='print the Merkle tree digest of directories '
+                        'in paths instead')
+    parser.add_argument('--tree-database', default='',
+                        help='with --tree and a single directory, save the '
+                        'digest of every node to the database at path')
+    parser.add_argument('--compare-trees', nargs=2, default=[],
+                        metavar=('LEFT', 'RIGHT'),
+                        help='compare two databases saved with '
+                        '--tree-database')
+    parser.add_argument('--cache', default='',
+                        help='path to a database of digests to reuse for '
+                        'unchanged files')
+    parser.add_argument('--cache-size', type=int, default=_CACHE_SIZE,
+                        help='maximum number of digests to keep in the cache')
     parser.add_argument('paths', nargs='*', default=[],
                         help='paths to files to checksum')
     args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error('--jobs must be a positive int')
+    # SHAKE digests need a length, which hexdigest() is not given here
+    supported = sorted(name for name in hashlib.algorithms_available
+                       if not name.startswith('shake_'))
+    for name in args.algorithm:
+        if name.strip().lower() not in supported:
+            parser.error('unsupported algorithm {0!r}, choose from {1}'.format(
+                name, ', '.join(supported)))
 
-    if len(args.paths) <= 0:
+    if len(args.compare_trees) > 0:
+        try:
+            for path, left, right in compare_trees(*args.compare_trees):
+                if left is None:
+                    print('{0}: only in {1}'.format(path,
+                                                    args.compare_trees[1]))
+                elif right is None:
+                    print('{0}: only in {1}'.format(path,
+                                                    args.compare_trees[0]))
+                else:
+                    print('{0}: differs'.format(path))
+        except ValueError as error:
+            parser.error(str(error))
+    elif (len(args.paths) <= 0) and (len(args.check) <= 0):
         suite = unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)
         unittest.TextTestRunner(verbosity=2).run(suite)
     else:
         hash_name = _DEFAULT_HASH
         paths = []
+        directories = []
         for path in args.paths:
             if path in hashlib.algorithms_available:
                 hash_name = path
             elif os.path.isfile(path):
                 paths.append(path)
+            elif os.path.isdir(path):
+                directories.append(path)
         paths.sort()
-        for path in paths:
-            print('{0}  {1}'.format(checksum(path, hash_name),
-                                    os.path.basename(path)))
+        names = args.algorithm
+        if len(names) <= 0:
+            names = [hash_name]
+        cache = None
+        if len(args.cache) > 0:
+            cache = DigestCache(args.cache, args.cache_size)
+        inodes = InodeTable()
+
+        if args.tree:
+            if (len(args.tree_database) > 0) and (len(directories) != 1):
+                parser.error('--tree-database needs exactly one directory')
+            errors = []
+
+            def onerror(error):
+                errors.append(error)
+                print(error, file=sys.stderr)
+
+            directories.sort()
+            for path in directories:
+                digest = tree_checksum(path, names[0], cache,
+                                       args.tree_database, inodes, onerror)
+                if digest is not None:
+                    print('{0}  {1}/'.format(
+                        digest, os.path.basename(os.path.normpath(path))))
+            if len(errors) > 0:
+                print('WARNING: {0} paths could not be read'.format(
+                    len(errors)), file=sys.stderr)
+        elif len(args.check) > 0:
+            counts = collections.Counter()
+            with open(args.check, 'r', encoding='utf-8') as f:
+                for filename, status in check(f, names[0], args.jobs, cache,
+                                              inodes):
+                    counts[status] += 1
+                    if status == _IMPROPER:
+                        continue
+                    print('{0}: {1}'.format(filename, status))
+                    if args.fail_fast and (status != _OK):
+                        break
+            improper = counts.pop(_IMPROPER, 0)
+            if improper > 0:
+                print('WARNING: {0} line{1} improperly formatted'.format(
+                    improper, ' is' if improper == 1 else 's are'),
+                      file=sys.stderr)
+            if sum(counts.values()) <= 0:
+                print('{0}: no properly formatted checksum lines found'.format(
+                    args.check), file=sys.stderr)
+            for status in [_FAILED, _MISSING]:
+                if counts[status] > 0:
+                    message = 'WARNING: {0} of {1} listed files {2}'.format(
+                        counts[status], sum(counts.values()), status)
+                    print(message, file=sys.stderr)
+        elif len(args.manifest) > 0:
+            manifests = [open('{0}.{1}'.format(args.manifest, name), 'w',
+                              encoding='utf-8')
+                         for name in names]
+            try:
+                for path, digests in checksums(paths, names, args.jobs, cache,
+                                               inodes):
+                    for f, digest in zip(manifests, digests):
+                        f.write('{0}  {1}\n'.format(
+                            digest, os.path.basename(path)))
+            finally:
+                for f in manifests:
+                    f.close()
+        elif len(names) == 1:
+            for path, digests in checksums(paths, names, args.jobs, cache,
+                                           inodes):
+                print('{0}  {1}'.format(digests[0], os.path.basename(path)))
+        else:
+            # Tag each line with its algorithm like BSD-style checksums
+            for path, digests in checksums(paths, names, args.jobs, cache,
+                                           inodes):
+                for name, digest in zip(names, digests):
+                    print('{0} ({1}) = {2}'.format(
+                        name.upper(), os.path.basename(path), digest))
+
+        if cache is not None:
+            cache.close()
+            print('Cache hits: {0} misses: {1}'.format(
+                cache.hits, cache.misses), file=sys.stderr)
+        if inodes.hits > 0:
+            print('Hard links: {0} files not read, {1} bytes saved'.format(
+                inodes.hits, inodes.saved), file=sys.stderr)
+        if (len(args.check) > 0) and ((counts[_OK] <= 0) or
+                                      (counts[_OK] < sum(counts.values()))):
+            sys.exit(1)
+        if args.tree and (len(errors) > 0):
+            sys.exit(1)
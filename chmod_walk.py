@@ -1,11 +1,25 @@
 """Python 3 script to recursively change the mode of directories and files."""
 
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import errno
+import io
+import itertools
 import os
 import os.path
+import shutil
+import sqlite3
 import stat
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+import tree_walk
+
 _ERROR_MESSAGE = 'Invalid mode'
 """String error message for an invalid mode."""
 
@@ -25,38 +39,539 @@ _MODE_TABLE = [
 ]
 """List of tuples containing the corresponding letter and its mode mask."""
 
-def _change_permissions(path, new_mode):
+_HAVE_DIR_FD = ((os.scandir in os.supports_fd) and
+                (os.open in os.supports_dir_fd) and
+                (os.chmod in os.supports_dir_fd) and
+                (os.chmod in os.supports_fd))
+"""Boolean flag indicating whether directories can be walked by descriptor."""
+
+_RACY_NS = 2 * 1000 * 1000 * 1000
+"""Integer nanoseconds a directory must be unmodified before recording it."""
+
+_OPEN_FLAGS = (os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0) |
+               getattr(os, 'O_NOFOLLOW', 0))
+"""Integer flags to open a directory without following a symbolic link."""
+
+_CHANGE_FLAGS = ((os.O_RDONLY | os.O_NONBLOCK | getattr(os, 'O_NOCTTY', 0) |
+                  getattr(os, 'O_CLOEXEC', 0) | os.O_NOFOLLOW)
+                 if hasattr(os, 'O_NOFOLLOW') else 0)
+"""Integer flags to open a file to change it or 0 if links are followed."""
+
+def _change_permissions(path, new_mode, status=None):
     """Change the permissions of the directory or file at path to new_mode.
 
     Args:
         path: String path to a directory or file whose permissions to change.
         new_mode: Integer new permissions.
+        status: Optional os.stat_result of path. Defaults to None to stat it.
+    Returns:
+        Boolean flag indicating whether the permissions were changed.
     """
-    old_mode = os.stat(path).st_mode & _MODE_MASK
+    if status is None:
+        status = os.stat(path)
+    old_mode = status.st_mode & _MODE_MASK
     if old_mode != new_mode:
         os.chmod(path, new_mode)
         print('Changed {old:o} to {new:o} for {path}'.format(
             old=old_mode, new=new_mode, path=path))
+        return True
+    return False
+
+def _change_permissions_at(dir_fd, name, directory, new_mode, status):
+    """Change the permissions of name in the directory open at dir_fd.
+
+    Like _change_permissions(), but name is resolved relative to dir_fd
+    instead of from the root and a symbolic link swapped in for it since it
+    was listed is never followed. Nothing is printed so the caller can
+    serialize its output.
+
+    Directories and regular files are opened without following a symbolic
+    link and changed by descriptor, which costs less than fchmodat() with
+    AT_SYMLINK_NOFOLLOW as the C library may emulate that through /proc.
+    Anything that cannot be opened for reading falls back to fchmodat(), and
+    where that cannot refuse a symbolic link the change fails instead.
+
+    Args:
+        dir_fd: Integer file descriptor of the directory containing name.
+        name: String name of a directory or file whose permissions to change.
+        directory: String path to the directory containing name for errors.
+        new_mode: Integer new permissions.
+        status: os.stat_result of name.
+    Returns:
+        Integer old permissions if they were changed or None.
+    """
+    old_mode = status.st_mode & _MODE_MASK
+    if old_mode == new_mode:
+        return None
+    if _CHANGE_FLAGS and (stat.S_ISDIR(status.st_mode) or
+                          stat.S_ISREG(status.st_mode)):
+        try:
+            fd = os.open(name, _CHANGE_FLAGS, dir_fd=dir_fd)
+        except PermissionError:
+            fd = None
+        except OSError as error:
+            error.filename = os.path.join(directory, name)
+            raise
+        if fd is not None:
+            try:
+                os.fchmod(fd, new_mode)
+            except OSError as error:
+                error.filename = os.path.join(directory, name)
+                raise
+            finally:
+                os.close(fd)
+            return old_mode
+    try:
+        os.chmod(name, new_mode, dir_fd=dir_fd, follow_symlinks=False)
+    except (NotImplementedError, ValueError):
+        # Without AT_SYMLINK_NOFOLLOW there is no way to change name without
+        # following a symbolic link swapped in for it, so fail closed
+        raise OSError(errno.ENOTSUP, os.strerror(errno.ENOTSUP),
+                      os.path.join(directory, name)) from None
+    except OSError as error:
+        error.filename = os.path.join(directory, name)
+        raise
+    return old_mode
+
+class DirectoryState:
+    """Persistent fingerprints of the directories changed in earlier runs.
+
+    The fingerprint of a directory is its modification time and the
+    directory and file modes applied to its entries, stored with the names
+    of its subdirectories. Creating, removing or renaming an entry updates
+    the modification time, so while the fingerprint matches the entries need
+    not be listed or stat'ed again and only the subdirectories are visited.
+    Changing the mode of an entry in place does not touch its directory, so
+    such files are only caught by a full verify. Paths and names are stored
+    as bytes so names that are not valid UTF-8 are kept. The fingerprints
+    are written in one transaction that is only committed when the run
+    finishes. A lock makes an instance safe to share between threads.
+    """
+
+    def __init__(self, path, verify=False):
+        """Open or create the state database at path.
+
+        Args:
+            path: String path to the SQLite database file.
+            verify: Optional boolean flag indicating whether to ignore the
+                fingerprints and check every entry while recording them
+                again. Defaults to False.
+        """
+        if not isinstance(path, str):
+            raise TypeError('path must be a string path to a file.')
+        if len(path) <= 0:
+            raise ValueError('path must be a string path to a file.')
+
+        self._verify = verify
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS directories ('
+            'path BLOB PRIMARY KEY, mtime INTEGER, dir_mode INTEGER, '
+            'file_mode INTEGER, subdirectories BLOB)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS meta ('
+            'key TEXT PRIMARY KEY, value TEXT)')
+        self._connection.execute('BEGIN')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(exc_type is None)
+
+    def reset_unless(self, options):
+        """Forget every fingerprint unless it was recorded with options.
+
+        Args:
+            options: String describing the options of the walk that decide
+                which entries are visited.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM meta WHERE key = 'options'").fetchone()
+            if (row is not None) and (row[0] == options):
+                return
+            self._connection.execute('DELETE FROM directories')
+            self._connection.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('options', ?)",
+                (options,))
+
+    def get(self, relative, status, dir_mode, file_mode):
+        """Return the names of the subdirectories if nothing changed or None.
+
+        Args:
+            relative: String path of the directory relative to the root of
+                the walk with / as the separator.
+            status: os.stat_result of the directory taken before listing it.
+            dir_mode: Integer permissions for directories.
+            file_mode: Integer permissions for files.
+        Returns:
+            List of string names of the subdirectories to visit or None if
+            the entries of the directory must be checked.
+        """
+        if self._verify:
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT mtime, dir_mode, file_mode, subdirectories '
+                'FROM directories WHERE path = ?',
+                (os.fsencode(relative),)).fetchone()
+        if (row is None) or (
+                row[:3] != (status.st_mtime_ns, dir_mode, file_mode)):
+            return None
+        if len(row[3]) <= 0:
+            return []
+        return [os.fsdecode(name) for name in row[3].split(b'/')]
+
+    def put(self, relative, status, dir_mode, file_mode, subdirectories):
+        """Record the fingerprint of a directory whose entries all succeeded.
+
+        Directories modified in the last _RACY_NS nanoseconds are not
+        recorded because another change in the same timestamp tick would be
+        missed. The fingerprints of subdirectories no longer there are
+        forgotten along with everything below them.
+
+        Args:
+            relative: String path of the directory relative to the root of
+                the walk with / as the separator.
+            status: os.stat_result of the directory taken before listing it.
+            dir_mode: Integer permissions for directories.
+            file_mode: Integer permissions for files.
+            subdirectories: List of string names of its subdirectories.
+        """
+        relative = os.fsencode(relative)
+        subdirectories = [os.fsencode(name) for name in subdirectories]
+        prefix = relative + b'/' if len(relative) > 0 else b''
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT subdirectories FROM directories WHERE path = ?',
+                (relative,)).fetchone()
+            if (row is not None) and (len(row[0]) > 0):
+                for name in set(row[0].split(b'/')).difference(
+                        subdirectories):
+                    # Every path below prefix + name sorts between these
+                    self._connection.execute(
+                        'DELETE FROM directories WHERE path = ? OR '
+                        '(path >= ? AND path < ?)',
+                        (prefix + name, prefix + name + b'/',
+                         prefix + name + b'0'))
+            if status.st_mtime_ns > time.time_ns() - _RACY_NS:
+                self._connection.execute(
+                    'DELETE FROM directories WHERE path = ?', (relative,))
+                return
+            self._connection.execute(
+                'INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)',
+                (relative, status.st_mtime_ns, dir_mode, file_mode,
+                 b'/'.join(subdirectories)))
+
+    def close(self, commit=True):
+        """Commit the fingerprints of the run unless it failed and close.
+
+        Args:
+            commit: Optional boolean flag indicating whether the run finished
+                so its fingerprints can be trusted. Defaults to True.
+        """
+        with self._lock:
+            if self._connection is not None:
+                self._connection.execute('COMMIT' if commit else 'ROLLBACK')
+                self._connection.close()
+                self._connection = None
 
 def _print_error(error):
-    """Print the OSError generated by os.walk()."""
+    """Print the OSError generated by tree_walk.walk_tree()."""
     print(error)
 
-def _walk(path, dir_mode, file_mode):
+def _walk_at(path, dir_mode, file_mode, excludes=(), max_depth=None,
+             one_filesystem=False, jobs=1, state=None):
+    """Walk the directory at path by descriptor and change the permissions.
+
+    Each directory is opened once without following symbolic links and
+    listed with os.scandir() on its descriptor. Its entries are then stat'ed
+    and changed by name relative to it, so no path is resolved from the root
+    again and a symbolic link swapped in during the walk is never followed.
+    Symbolic links are left alone.
+
+    The directories wait on a shared stack that a pool of jobs threads pops
+    from, so every thread stays busy until the whole tree is done however
+    unbalanced it is. A directory stays open only until all of its
+    subdirectories have been opened. Popping the newest first keeps that to
+    about one descriptor per level of the tree per thread, and with one job
+    the order is that of tree_walk.walk_tree().
+
+    With a DirectoryState, a directory whose fingerprint has not changed is
+    not listed. Only its subdirectories are opened, their own modes checked
+    and their fingerprints compared in turn, so the work is proportional to
+    the directories and what changed instead of to every entry.
+
+    Args:
+        path: String path to a directory to walk.
+        dir_mode: Integer permissions for directories.
+        file_mode: Integer permissions for files.
+        excludes: Optional iterable of string glob patterns of the entries
+            to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to stay on
+            the file system of path. Defaults to False.
+        jobs: Optional positive int number of directories to change
+            concurrently. Defaults to 1.
+        state: Optional DirectoryState of the fingerprints of the
+            directories, forgotten when walking from another root. Defaults
+            to None to list every directory.
+    Returns:
+        collections.Counter of the entries checked, changed and with errors
+        and of the directories skipped.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a string path to a directory.')
+    if (max_depth is not None) and (not isinstance(max_depth, int)):
+        raise TypeError('max_depth must be a non-negative int.')
+    if (max_depth is not None) and (max_depth < 0):
+        raise ValueError('max_depth must be a non-negative int.')
+    if not isinstance(jobs, int):
+        raise TypeError('jobs must be a positive int.')
+    if jobs <= 0:
+        raise ValueError('jobs must be a positive int.')
+
+    excluded = tree_walk.compile_excludes(excludes)
+    device = None
+    if one_filesystem:
+        device = os.stat(path).st_dev
+
+    lock = threading.Lock()
+    condition = threading.Condition(lock)
+    # Each task is the open parent, the name, path, relative path, depth and
+    # whether the parent was listed
+    stack = []
+    # Number of tasks on the stack or being worked on
+    pending = [0]
+    failed = []
+    # Descriptor and number of users of each open directory
+    references = {}
+
+    def report(line):
+        with lock:
+            print(line)
+
+    def release(fd):
+        with lock:
+            references[fd] -= 1
+            if references[fd] > 0:
+                return
+            del references[fd]
+        os.close(fd)
+
+    def change(fd, directory, relative, depth, listed, counts):
+        # Change the entries of the directory open at fd and return its
+        # subdirectories to descend into
+        own = None
+        if state is not None:
+            try:
+                own = os.fstat(fd)
+                if not listed:
+                    # Its parent was skipped, so its own mode is unchecked
+                    old_mode = own.st_mode & _MODE_MASK
+                    counts['checked'] += 1
+                    if old_mode != dir_mode:
+                        os.chmod(fd, dir_mode)
+                        counts['changed'] += 1
+                        report('Changed {old:o} to {new:o} for {path}'.format(
+                            old=old_mode, new=dir_mode, path=directory))
+            except OSError as error:
+                error.filename = directory
+                counts['errors'] += 1
+                report(error)
+                return []
+        prefix = relative + '/' if len(relative) > 0 else ''
+        if state is not None:
+            names = state.get(relative, own, dir_mode, file_mode)
+            if names is not None:
+                counts['skipped'] += 1
+                return [(name, os.path.join(directory, name), prefix + name,
+                         depth + 1, False) for name in names]
+
+        try:
+            with os.scandir(fd) as iterator:
+                entries = list(iterator)
+        except OSError as error:
+            error.filename = directory
+            counts['errors'] += 1
+            report(error)
+            return []
+        subdirectories = []
+        # Only a directory whose entries all succeeded and whose
+        # subdirectories are all visited can be skipped next time
+        complete = True
+        for entry in entries:
+            if tree_walk.is_excluded(excluded, prefix + entry.name):
+                continue
+            try:
+                if entry.is_symlink():
+                    continue
+                is_dir = entry.is_dir(follow_symlinks=False)
+                status = entry.stat(follow_symlinks=False)
+                new_mode = dir_mode if is_dir else file_mode
+                old_mode = _change_permissions_at(fd, entry.name, directory,
+                                                  new_mode, status)
+            except OSError as error:
+                if error.filename is None:
+                    error.filename = os.path.join(directory, entry.name)
+                counts['errors'] += 1
+                report(error)
+                complete = False
+                continue
+            counts['checked'] += 1
+            if old_mode is not None:
+                counts['changed'] += 1
+                report('Changed {old:o} to {new:o} for {path}'.format(
+                    old=old_mode, new=new_mode,
+                    path=os.path.join(directory, entry.name)))
+            if not is_dir:
+                continue
+            if ((max_depth is not None) and (depth >= max_depth)) or (
+                    one_filesystem and (status.st_dev != device)):
+                complete = False
+                continue
+            subdirectories.append((entry.name,
+                                   os.path.join(directory, entry.name),
+                                   prefix + entry.name, depth + 1, True))
+        if (state is not None) and complete:
+            state.put(relative, own, dir_mode, file_mode,
+                      [subdirectory[0] for subdirectory in subdirectories])
+        return subdirectories
+
+    def work(task, counts):
+        parent, name, directory, relative, depth, listed = task
+        flags = _OPEN_FLAGS
+        if parent is None:
+            # The path given may itself be a symbolic link to follow
+            flags = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+        try:
+            fd = os.open(name, flags, dir_fd=parent)
+        except OSError as error:
+            error.filename = directory
+            counts['errors'] += 1
+            report(error)
+            return
+        finally:
+            if parent is not None:
+                release(parent)
+        references[fd] = 1
+        try:
+            subdirectories = change(fd, directory, relative, depth, listed,
+                                    counts)
+            with condition:
+                # Reverse so the stack pops the subdirectories in listing
+                # order and hold fd open until each one is opened
+                references[fd] += len(subdirectories)
+                stack.extend((fd,) + subdirectory
+                             for subdirectory in reversed(subdirectories))
+                pending[0] += len(subdirectories)
+                condition.notify(len(subdirectories))
+        finally:
+            release(fd)
+
+    def worker():
+        counts = collections.Counter()
+        try:
+            while True:
+                with condition:
+                    while (len(stack) <= 0) and (pending[0] > 0) and (
+                            len(failed) <= 0):
+                        condition.wait()
+                    if (len(stack) <= 0) or (len(failed) > 0):
+                        return counts
+                    task = stack.pop()
+                try:
+                    work(task, counts)
+                finally:
+                    with condition:
+                        pending[0] -= 1
+                        if pending[0] <= 0:
+                            condition.notify_all()
+        except BaseException:
+            with condition:
+                failed.append(True)
+                condition.notify_all()
+            raise
+
+    if state is not None:
+        # The fingerprints are relative to the root, so it is an option too
+        state.reset_unless(repr((os.path.realpath(path), sorted(excludes),
+                                 max_depth, one_filesystem)))
+    stack.append((None, path, path, '', 0, True))
+    pending[0] = 1
+    try:
+        if jobs == 1:
+            return worker()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=jobs) as executor:
+            futures = [executor.submit(worker) for _ in range(jobs)]
+            return sum((future.result() for future in futures),
+                       collections.Counter())
+    finally:
+        # Close what is left open if a thread failed
+        for fd in references:
+            os.close(fd)
+
+def _walk(path, dir_mode, file_mode, excludes=(), max_depth=None,
+          one_filesystem=False, follow_symlinks=False, list_jobs=1, jobs=1,
+          state=None):
     """Walk the directory at path and change the permissions.
 
+    The entries are changed one at a time by path, which is fastest when
+    most of them change. Changing several directories concurrently or
+    skipping them by state walks them by file descriptor with _walk_at()
+    instead, which following symbolic links or listing ahead rules out as
+    they need the paths.
+
     Args:
         path: String path to a directory to walk.
         dir_mode: Integer permissions for directories.
         file_mode: Integer permissions for files.
+        excludes: Optional iterable of string glob patterns of the entries
+            to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to stay on
+            the file system of path. Defaults to False.
+        follow_symlinks: Optional boolean flag indicating whether to descend
+            into symbolic links to directories. Defaults to False.
+        list_jobs: Optional positive int number of directories to list
+            concurrently ahead of a walk by path. Defaults to 1.
+        jobs: Optional positive int number of directories to change
+            concurrently when walking by file descriptor. Defaults to 1.
+        state: Optional DirectoryState of the fingerprints of the
+            directories to skip when walking by file descriptor. Defaults to
+            None.
+    Returns:
+        collections.Counter of the entries checked, changed and with errors
+        and of the directories skipped.
     """
-    for parent, dirnames, filenames in os.walk(path, onerror=_print_error):
-        for dirname in dirnames:
-            path = os.path.join(parent, dirname)
-            _change_permissions(path, dir_mode)
-        for filename in filenames:
-            path = os.path.join(parent, filename)
-            _change_permissions(path, file_mode)
+    if ((jobs > 1) or (state is not None)) and _HAVE_DIR_FD and (
+            not follow_symlinks) and (list_jobs == 1):
+        return _walk_at(path, dir_mode, file_mode, excludes, max_depth,
+                        one_filesystem, jobs, state)
+
+    counts = collections.Counter()
+
+    def onerror(error):
+        counts['errors'] += 1
+        _print_error(error)
+
+    for parent, dirs, files in tree_walk.walk_tree(
+            path, excludes, max_depth, one_filesystem, follow_symlinks,
+            list_jobs, onerror):
+        for entries, mode in [(dirs, dir_mode), (files, file_mode)]:
+            for entry in entries:
+                counts['checked'] += 1
+                if _change_permissions(entry.path, mode, entry.stat()):
+                    counts['changed'] += 1
+    return counts
 
 def parse_mode(mode_string):
     """Return integer permissions corresponding to mode_string.
@@ -204,6 +719,246 @@ class _UnitTest(unittest.TestCase):
                     expected = (user * 8 * 8) + (group * 8) + other
                     self.assertEqual(parse_mode(value), expected)
 
+    def test_walk(self):
+        """Test changing the permissions of a tree."""
+        with tempfile.TemporaryDirectory() as directory:
+            for parts in [('a', 'b'), ('c',)]:
+                os.makedirs(os.path.join(directory, *parts))
+                with open(os.path.join(directory, *parts, 'f'), 'w') as f:
+                    f.write('foo')
+            os.chmod(os.path.join(directory, 'c', 'f'), 0o600)
+
+            for list_jobs in range(1, 3):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    counts = _walk(directory, 0o700, 0o640, excludes=['c/f'],
+                                   list_jobs=list_jobs)
+                for parts, expected in [(('a',), 0o700),
+                                        (('a', 'b'), 0o700),
+                                        (('a', 'b', 'f'), 0o640),
+                                        (('c',), 0o700),
+                                        (('c', 'f'), 0o600)]:
+                    path = os.path.join(directory, *parts)
+                    self.assertEqual(os.stat(path).st_mode & _MODE_MASK,
+                                     expected)
+                # Nothing is left to change the second time
+                self.assertEqual(len(output.getvalue()) > 0, list_jobs == 1)
+                self.assertEqual(counts['checked'], 4)
+                self.assertEqual(counts['changed'],
+                                 4 if list_jobs == 1 else 0)
+
+    @unittest.skipUnless(_HAVE_DIR_FD, 'no file descriptor relative calls')
+    def test_walk_at(self):
+        """Test changing the permissions of a tree by file descriptor."""
+        self.assertRaises(TypeError, _walk_at, None, 0o700, 0o600)
+        self.assertRaises(ValueError, _walk_at, '.', 0o700, 0o600, (), -1)
+        self.assertRaises(TypeError, _walk_at, '.', 0o700, 0o600, jobs=None)
+        self.assertRaises(ValueError, _walk_at, '.', 0o700, 0o600, jobs=0)
+        with tempfile.TemporaryDirectory() as directory:
+            for parts in [('a', 'b', 'c'), ('d',)]:
+                os.makedirs(os.path.join(directory, *parts))
+            for parts in [('a', 'b'), ('a', 'b', 'c'), ('d',)]:
+                with open(os.path.join(directory, *parts, 'f'), 'w') as f:
+                    f.write('foo')
+            for parts in [('a', 'b'), ('a', 'b', 'c'), ('d',)]:
+                os.chmod(os.path.join(directory, *parts), 0o755)
+                os.chmod(os.path.join(directory, *parts, 'f'), 0o644)
+            outside = os.path.join(directory, 'd', 'f')
+            os.chmod(outside, 0o600)
+            os.symlink(outside, os.path.join(directory, 'a', 'l'))
+            os.symlink(os.path.join(directory, 'd'),
+                       os.path.join(directory, 'a', 'm'))
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                _walk_at(os.path.join(directory, 'a'), 0o750, 0o640,
+                         max_depth=1)
+            for parts, expected in [(('a', 'b'), 0o750),
+                                    (('a', 'b', 'f'), 0o640),
+                                    (('a', 'b', 'c'), 0o750),
+                                    (('a', 'b', 'c', 'f'), 0o644),
+                                    (('d',), 0o755),
+                                    (('d', 'f'), 0o600)]:
+                path = os.path.join(directory, *parts)
+                self.assertEqual(os.stat(path).st_mode & _MODE_MASK,
+                                 expected)
+            expected = ['Changed {0:o} to {1:o} for {2}'.format(
+                old, new, os.path.join(directory, 'a', *parts))
+                        for parts, old, new in [(('b',), 0o755, 0o750),
+                                                (('b', 'f'), 0o644, 0o640),
+                                                (('b', 'c'), 0o755, 0o750)]]
+            self.assertEqual(sorted(output.getvalue().splitlines()),
+                             sorted(expected))
+
+            # A symbolic link swapped in is refused, other files changed
+            fd = os.open(os.path.join(directory, 'a'), _OPEN_FLAGS)
+            try:
+                status = os.stat('b', dir_fd=fd)
+                self.assertEqual(_change_permissions_at(
+                    fd, 'b', directory, 0o700, status), 0o750)
+                self.assertEqual(os.stat('b', dir_fd=fd).st_mode &
+                                 _MODE_MASK, 0o700)
+                with self.assertRaises(OSError) as context:
+                    _change_permissions_at(fd, 'l', directory, 0o640, status)
+                self.assertEqual(context.exception.errno, errno.ELOOP)
+                self.assertEqual(os.stat(outside).st_mode & _MODE_MASK,
+                                 0o600)
+
+                # Files that cannot be opened for reading are still changed
+                os.mkfifo('p', 0o600, dir_fd=fd)
+                os.close(os.open('w', os.O_WRONLY | os.O_CREAT, 0o200,
+                                 dir_fd=fd))
+                for name in ['p', 'w']:
+                    status = os.stat(name, dir_fd=fd)
+                    self.assertEqual(_change_permissions_at(
+                        fd, name, directory, 0o640, status),
+                                     status.st_mode & _MODE_MASK)
+                    self.assertEqual(os.stat(name, dir_fd=fd).st_mode &
+                                     _MODE_MASK, 0o640)
+            finally:
+                os.close(fd)
+
+    @unittest.skipUnless(_HAVE_DIR_FD, 'no file descriptor relative calls')
+    def test_directory_state(self):
+        """Test skipping the directories unchanged since the last run."""
+        for value in [None, 42]:
+            self.assertRaises(TypeError, DirectoryState, value)
+        self.assertRaises(ValueError, DirectoryState, '')
+        with tempfile.TemporaryDirectory() as directory:
+            root = os.path.join(directory, 'root')
+            for parts in [('a', 'b'), ('c',)]:
+                os.makedirs(os.path.join(root, *parts))
+            for parts in [('a', 'f'), ('a', 'b', 'f'), ('c', 'f')]:
+                with open(os.path.join(root, *parts), 'w') as f:
+                    f.write('foo')
+            directories = [('a',), ('a', 'b'), ('c',)]
+            ages = itertools.count(1)
+
+            def age():
+                # Recorded fingerprints must be older than _RACY_NS, but
+                # each change must still move the modification time
+                seconds = next(ages)
+                for parts in [()] + directories:
+                    os.utime(os.path.join(root, *parts), (seconds, seconds))
+
+            def run(verify=False, root=root, **kwargs):
+                output = io.StringIO()
+                with DirectoryState(os.path.join(directory, 'state.db'),
+                                    verify) as state:
+                    with contextlib.redirect_stdout(output):
+                        counts = _walk_at(root, 0o750, 0o640, state=state,
+                                          **kwargs)
+                return counts, output.getvalue().splitlines()
+
+            age()
+            counts, lines = run()
+            self.assertEqual(counts['checked'], 6)
+            self.assertEqual(counts['changed'], 6)
+            self.assertEqual(counts['skipped'], 0)
+            # Only the subdirectories of the skipped directories are checked
+            for jobs in range(1, 3):
+                counts, lines = run(jobs=jobs)
+                self.assertEqual(counts['checked'], 3)
+                self.assertEqual(counts['changed'], 0)
+                self.assertEqual(counts['skipped'], 4)
+
+            # A directory changed in place is caught through its parent
+            os.chmod(os.path.join(root, 'a', 'b'), 0o700)
+            # A file changed in place is not caught until a full verify
+            os.chmod(os.path.join(root, 'c', 'f'), 0o600)
+            counts, lines = run()
+            self.assertEqual(lines, ['Changed 700 to 750 for {0}'.format(
+                os.path.join(root, 'a', 'b'))])
+            counts, lines = run(verify=True)
+            self.assertEqual(counts['skipped'], 0)
+            self.assertEqual(lines, ['Changed 600 to 640 for {0}'.format(
+                os.path.join(root, 'c', 'f'))])
+
+            # A new file changes the modification time of its directory
+            with open(os.path.join(root, 'a', 'b', 'g'), 'w') as f:
+                f.write('foo')
+            os.chmod(os.path.join(root, 'a', 'b', 'g'), 0o600)
+            counts, lines = run()
+            self.assertEqual(counts['skipped'], 3)
+            self.assertEqual(lines, ['Changed 600 to 640 for {0}'.format(
+                os.path.join(root, 'a', 'b', 'g'))])
+
+            # Removed subdirectories are forgotten
+            os.remove(os.path.join(root, 'a', 'b', 'f'))
+            os.remove(os.path.join(root, 'a', 'b', 'g'))
+            os.rmdir(os.path.join(root, 'a', 'b'))
+            directories.remove(('a', 'b'))
+            age()
+            counts, lines = run()
+            self.assertEqual(counts['errors'], 0)
+            self.assertEqual(counts['skipped'], 0)
+            with contextlib.closing(sqlite3.connect(
+                    os.path.join(directory, 'state.db'))) as connection:
+                self.assertEqual(sorted(row[0] for row in connection.execute(
+                    'SELECT path FROM directories')), [b'', b'a', b'c'])
+
+            # Other options or modes check every entry again
+            counts, lines = run(excludes=['f'])
+            self.assertEqual(counts['skipped'], 0)
+            counts, lines = run(excludes=['f'])
+            self.assertEqual(counts['skipped'], 3)
+
+            # So does another root with the same modification times
+            copy = os.path.join(directory, 'copy')
+            shutil.copytree(root, copy)
+            os.chmod(os.path.join(copy, 'c', 'f'), 0o600)
+            age()
+            for parts in [()] + directories:
+                status = os.stat(os.path.join(root, *parts))
+                os.utime(os.path.join(copy, *parts),
+                         ns=(status.st_atime_ns, status.st_mtime_ns))
+            run()
+            counts, lines = run(root=copy)
+            self.assertEqual(counts['skipped'], 0)
+            self.assertEqual(lines, ['Changed 600 to 640 for {0}'.format(
+                os.path.join(copy, 'c', 'f'))])
+
+            # Names that are not valid UTF-8 are kept
+            directories.append((os.fsdecode(b'\xff'),))
+            os.mkdir(os.path.join(root, *directories[-1]))
+            age()
+            counts, lines = run()
+            self.assertEqual(counts['errors'], 0)
+            counts, lines = run()
+            self.assertEqual(counts['skipped'], 4)
+
+    @unittest.skipUnless(_HAVE_DIR_FD, 'no file descriptor relative calls')
+    def test_walk_at_jobs(self):
+        """Test changing the permissions of a tree with several threads."""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = []
+            for i in range(4):
+                for j in range(i + 1):
+                    parts = [str(i)] + ['d'] * j
+                    paths.append(os.path.join(directory, *parts))
+                    os.makedirs(paths[-1], exist_ok=True)
+                    for k in range(3):
+                        paths.append(os.path.join(directory, *parts, str(k)))
+                        with open(paths[-1], 'w') as f:
+                            f.write('foo')
+
+            outputs = []
+            for jobs in range(1, 5):
+                for path in paths:
+                    os.chmod(path, 0o700 if os.path.isdir(path) else 0o600)
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    counts = _walk_at(directory, 0o750, 0o640, jobs=jobs)
+                self.assertEqual(counts['checked'], len(paths))
+                self.assertEqual(counts['changed'], len(paths))
+                self.assertEqual(counts['errors'], 0)
+                outputs.append(output.getvalue().splitlines())
+                for path in paths:
+                    self.assertEqual(os.stat(path).st_mode & _MODE_MASK,
+                                     0o750 if os.path.isdir(path) else 0o640)
+            for output in outputs[1:]:
+                self.assertEqual(sorted(output), sorted(outputs[0]))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description=__doc__,
@@ -212,9 +967,38 @@ if __name__ == '__main__':
                         help='mode to use for directories')
     parser.add_argument('-f', '--filemode', type=parse_mode, default='644',
                         help='mode to use for files')
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        help='glob pattern of the names or relative paths to '
+                        'skip, repeat for several')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='number of levels of subdirectories to descend '
+                        'into')
+    parser.add_argument('--one-file-system', action='store_true',
+                        help='do not descend into other file systems')
+    parser.add_argument('-L', '--follow-symlinks', action='store_true',
+                        help='descend into symbolic links to directories')
+    parser.add_argument('--list-jobs', type=int, default=1,
+                        help='number of directories to list concurrently')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of directories to change concurrently')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='print the number of entries checked, changed '
+                        'and with errors and of directories skipped')
+    parser.add_argument('--state', default='',
+                        help='path to a database of directory fingerprints '
+                        'to skip the directories unchanged since the last '
+                        'run')
+    parser.add_argument('--verify', action='store_true',
+                        help='check every entry and record the state again')
     parser.add_argument('path', nargs='?', default='',
                         help='path to the directory to walk')
     args = parser.parse_args()
+    if (args.max_depth is not None) and (args.max_depth < 0):
+        parser.error('--max-depth must be a non-negative int')
+    if args.list_jobs < 1:
+        parser.error('--list-jobs must be a positive int')
+    if args.jobs < 1:
+        parser.error('--jobs must be a positive int')
 
     if len(args.path) <= 0:
         suite = unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)
@@ -222,4 +1006,24 @@ if __name__ == '__main__':
     elif os.path.isfile(args.path):
         _change_permissions(args.path, args.filemode)
     elif os.path.isdir(args.path):
-        _walk(args.path, args.dirmode, args.filemode)
+        # Whether _walk() can walk by file descriptor
+        by_fd = _HAVE_DIR_FD and (not args.follow_symlinks) and (
+            args.list_jobs == 1)
+        if (args.jobs != 1) and not by_fd:
+            parser.error('--jobs needs a walk by file descriptor, so not '
+                         'with -L or --list-jobs')
+        state = None
+        if len(args.state) > 0:
+            if not by_fd:
+                parser.error('--state needs a walk by file descriptor, so '
+                             'not with -L or --list-jobs')
+            state = DirectoryState(args.state, args.verify)
+        with (state if state is not None else contextlib.nullcontext()):
+            counts = _walk(args.path, args.dirmode, args.filemode,
+                           args.exclude, args.max_depth, args.one_file_system,
+                           args.follow_symlinks, args.list_jobs, args.jobs,
+                           state)
+        if args.stats:
+            print('Checked: {0} changed: {1} errors: {2} skipped: {3}'.format(
+                counts['checked'], counts['changed'], counts['errors'],
+                counts['skipped']), file=sys.stderr)
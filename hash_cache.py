@@ -0,0 +1,287 @@
+"""Caches of file digests shared by checksum.py and subset.py."""
+
+import os
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+_CACHE_SIZE = 1000000
+"""Positive integer maximum number of digests to keep in a DigestCache."""
+
+_EVICT_INTERVAL = 1024
+"""Positive integer number of digests to store or find between writes."""
+
+# Writes within the same timestamp tick after hashing would go unnoticed
+_RACY_NS = 2 * 1000 * 1000 * 1000
+"""Integer nanoseconds a file must be unmodified before caching its digest."""
+
+_PACKED_STATUS = struct.Struct('<Qq')
+"""Struct packing the size and modification time of a file in InodeTable."""
+
+class InodeTable:
+    """In-memory table of the digests of hard linked files hashed in a run.
+
+    Every link to a file leads to the same inode, so a file found again under
+    another path is not read twice. Only files with more than one link are
+    kept since no other path can lead to the rest. Each entry is an integer
+    key and a bytes value of the packed size, modification time and raw
+    digest, which keeps the table compact for millions of links. A lock
+    makes an instance safe to share between threads.
+
+    Attributes:
+        hits: Integer number of lookups that found a digest.
+        saved: Integer number of bytes not read because of the hits.
+    """
+
+    def __init__(self):
+        """Create an empty table."""
+        self.hits = 0
+        self.saved = 0
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def get(self, status, names):
+        """Return a list of the digests of the inode in status or None.
+
+        Args:
+            status: os.stat_result of the file.
+            names: Sequence of string names of the hash algorithms in hashlib.
+        Returns:
+            List of string hexadecimal digest checksums in the same order as
+            names or None if any of them is not known.
+        """
+        if status.st_nlink < 2:
+            return None
+        key = (status.st_dev << 64) | status.st_ino
+        prefix = _PACKED_STATUS.pack(status.st_size, status.st_mtime_ns)
+        digests = []
+        with self._lock:
+            for name in names:
+                value = self._digests.get(name.strip().lower(), {}).get(key)
+                if (value is None) or (value[:len(prefix)] != prefix):
+                    return None
+                digests.append(value[len(prefix):].hex())
+            self.hits += 1
+            self.saved += status.st_size
+        return digests
+
+    def put(self, status, name, digest):
+        """Store digest as the digest of the inode in status for name.
+
+        Args:
+            status: os.stat_result of the file taken before it was hashed.
+            name: String name of the hash algorithm in hashlib.
+            digest: String hexadecimal digest checksum of the file.
+        """
+        if status.st_nlink < 2:
+            return
+        value = (_PACKED_STATUS.pack(status.st_size, status.st_mtime_ns) +
+                 bytes.fromhex(digest))
+        with self._lock:
+            self._digests.setdefault(name.strip().lower(), {})[
+                (status.st_dev << 64) | status.st_ino] = value
+
+class DigestCache:
+    """Persistent cache of file digests in an SQLite database.
+
+    A digest is looked up by the device, inode and algorithm of a file and is
+    only reused while the size and modification time still match, so changed
+    files are rehashed. Once there are more than max_entries digests, the
+    least recently used ones are evicted. SQLite locking makes the database
+    safe to share between processes and a lock makes an instance safe to
+    share between threads. The last use of each digest found is kept in
+    memory and written in one transaction every _EVICT_INTERVAL hits, before
+    an eviction and on close, so a warm run does not write once per file.
+
+    Attributes:
+        hits: Integer number of lookups that found a digest.
+        misses: Integer number of lookups that did not.
+    """
+
+    def __init__(self, path, max_entries=_CACHE_SIZE):
+        """Open or create the cache database at path.
+
+        Args:
+            path: String path to the SQLite database file.
+            max_entries: Optional positive int maximum number of digests to
+                keep. Defaults to _CACHE_SIZE.
+        """
+        if not isinstance(path, str):
+            raise TypeError('path must be a string path to a file.')
+        if len(path) <= 0:
+            raise ValueError('path must be a string path to a file.')
+        if not isinstance(max_entries, int):
+            raise TypeError('max_entries must be a positive int.')
+        if max_entries <= 0:
+            raise ValueError('max_entries must be a positive int.')
+
+        self.hits = 0
+        self.misses = 0
+        self._max_entries = max_entries
+        self._puts = 0
+        self._used = {}
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS digests ('
+            'device INTEGER, inode INTEGER, name TEXT, size INTEGER, '
+            'mtime INTEGER, digest TEXT, used INTEGER, '
+            'PRIMARY KEY (device, inode, name))')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS digests_used ON digests (used)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get(self, status, name):
+        """Return the cached string digest for status and name or None.
+
+        Args:
+            status: os.stat_result of the file.
+            name: String name of the hash algorithm in hashlib.
+        Returns:
+            String hexadecimal digest checksum or None if it is not cached.
+        """
+        key = (status.st_dev, status.st_ino, name.strip().lower())
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT size, mtime, digest FROM digests '
+                'WHERE device = ? AND inode = ? AND name = ?', key).fetchone()
+            if ((row is None) or (row[0] != status.st_size) or
+                (row[1] != status.st_mtime_ns)):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._used[key] = time.time_ns()
+            if self.hits % _EVICT_INTERVAL == 0:
+                self._touch()
+            return row[2]
+
+    def put(self, status, name, digest):
+        """Store digest as the digest of the file with status for name.
+
+        Files modified in the last _RACY_NS nanoseconds are not stored
+        because another write in the same timestamp tick would be missed.
+
+        Args:
+            status: os.stat_result of the file taken before it was hashed.
+            name: String name of the hash algorithm in hashlib.
+            digest: String hexadecimal digest checksum of the file.
+        """
+        now = time.time_ns()
+        if status.st_mtime_ns > now - _RACY_NS:
+            return
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (status.st_dev, status.st_ino, name.strip().lower(),
+                 status.st_size, status.st_mtime_ns, digest, now))
+            self._puts += 1
+            if self._puts % _EVICT_INTERVAL == 0:
+                self._evict()
+
+    def _touch(self):
+        """Write the last use of the digests found since the last write."""
+        if len(self._used) <= 0:
+            return
+        with self._connection:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'UPDATE digests SET used = ? '
+                'WHERE device = ? AND inode = ? AND name = ?',
+                [(used,) + key for key, used in self._used.items()])
+        self._used.clear()
+
+    def _evict(self):
+        """Delete the least recently used digests beyond max_entries."""
+        self._touch()
+        self._connection.execute(
+            'DELETE FROM digests WHERE used <= ('
+            'SELECT used FROM digests ORDER BY used DESC LIMIT 1 OFFSET ?)',
+            (self._max_entries,))
+
+    def close(self):
+        """Evict the least recently used digests and close the database."""
+        with self._lock:
+            if self._connection is not None:
+                self._evict()
+                self._connection.close()
+                self._connection = None
+
+
+class _UnitTest(unittest.TestCase):
+    def test_digest_cache(self):
+        """Test batching the last use of the digests found in a DigestCache."""
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'cache.db')
+            path = os.path.join(directory, 'foo.txt')
+            with open(path, 'w') as f:
+                f.write('foo')
+            os.utime(path, ns=(0, 0))
+            status = os.stat(path)
+
+            def used():
+                connection = sqlite3.connect(database)
+                try:
+                    return connection.execute(
+                        'SELECT used FROM digests').fetchone()[0]
+                finally:
+                    connection.close()
+
+            with DigestCache(database) as cache:
+                self.assertIsNone(cache.get(status, 'md5'))
+                cache.put(status, 'MD5', 'ab' * 16)
+                stored = used()
+                for _ in range(_EVICT_INTERVAL - 1):
+                    self.assertEqual(cache.get(status, ' md5'), 'ab' * 16)
+                self.assertEqual(used(), stored)
+                self.assertEqual(cache.get(status, 'md5'), 'ab' * 16)
+                self.assertGreater(used(), stored)
+                stored = used()
+                self.assertEqual(cache.get(status, 'md5'), 'ab' * 16)
+                self.assertEqual(used(), stored)
+            self.assertGreater(used(), stored)
+            self.assertEqual((cache.hits, cache.misses),
+                             (_EVICT_INTERVAL + 1, 1))
+
+    def test_inode_table(self):
+        """Test looking up the digests of hard linked files."""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, str(i)) for i in range(3)]
+            with open(paths[0], 'w') as f:
+                f.write('foo')
+            os.link(paths[0], paths[1])
+            with open(paths[2], 'w') as f:
+                f.write('foo')
+
+            inodes = InodeTable()
+            status = os.stat(paths[0])
+            self.assertIsNone(inodes.get(status, ['md5']))
+            inodes.put(status, 'MD5', 'ab' * 16)
+            inodes.put(status, 'sha1', 'cd' * 20)
+            self.assertEqual(inodes.get(os.stat(paths[1]), [' md5', 'sha1']),
+                             ['ab' * 16, 'cd' * 20])
+            self.assertEqual((inodes.hits, inodes.saved), (1, 3))
+            # Every name must be known and files with one link are not kept
+            self.assertIsNone(inodes.get(status, ['md5', 'sha256']))
+            inodes.put(os.stat(paths[2]), 'md5', 'ab' * 16)
+            self.assertIsNone(inodes.get(os.stat(paths[2]), ['md5']))
+
+            # A file changed since it was hashed is not found
+            with open(paths[1], 'w') as f:
+                f.write('bar')
+            self.assertIsNone(inodes.get(os.stat(paths[0]), ['md5']))
+            self.assertEqual(inodes.hits, 1)
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -18,6 +18,7 @@ python3 dog.py -w 79 LICENSE > tests/dog_LICENSE.temp
 python3 checksum.py md5 LICENSE > tests/checksum_md5.temp
 python3 checksum.py md5 LICENSE sha1 > tests/checksum_sha1.temp
 python3 checksum.py LICENSE sha256 > tests/checksum_sha256.temp
+python3 checksum.py -a md5 -a sha1 LICENSE > tests/checksum_multi.temp
 
 python3 sort_sha.py tests/sort_sha.in > tests/sort_sha.temp
 
@@ -2,32 +2,163 @@
 
 Confirm all the files in base can be found and are identical in copy but not
 vice versa. Basically, it establishes base is a subset of copy.
-For bidirectionality, reverse the arguments and run the comparison again.
+For bidirectionality, use --both to also find the files only in copy in the
+same traversal.
 
-File comparisons are done using a hash algorithm in hashlib.
+File comparisons are done using a hash algorithm in hashlib. Cheaper checks
+on existence and size run first so most mismatches are found without hashing.
 """
 
+import collections
+import concurrent.futures
+import contextlib
 import hashlib
+import io
+import json
 import os
 import os.path
+import sqlite3
+import stat
+import sys
+import tempfile
+import time
 import unittest
 
+import tree_walk
+from hash_cache import _CACHE_SIZE, DigestCache, InodeTable
+
 _DEFAULT_HASH = 'sha256'
 """String name of the default hash algorithm in hashlib to use."""
 
 # Set this larger than 2047 bytes so the Python GIL is released
 _SIZE = 2048
-"""Positive integer number of bytes to read from a file at a time."""
+"""Positive integer minimum number of bytes to read from a file at a time."""
+
+_MAX_SIZE = 1024 * 1024
+"""Positive integer number of bytes a read can grow to for large files."""
+
+_DEFAULT_JOBS = 1
+"""Positive integer number of files to compare concurrently."""
+
+_SAME = 'same'
+"""String result when the file in copy matches the file in base."""
+
+_DIFFERS = 'differs'
+"""String result when the file in copy does not match the file in base."""
+
+_MISSING = 'missing'
+"""String result when the file in base cannot be found in copy."""
+
+_EXTRA = 'extra'
+"""String result when the file in copy cannot be found in base."""
+
+_SAMPLED = 'sampled'
+"""String result when only samples of the files were compared and matched."""
+
+_ERROR = 'error'
+"""String result when the files could not be compared."""
+
+_MOVED = 'moved'
+"""String result when the missing file in base was found elsewhere in copy."""
+
+_TIER_EXISTENCE = 'existence'
+"""String tier deciding a comparison by whether the copy exists."""
+
+_TIER_SIZE = 'size'
+"""String tier deciding a comparison by the file sizes."""
+
+_TIER_INODE = 'inode'
+"""String tier deciding a comparison by the files being the same inode."""
+
+_TIER_MTIME = 'mtime'
+"""String tier deciding a comparison by the sizes and modification times."""
+
+_TIER_SAMPLE = 'sample'
+"""String tier deciding a comparison by samples of the file contents."""
+
+_TIER_CONTENT = 'content'
+"""String tier deciding a comparison by the file contents."""
+
+_TIERS = (_TIER_EXISTENCE, _TIER_SIZE, _TIER_INODE, _TIER_MTIME,
+          _TIER_SAMPLE, _TIER_CONTENT)
+"""Tuple of the string tiers from cheapest to most expensive."""
+
+Result = collections.namedtuple('Result', [
+    'path_in_base', 'path_in_copy', 'result', 'tier', 'base_size',
+    'copy_size', 'seconds', 'error'])
+"""Record of comparing one file: string paths, string result and tier,
+integer sizes, float seconds taken and string error. Fields that were not
+needed or do not apply are None."""
+
+_SAMPLE_SIZE = 64 * 1024
+"""Positive integer number of bytes in each block sampled from a file."""
+
+_SAMPLES = 8
+"""Non-negative integer number of blocks sampled between the first and last."""
 
-def checksum(path, name=_DEFAULT_HASH, size=_SIZE):
+_MAX_CANDIDATES = 1000
+"""Positive integer number of files of the same size to try for a move."""
+
+def _cache_key(status):
+    """Return a tuple of the fields in status that identify file contents."""
+    return (status.st_dev, status.st_ino, status.st_size, status.st_mtime_ns)
+
+def _block_size(status, size=_SIZE):
+    """Return the integer number of bytes to read at a time from a file.
+
+    Start from the larger of size and the preferred I/O size of the file
+    system, then double it until the file fits in a single read or the
+    block reaches _MAX_SIZE. Small files are read with one call while large
+    files amortize the Python overhead per read over a larger block.
+
+    Args:
+        status: os.stat_result of the file.
+        size: Optional positive int minimum number of bytes to read at a
+            time. Defaults to _SIZE.
+    Returns:
+        Integer number of bytes to read at a time.
+    """
+    block = max(size, getattr(status, 'st_blksize', 0) or 0)
+    while (block < status.st_size) and (block < _MAX_SIZE):
+        block *= 2
+    return block
+
+def _read_blocks(f, size=_SIZE):
+    """Yield memoryview blocks of the unbuffered binary file f.
+
+    One buffer is allocated and reused with readinto() so no new bytes
+    object is created per read. Each block is only valid until the next one
+    is yielded.
+
+    Args:
+        f: File object opened with open(path, 'rb', buffering=0).
+        size: Optional positive int minimum number of bytes to read at a
+            time. Defaults to _SIZE.
+    Yields:
+        memoryview of the bytes just read.
+    """
+    buffer = bytearray(_block_size(os.fstat(f.fileno()), size))
+    view = memoryview(buffer)
+    while True:
+        # readinto() returns 0 once EOF is reached and else breaks the loop
+        count = f.readinto(buffer)
+        if not count:
+            break
+        yield view[:count]
+
+def checksum(path, name=_DEFAULT_HASH, size=_SIZE, cache=None, inodes=None):
     """Return the string hexadecimal digest checksum of the file at path.
 
     Args:
         path: String path to the file.
         name: Optional string name of the hash algorithm in hashlib to use.
             Defaults to _DEFAULT_HASH.
-        size: Optional positive int number of bytes to read from the file at
-            a time. Defaults to _SIZE.
+        size: Optional positive int minimum number of bytes to read from the
+            file at a time. Defaults to _SIZE.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the file.
+        inodes: Optional InodeTable of the hard linked files already hashed.
+            Defaults to None to read the file for every link.
     Returns:
         String hexadecimal digest checksum of the file at path.
     """
@@ -43,15 +174,191 @@ def checksum(path, name=_DEFAULT_HASH, size=_SIZE):
         raise ValueError('size must be a positive int > 1024.')
 
     name = name.strip().lower()
+    status = None
+    if (cache is not None) or (inodes is not None):
+        status = os.stat(path)
+        if inodes is not None:
+            digests = inodes.get(status, [name])
+            if digests is not None:
+                return digests[0]
+        if cache is not None:
+            digest = cache.get(status, name)
+            if digest is not None:
+                return digest
+
     m = hashlib.new(name)
-    with open(path, 'rb') as f:
+    with open(path, 'rb', buffering=0) as f:
+        for block in _read_blocks(f, size):
+            m.update(block)
+    digest = m.hexdigest()
+
+    # Only keep the digest if the file did not change while being read
+    if (status is not None) and (_cache_key(os.stat(path)) ==
+                                 _cache_key(status)):
+        if cache is not None:
+            cache.put(status, name, digest)
+        if inodes is not None:
+            inodes.put(status, name, digest)
+    return digest
+
+def _read_full(f, view):
+    """Return the number of bytes read into view, which is short only at EOF.
+
+    Args:
+        f: File object opened with open(path, 'rb', buffering=0).
+        view: Writable memoryview to fill.
+    Returns:
+        Integer number of bytes read.
+    """
+    total = 0
+    while total < len(view):
+        count = f.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+def _pread_full(f, view, offset):
+    """Return the number of bytes read into view from offset in f.
+
+    os.preadv() reads at offset without moving the file position. Platforms
+    without it fall back to seeking.
+
+    Args:
+        f: File object opened with open(path, 'rb', buffering=0).
+        view: Writable memoryview to fill.
+        offset: Non-negative int position in the file to read from.
+    Returns:
+        Integer number of bytes read, which is short only at EOF.
+    """
+    total = 0
+    while total < len(view):
+        if hasattr(os, 'preadv'):
+            count = os.preadv(f.fileno(), [view[total:]], offset + total)
+        else:
+            f.seek(offset + total)
+            count = f.readinto(view[total:])
+        if not count:
+            break
+        total += count
+    return total
+
+def compare_bytes(path1, path2, size=_SIZE):
+    """Return True if the files at path1 and path2 have identical contents.
+
+    Both files are read in lockstep into two reused buffers and the comparison
+    stops at the first block that differs, so no hashing is done and files
+    that differ early are not read to the end.
+
+    Args:
+        path1: String path to a file.
+        path2: String path to the other file.
+        size: Optional positive int minimum number of bytes to read from each
+            file at a time. Defaults to _SIZE.
+    Returns:
+        True if the contents are identical. False otherwise.
+    """
+    for path in [path1, path2]:
+        if not isinstance(path, str):
+            raise TypeError('path must be a valid string path to a file.')
+        if not os.path.isfile(path):
+            raise ValueError('path must be a valid string path to a file.')
+    if not isinstance(size, int):
+        raise TypeError('size must be a positive int > 1024.')
+    if size <= 1024:
+        raise ValueError('size must be a positive int > 1024.')
+
+    with open(path1, 'rb', buffering=0) as f1, \
+         open(path2, 'rb', buffering=0) as f2:
+        status1 = os.fstat(f1.fileno())
+        status2 = os.fstat(f2.fileno())
+        if status1.st_size != status2.st_size:
+            return False
+        block = _block_size(status1, size)
+        buffer1 = bytearray(block)
+        buffer2 = bytearray(block)
+        view1 = memoryview(buffer1)
+        view2 = memoryview(buffer2)
         while True:
-            # read() returns '' once EOF is reached and else breaks the loop
-            data = f.read(size)
-            if len(data) > 0:
-                m.update(data)
-            else:
-                break
+            count1 = _read_full(f1, view1)
+            count2 = _read_full(f2, view2)
+            if count1 != count2:
+                return False
+            if count1 < block:
+                # Only the final short block needs slicing
+                return buffer1[:count1] == buffer2[:count2]
+            # Comparing bytearrays uses memcmp() unlike memoryviews
+            if buffer1 != buffer2:
+                return False
+
+def _sample_offsets(length, samples, size=_SAMPLE_SIZE):
+    """Return a list of the integer offsets of the blocks to sample.
+
+    The first block, the last block and samples blocks evenly spaced between
+    them are sampled. Files too small for the blocks to be worth sampling
+    return an empty list.
+
+    Args:
+        length: Integer size of the file.
+        samples: Non-negative int number of blocks to sample between the
+            first and the last.
+        size: Optional positive int number of bytes in each block.
+            Defaults to _SAMPLE_SIZE.
+    Returns:
+        List of integer offsets in increasing order.
+    """
+    if length <= (samples + 2) * size:
+        return []
+    last = length - size
+    middle = [last * i // (samples + 1) for i in range(1, samples + 1)]
+    return [0] + middle + [last]
+
+def sample_checksum(path, name=_DEFAULT_HASH, samples=_SAMPLES,
+                    size=_SAMPLE_SIZE):
+    """Return the string hexadecimal digest of samples of the file at path.
+
+    The digest covers the size of the file and the blocks at the offsets from
+    _sample_offsets(), read with positioned reads. Equal digests only mean
+    the sampled blocks are equal, but unequal digests mean the files differ.
+
+    Args:
+        path: String path to the file.
+        name: Optional string name of the hash algorithm in hashlib to use.
+            Defaults to _DEFAULT_HASH.
+        samples: Optional non-negative int number of blocks to sample between
+            the first and the last. Defaults to _SAMPLES.
+        size: Optional positive int number of bytes in each block.
+            Defaults to _SAMPLE_SIZE.
+    Returns:
+        String hexadecimal digest or None if the file is too small to sample.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a valid string path to a file.')
+    if not os.path.isfile(path):
+        raise ValueError('path must be a valid string path to a file.')
+    if not isinstance(name, str):
+        raise TypeError('name must be a string.')
+    if not isinstance(samples, int):
+        raise TypeError('samples must be a non-negative int.')
+    if samples < 0:
+        raise ValueError('samples must be a non-negative int.')
+    if not isinstance(size, int):
+        raise TypeError('size must be a positive int.')
+    if size <= 0:
+        raise ValueError('size must be a positive int.')
+
+    m = hashlib.new(name.strip().lower())
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        length = os.fstat(f.fileno()).st_size
+        offsets = _sample_offsets(length, samples, size)
+        if len(offsets) <= 0:
+            return None
+        m.update(length.to_bytes(8, 'little'))
+        for offset in offsets:
+            count = _pread_full(f, view, offset)
+            m.update(view[:count])
     return m.hexdigest()
 
 def break_apart(path):
@@ -122,19 +429,495 @@ def get_matching_path(path, base, replacement):
     return os.path.join(*replacement_parts)
 
 def _print_error(error):
-    """Print the OSError generated by os.walk()."""
-    print(error)
+    """Print an OSError of the walk to stderr, keeping stdout for results."""
+    print(error, file=sys.stderr)
 
-def walk_and_compare(base, copy, name=_DEFAULT_HASH, verbose=False):
-    """Walk directory base and compare each file against directory copy.
+def _ordered_map(function, items, jobs=_DEFAULT_JOBS, depth=None):
+    """Yield a tuple of item and function(item) for each item in items.
+
+    The tuples are yielded in the same order as items. With more than one job,
+    function is called by a pool of threads. At most depth items are in flight
+    at a time so items can be a lazy iterable of any length. Items not started
+    yet are cancelled if the generator is closed early.
+
+    Args:
+        function: Callable taking one item.
+        items: Iterable of items to pass to function.
+        jobs: Optional positive int number of items to process concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of items in flight, at
+            least jobs. Defaults to None for 2 * jobs.
+    Yields:
+        Tuple of item and the return value of function(item).
+    """
+    if not isinstance(jobs, int):
+        raise TypeError('jobs must be a positive int.')
+    if jobs <= 0:
+        raise ValueError('jobs must be a positive int.')
+    if depth is None:
+        depth = 2 * jobs
+    if not isinstance(depth, int):
+        raise TypeError('depth must be a positive int >= jobs.')
+    if depth < jobs:
+        raise ValueError('depth must be a positive int >= jobs.')
+
+    if jobs == 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append((item, executor.submit(function, item)))
+                if len(pending) >= depth:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            for item, future in pending:
+                future.cancel()
+
+def _compare_files(path_in_base, path_in_copy, name=_DEFAULT_HASH,
+                   mtime=False, cache=None, base_entry=None, copy_entry=None,
+                   samples=0, inodes=None):
+    """Return a tuple of the result of comparing two files and its tier.
+
+    The cheapest checks run first and each later one only runs when the
+    earlier ones cannot decide:
+    1. _TIER_EXISTENCE: the copy is missing.
+    2. _TIER_SIZE: the sizes differ.
+    3. _TIER_INODE: both paths are hard links to the same file.
+    4. _TIER_MTIME: if mtime is True, equal sizes and modification times
+       are trusted to mean the files are the same.
+    5. _TIER_SAMPLE: if samples is positive, only samples of large files
+       are compared with sample_checksum(). Matching samples give _SAMPLED.
+    6. _TIER_CONTENT: the digests or the bytes of the files are compared.
+
+    Args:
+        path_in_base: String path to the file in base.
+        path_in_copy: String path to the matching file in copy.
+        name: Optional string name of the hash function in hashlib to use,
+            'bytes' to compare the contents directly with compare_bytes() or
+            'name' to only check the copy exists. Defaults to _DEFAULT_HASH.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        base_entry: Optional os.DirEntry of the file in base from listing
+            its directory. Defaults to None.
+        copy_entry: Optional os.DirEntry of the file in copy from listing
+            its directory. Defaults to None.
+        samples: Optional non-negative int number of blocks to sample between
+            the first and the last of large files. Defaults to 0 to compare
+            the whole files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+    Returns:
+        Tuple of string result, one of _SAME, _SAMPLED, _DIFFERS and
+        _MISSING, the string tier that decided it, and the integer sizes of
+        the files in base and in copy or None if they were not needed.
+    """
+    try:
+        if copy_entry is None:
+            copy_status = os.stat(path_in_copy)
+        else:
+            copy_status = copy_entry.stat()
+    except OSError:
+        return _MISSING, _TIER_EXISTENCE, None, None
+    if not stat.S_ISREG(copy_status.st_mode):
+        return _MISSING, _TIER_EXISTENCE, None, None
+    if name == 'name':
+        return _SAME, _TIER_EXISTENCE, None, copy_status.st_size
+
+    if base_entry is None:
+        base_status = os.stat(path_in_base)
+    else:
+        base_status = base_entry.stat()
+    sizes = (base_status.st_size, copy_status.st_size)
+    if base_status.st_size != copy_status.st_size:
+        return (_DIFFERS, _TIER_SIZE) + sizes
+    if ((base_status.st_dev == copy_status.st_dev) and
+        (base_status.st_ino == copy_status.st_ino)):
+        return (_SAME, _TIER_INODE) + sizes
+    if mtime and (base_status.st_mtime_ns == copy_status.st_mtime_ns):
+        return (_SAME, _TIER_MTIME) + sizes
+    if (samples > 0) and (len(_sample_offsets(base_status.st_size,
+                                              samples)) > 0):
+        sample_name = _DEFAULT_HASH if name == 'bytes' else name
+        if (sample_checksum(path_in_base, sample_name, samples) !=
+            sample_checksum(path_in_copy, sample_name, samples)):
+            return (_DIFFERS, _TIER_SAMPLE) + sizes
+        return (_SAMPLED, _TIER_SAMPLE) + sizes
+    if name == 'bytes':
+        if compare_bytes(path_in_base, path_in_copy):
+            return (_SAME, _TIER_CONTENT) + sizes
+        return (_DIFFERS, _TIER_CONTENT) + sizes
+    if (checksum(path_in_base, name, cache=cache, inodes=inodes) !=
+        checksum(path_in_copy, name, cache=cache, inodes=inodes)):
+        return (_DIFFERS, _TIER_CONTENT) + sizes
+    return (_SAME, _TIER_CONTENT) + sizes
+
+def _same_devices(paths, exists, devices):
+    """Return whether each existing path is on the matching device.
+
+    Args:
+        paths: Tuple of string paths to a directory in base and in copy.
+        exists: Tuple of boolean flags indicating whether each path exists.
+        devices: Tuple of integer devices of base and of copy.
+    Returns:
+        Boolean False if a path is on another file system or cannot be
+        stat'ed.
+    """
+    for path, exist, device in zip(paths, exists, devices):
+        if not exist:
+            continue
+        try:
+            if os.stat(path).st_dev != device:
+                return False
+        except OSError as error:
+            _print_error(error)
+            return False
+    return True
+
+def _list_directory(path):
+    """Return a tuple of sorted lists of the file and directory names in path.
+
+    Like os.walk(), symbolic links to directories are not listed as
+    directories to descend into.
+
+    Args:
+        path: String path to a directory or None.
+    Returns:
+        Tuple of sorted list of string filenames, sorted list of string names
+        of directories to descend into, set of string names of all the
+        directories and dictionary mapping each filename to its os.DirEntry.
+        Empty if path is None or cannot be listed.
+    """
+    filenames, dirnames, all_dirnames, entries = [], [], set(), {}
+    if path is None:
+        return filenames, dirnames, all_dirnames, entries
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    is_dir = entry.is_dir()
+                    is_symlink = is_dir and entry.is_symlink()
+                except OSError as error:
+                    # Like a symbolic link loop, report it and keep listing
+                    _print_error(error)
+                    continue
+                if is_dir:
+                    all_dirnames.add(entry.name)
+                    if not is_symlink:
+                        dirnames.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+                    entries[entry.name] = entry
+    except OSError as error:
+        _print_error(error)
+    filenames.sort()
+    dirnames.sort()
+    return filenames, dirnames, all_dirnames, entries
+
+def _list_files(path):
+    """Return a dictionary mapping the names of the files in path to entries.
+
+    Like os.path.isfile(), symbolic links to files count as files. A
+    directory that does not exist or cannot be listed has no files.
+
+    Args:
+        path: String path to a directory.
+    Returns:
+        Dictionary mapping string filenames to their os.DirEntry.
+    """
+    files = {}
+    try:
+        with os.scandir(path) as iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_file():
+                        files[entry.name] = entry
+                except OSError:
+                    # Not a file in copy, which the walk of base reports
+                    continue
+    except OSError:
+        pass
+    return files
+
+def _walk_pairs(base, copy, excludes=(), max_depth=None,
+                one_filesystem=False):
+    """Yield a tuple for each file in base with its path in copy.
+
+    Base is walked with tree_walk.walk_tree() and each directory in copy is
+    listed once with os.scandir() so whether a file exists in copy is answered
+    from the listing instead of a stat per file.
 
     Args:
         base: String path to the base directory.
         copy: String path to the copy directory.
-        name: Optional string name of the hash function in hashlib to use.
-            Defaults to _DEFAULT_HASH.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on other file systems. Defaults to
+            False.
+    Yields:
+        Tuple of string path to a file in base, string matching path in copy,
+        _MISSING if it is not a file in copy or None if both need comparing,
+        os.DirEntry of the file in base and os.DirEntry of the file in copy or
+        None, in sorted order with the files in a directory before its
+        subdirectories.
+    """
+    for path, dirs, files in tree_walk.walk_tree(
+            base, excludes, max_depth, one_filesystem, onerror=_print_error):
+        # Sorting in place makes the walk descend in sorted order
+        dirs.sort(key=lambda entry: entry.name)
+        suffix = path[len(base):].lstrip(os.sep)
+        copy_path = os.path.join(copy, suffix) if len(suffix) > 0 else copy
+        copy_entries = _list_files(copy_path)
+        for entry in sorted(files, key=lambda entry: entry.name):
+            try:
+                entry.is_dir()
+            except OSError as error:
+                # Like a symbolic link loop, report it and keep walking
+                _print_error(error)
+                continue
+            copy_entry = copy_entries.get(entry.name)
+            known = None
+            if copy_entry is None:
+                known = _MISSING
+            yield (entry.path, os.path.join(copy_path, entry.name), known,
+                   entry, copy_entry)
+
+def _merge_names(names1, names2):
+    """Yield tuples pairing the names in two sorted lists like a merge join.
+
+    Args:
+        names1: Sorted list of strings.
+        names2: Sorted list of strings.
+    Yields:
+        Tuple of string name, boolean whether it is in names1 and boolean
+        whether it is in names2, in sorted order.
+    """
+    i, j = 0, 0
+    while (i < len(names1)) or (j < len(names2)):
+        if (j >= len(names2)) or ((i < len(names1)) and
+                                  (names1[i] < names2[j])):
+            yield names1[i], True, False
+            i += 1
+        elif (i >= len(names1)) or (names2[j] < names1[i]):
+            yield names2[j], False, True
+            j += 1
+        else:
+            yield names1[i], True, True
+            i += 1
+            j += 1
+
+def _walk_both(base, copy, excludes=(), max_depth=None,
+               one_filesystem=False):
+    """Yield a tuple for each file in either base or copy in one traversal.
+
+    Both directories are listed once and their sorted listings are paired
+    like a merge join, so files only in one of them are found without
+    walking the trees twice.
+
+    Args:
+        base: String path to the base directory.
+        copy: String path to the copy directory.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on another file system than base or
+            copy. Defaults to False.
+    Yields:
+        Tuple of string path to a file in base, string matching path in copy,
+        _MISSING if it is only in base, _EXTRA if it is only in copy or None
+        if both need comparing, and os.DirEntry of the file in base and in
+        copy or None.
+    """
+    excluded = tree_walk.compile_excludes(excludes)
+    devices = None
+    if one_filesystem:
+        devices = (os.stat(base).st_dev, os.stat(copy).st_dev)
+
+    stack = [(base, copy, True, True, '', 0)]
+    while len(stack) > 0:
+        base_path, copy_path, base_exists, copy_exists, relative, depth = (
+            stack.pop())
+        base_files, base_dirs, base_all_dirs, base_entries = _list_directory(
+            base_path if base_exists else None)
+        copy_files, copy_dirs, copy_all_dirs, copy_entries = _list_directory(
+            copy_path if copy_exists else None)
+        prefix = relative + '/' if len(relative) > 0 else ''
+        for filename, in_base, in_copy in _merge_names(base_files, copy_files):
+            if tree_walk.is_excluded(excluded, prefix + filename):
+                continue
+            if in_base and in_copy:
+                known = None
+            elif in_base:
+                known = _MISSING
+            else:
+                known = _EXTRA
+            yield (os.path.join(base_path, filename),
+                   os.path.join(copy_path, filename), known,
+                   base_entries.get(filename), copy_entries.get(filename))
+
+        if (max_depth is not None) and (depth >= max_depth):
+            continue
+        subdirectories = []
+        for dirname, in_base, in_copy in _merge_names(base_dirs, copy_dirs):
+            if tree_walk.is_excluded(excluded, prefix + dirname):
+                continue
+            # A directory that is a symbolic link on one side is still
+            # followed there when it is a real directory on the other side
+            paths = (os.path.join(base_path, dirname),
+                     os.path.join(copy_path, dirname))
+            exists = (dirname in base_all_dirs, dirname in copy_all_dirs)
+            if (devices is not None) and not _same_devices(paths, exists,
+                                                           devices):
+                continue
+            subdirectories.append(paths + exists +
+                                  (prefix + dirname, depth + 1))
+        # Reverse so the stack pops the subdirectories in sorted order
+        stack.extend(reversed(subdirectories))
+
+def _timed(compare):
+    """Return a function timing compare and turning its errors into results.
+
+    Args:
+        compare: Callable taking one item and returning a tuple of string
+            result, string tier, base size and copy size.
+    Returns:
+        Callable taking one item and returning the same tuple followed by
+        the float number of seconds compare took and the string error or
+        None. Errors have the result _ERROR and None for the tier and sizes.
+    """
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            outcome = compare(item)
+        except (OSError, ValueError) as error:
+            return (_ERROR, None, None, None, time.perf_counter() - start,
+                    str(error))
+        return outcome + (time.perf_counter() - start, None)
+    return timed
+
+def _records(results):
+    """Yield a Result for each item in results.
+
+    Args:
+        results: Iterable of tuples of a tuple of string path in base, string
+            path in copy and anything else, and a tuple of the fields of
+            Result after the paths.
+    Yields:
+        Result for each item in results.
+    """
+    for (path_in_base, path_in_copy, *rest), outcome in results:
+        yield Result(path_in_base, path_in_copy, *outcome)
+
+def _moved_records(finder):
+    """Yield a Result for each missing file added to finder found in copy."""
+    for path_in_base, path_in_copy in finder.find():
+        yield Result(path_in_base, path_in_copy, _MOVED, None, None, None,
+                     None, None)
+
+def _print_results(records, verbose=False, output='text'):
+    """Print the files that are missing or differ and count the tiers.
+
+    Args:
+        records: Iterable of Result.
         verbose: Optional boolean flag indicating whether to print the
             filenames as they are being compared. Defaults to False.
+        output: Optional string format to print in, 'text' or 'jsonl' for
+            every record as a JSON object on its own line. Defaults to
+            'text'.
+    Returns:
+        collections.Counter of the number of files each tier decided.
+    """
+    tiers = collections.Counter()
+    for record in records:
+        if record.tier is not None:
+            tiers[record.tier] += 1
+        if output == 'jsonl':
+            print(json.dumps(record._asdict()))
+            continue
+        if verbose and (record.result != _MOVED):
+            print('{0} vs {1}'.format(record.path_in_base,
+                                      record.path_in_copy))
+        if record.result == _MISSING:
+            print('{0} not found!'.format(record.path_in_copy))
+        elif record.result == _EXTRA:
+            # Report it like running again with the arguments reversed
+            print('{0} not found!'.format(record.path_in_base))
+        elif record.result == _DIFFERS:
+            print('{0}: Files differ!'.format(record.path_in_base))
+        elif record.result == _SAMPLED:
+            print('{0}: Verified by sampling only'.format(
+                record.path_in_base))
+        elif record.result == _MOVED:
+            print('{0} moved to {1}'.format(record.path_in_base,
+                                            record.path_in_copy))
+        elif record.result == _ERROR:
+            print(record.error)
+    return tiers
+
+def compare_directories(base, copy, name=_DEFAULT_HASH, cache=None,
+                        mtime=False, jobs=_DEFAULT_JOBS, depth=None,
+                        both=False, moves=False, move_index='', samples=0,
+                        inodes=None, excludes=(), max_depth=None,
+                        one_filesystem=False):
+    """Compare each file in directory base against directory copy lazily.
+
+    With more than one job, the walk feeds a bounded queue of files that a
+    pool of threads stats and hashes while the results are still yielded in
+    the order of the walk. This hides the latency of network file systems.
+    Nothing is buffered besides the queue so any number of files can be
+    consumed incrementally.
+
+    Args:
+        base: String path to the base directory.
+        copy: String path to the copy directory.
+        name: Optional string name of the hash function in hashlib to use.
+            Defaults to _DEFAULT_HASH.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        jobs: Optional positive int number of files to compare concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of files queued or being
+            compared, at least jobs. Defaults to None for 2 * jobs.
+        both: Optional boolean flag indicating whether to walk base and copy
+            together and also report the files only in copy. Defaults to
+            False.
+        moves: Optional boolean flag indicating whether to look for the
+            missing files elsewhere in copy by their contents. Defaults to
+            False.
+        move_index: Optional string path to an SQLite database to keep the
+            index of moves in. Defaults to the empty string for a temporary
+            file.
+        samples: Optional non-negative int number of blocks to sample between
+            the first and the last of large files instead of comparing them
+            whole. Defaults to 0 to compare the whole files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on other file systems. Defaults to
+            False.
+    Returns:
+        Generator of Result in the order of the walk, followed by the files
+        found moved if moves is True.
     """
     if not isinstance(base, str):
         raise TypeError('base must be a string path to a directory.')
@@ -146,39 +929,614 @@ def walk_and_compare(base, copy, name=_DEFAULT_HASH, verbose=False):
         raise ValueError('copy must be a string path to a directory.')
     if not isinstance(name, str):
         raise TypeError('name must be a string.')
+    if not isinstance(samples, int):
+        raise TypeError('samples must be a non-negative int.')
+    if samples < 0:
+        raise ValueError('samples must be a non-negative int.')
     name = name.strip().lower()
-    filename_only = name == 'name'
-
-    for path, dirnames, filenames in os.walk(base, onerror=_print_error):
-        # Ignore dirnames because we only compare files
-        copy_path = get_matching_path(path, base, copy)
-##        print('path:', break_apart(path))
-##        print('base:', break_apart(base))
-##        print('copy:', break_apart(copy))
-##        print(copy_path)
-
-        checksums = {}
-        if not filename_only:
-            # Calculate checksums of the files in the current subdirectory
-            for filename in filenames:
-                checksums[filename] = checksum(
-                    os.path.join(path, filename), name)
-        for filename in filenames:
-            path_in_base = os.path.join(path, filename)
-            path_in_copy = os.path.join(copy_path, filename)
-            if verbose:
-                print('{0} vs {1}'.format(path_in_base, path_in_copy))
-
-            if os.path.isfile(path_in_copy):
-                if not filename_only:
-                    copy_checksum = checksum(path_in_copy, name)
-                    if (checksums[filename] != copy_checksum):
-                        print('{0}: Files differ!'.format(path_in_base))
+
+    def compare(pair):
+        path_in_base, path_in_copy, known, base_entry, copy_entry = pair
+        if known is not None:
+            return known, _TIER_EXISTENCE, None, None
+        return _compare_files(path_in_base, path_in_copy, name, mtime, cache,
+                              base_entry, copy_entry, samples, inodes)
+
+    def generate():
+        if both:
+            pairs = _walk_both(base, copy, excludes, max_depth,
+                               one_filesystem)
+        else:
+            pairs = _walk_pairs(base, copy, excludes, max_depth,
+                                one_filesystem)
+        results = _ordered_map(_timed(compare), pairs, jobs, depth)
+        if not moves:
+            yield from _records(results)
+            return
+        with MoveFinder(copy, name, cache, move_index, excludes, max_depth,
+                        one_filesystem) as finder:
+            yield from _records(_record_missing(results, finder))
+            yield from _moved_records(finder)
+
+    return generate()
+
+def walk_and_compare(base, copy, name=_DEFAULT_HASH, verbose=False,
+                     cache=None, mtime=False, jobs=_DEFAULT_JOBS, depth=None,
+                     both=False, moves=False, move_index='', samples=0,
+                     output='text', inodes=None, excludes=(),
+                     max_depth=None, one_filesystem=False):
+    """Walk directory base and compare each file against directory copy.
+
+    Prints the records of compare_directories() as they are yielded.
+
+    Args:
+        base: String path to the base directory.
+        copy: String path to the copy directory.
+        name: Optional string name of the hash function in hashlib to use.
+            Defaults to _DEFAULT_HASH.
+        verbose: Optional boolean flag indicating whether to print the
+            filenames as they are being compared. Defaults to False.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        jobs: Optional positive int number of files to compare concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of files queued or being
+            compared, at least jobs. Defaults to None for 2 * jobs.
+        both: Optional boolean flag indicating whether to walk base and copy
+            together and also report the files only in copy. Defaults to
+            False.
+        moves: Optional boolean flag indicating whether to look for the
+            missing files elsewhere in copy by their contents. Defaults to
+            False.
+        move_index: Optional string path to an SQLite database to keep the
+            index of moves in. Defaults to the empty string for a temporary
+            file.
+        samples: Optional non-negative int number of blocks to sample between
+            the first and the last of large files instead of comparing them
+            whole. Defaults to 0 to compare the whole files.
+        output: Optional string format to print in, 'text' or 'jsonl'.
+            Defaults to 'text'.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on other file systems. Defaults to
+            False.
+    Returns:
+        collections.Counter of the number of files each tier decided.
+    """
+    records = compare_directories(base, copy, name, cache, mtime, jobs, depth,
+                                  both, moves, move_index, samples, inodes,
+                                  excludes, max_depth, one_filesystem)
+    return _print_results(records, verbose, output)
+
+class MoveFinder:
+    """Find where files missing from copy were moved or renamed to in copy.
+
+    The missing files and the candidates in copy are kept in an SQLite
+    database rather than in memory so millions of files can be handled.
+    Only files in copy with the same size as a missing file become
+    candidates, and each candidate is hashed at most once, so most of copy
+    is never read. At most _MAX_CANDIDATES candidates are tried for each
+    missing file and a candidate is paired with one missing file at most.
+    Empty files are left out since any two of them match. Paths are stored
+    as bytes so names that are not valid UTF-8 are kept.
+
+    Attributes:
+        found: Integer number of missing files found elsewhere in copy.
+    """
+
+    def __init__(self, copy, name=_DEFAULT_HASH, cache=None, database='',
+                 excludes=(), max_depth=None, one_filesystem=False):
+        """Create a finder for the files missing from the directory copy.
+
+        Args:
+            copy: String path to the copy directory.
+            name: Optional string name of the hash function in hashlib to use.
+                _DEFAULT_HASH is used for 'name' and 'bytes'. Defaults to
+                _DEFAULT_HASH.
+            cache: Optional DigestCache to reuse and store digests in.
+                Defaults to None to always read the files.
+            database: Optional string path to an SQLite database to keep the
+                index in. Defaults to the empty string for a temporary file
+                that is deleted by close().
+            excludes: Optional iterable of string glob patterns of the names
+                or relative paths in copy to skip. Defaults to ().
+            max_depth: Optional non-negative int number of levels of
+                subdirectories of copy to descend into. Defaults to None for
+                no limit.
+            one_filesystem: Optional boolean flag indicating whether to not
+                descend into directories on other file systems. Defaults to
+                False.
+        """
+        if not isinstance(copy, str):
+            raise TypeError('copy must be a string path to a directory.')
+        if not os.path.isdir(copy):
+            raise ValueError('copy must be a string path to a directory.')
+        if not isinstance(name, str):
+            raise TypeError('name must be a string.')
+        if not isinstance(database, str):
+            raise TypeError('database must be a string path to a file.')
+
+        self.found = 0
+        self._copy = copy
+        self._walk_options = (excludes, max_depth, one_filesystem)
+        self._name = name.strip().lower()
+        if self._name in ('name', 'bytes'):
+            self._name = _DEFAULT_HASH
+        self._cache = cache
+        self._temporary = ''
+        if len(database) <= 0:
+            handle, database = tempfile.mkstemp(suffix='.db')
+            os.close(handle)
+            self._temporary = database
+        self._connection = sqlite3.connect(database)
+        with self._connection:
+            self._connection.execute('DROP TABLE IF EXISTS missing')
+            self._connection.execute('DROP TABLE IF EXISTS candidates')
+            self._connection.execute(
+                'CREATE TABLE missing (path BLOB PRIMARY KEY, size INTEGER, '
+                'digest TEXT)')
+            self._connection.execute(
+                'CREATE TABLE candidates (path BLOB PRIMARY KEY, '
+                'size INTEGER, digest TEXT)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def add(self, path_in_base, size=None, digest=None):
+        """Add a file in base that is missing from copy.
+
+        Args:
+            path_in_base: String path to the file in base.
+            size: Optional integer size of the file. Defaults to None to stat
+                path_in_base.
+            digest: Optional string digest of the file with the name this
+                finder uses. Defaults to None to hash path_in_base if needed.
+        """
+        if size is None:
+            try:
+                size = os.stat(path_in_base).st_size
+            except OSError as error:
+                _print_error(error)
+                return
+        if size <= 0:
+            # Every empty file has the same contents
+            return
+        self._connection.execute(
+            'INSERT OR REPLACE INTO missing VALUES (?, ?, ?)',
+            (os.fsencode(path_in_base), size, digest))
+
+    def _hash(self, path):
+        """Return the string digest of the file at path or None on error."""
+        try:
+            return checksum(path, self._name, cache=self._cache)
+        except (OSError, ValueError) as error:
+            _print_error(error)
+            return None
+
+    def find(self):
+        """Yield each missing file found in copy and where it was found.
+
+        Yields:
+            Tuple of string path to the file in base and string path to a
+            file in copy with the same contents.
+        """
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS missing_size ON missing (size)')
+        for path, dirs, files in tree_walk.walk_tree(
+                self._copy, *self._walk_options, onerror=_print_error):
+            for entry in files:
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    continue
+                if size <= 0:
+                    continue
+                if self._connection.execute(
+                        'SELECT 1 FROM missing WHERE size = ? LIMIT 1',
+                        (size,)).fetchone() is not None:
+                    self._connection.execute(
+                        'INSERT OR IGNORE INTO candidates VALUES (?, ?, NULL)',
+                        (os.fsencode(entry.path), size))
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS candidates_size ON candidates (size)')
+        self._connection.commit()
+
+        missing = self._connection.execute(
+            'SELECT path, size, digest FROM missing ORDER BY size, path')
+        for base_key, size, digest in missing:
+            path_in_base = os.fsdecode(base_key)
+            candidates = self._connection.execute(
+                'SELECT path, digest FROM candidates WHERE size = ? '
+                'ORDER BY path LIMIT ?', (size, _MAX_CANDIDATES))
+            for copy_key, candidate in candidates:
+                path_in_copy = os.fsdecode(copy_key)
+                if digest is None:
+                    # Only hash the missing file once it has a candidate
+                    digest = self._hash(path_in_base)
+                    if digest is None:
+                        break
+                if candidate is None:
+                    # Save the digest so each candidate is hashed only once
+                    candidate = self._hash(path_in_copy)
+                    self._connection.execute(
+                        'UPDATE candidates SET digest = ? WHERE path = ?',
+                        (candidate, copy_key))
+                if candidate == digest:
+                    # A file in copy can only be where one file moved to
+                    self._connection.execute(
+                        'DELETE FROM candidates WHERE path = ?',
+                        (copy_key,))
+                    self.found += 1
+                    yield path_in_base, path_in_copy
+                    break
+        self._connection.commit()
+
+    def close(self):
+        """Close the database and delete it if it is temporary."""
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        if len(self._temporary) > 0:
+            os.remove(self._temporary)
+            self._temporary = ''
+
+def _record_missing(results, finder):
+    """Yield each item in results after adding the missing files to finder.
+
+    Args:
+        results: Iterable of tuples of a tuple of string path in base, string
+            path in copy and an optional manifest entry, and a tuple of
+            string result and anything else.
+        finder: MoveFinder to add the files missing from copy to.
+    Yields:
+        Each item in results.
+    """
+    for item in results:
+        (path_in_base, path_in_copy, *rest), (result, *details) = item
+        if result == _MISSING:
+            if (len(rest) > 0) and isinstance(rest[0], tuple):
+                size, modified, digest = rest[0]
+                finder.add(path_in_base, size, digest)
             else:
-                print('{0} not found!'.format(path_in_copy))
+                finder.add(path_in_base)
+        yield item
+
+def _relative_parts(path, base):
+    """Return a list of the components of path relative to base."""
+    return break_apart(os.path.relpath(path, base))
+
+def export_manifest(base, database, name=_DEFAULT_HASH, cache=None,
+                    jobs=_DEFAULT_JOBS, depth=None, inodes=None, excludes=(),
+                    max_depth=None, one_filesystem=False):
+    """Save the size, modification time and digest of each file in base.
+
+    The files are written to an SQLite database as they are hashed, keyed by
+    their path relative to base with / as the separator. Paths are stored as
+    bytes so names that are not valid UTF-8 are kept. compare_manifest() can
+    then audit any number of copies against it without reading base. Only
+    regular files are saved and files that cannot be read are printed to
+    stderr and left out.
+
+    Args:
+        base: String path to the base directory.
+        database: String path to the SQLite database to replace.
+        name: Optional string name of the hash function in hashlib to use or
+            'name' to only save the paths. Defaults to _DEFAULT_HASH.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        jobs: Optional positive int number of files to hash concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of files queued or being
+            hashed, at least jobs. Defaults to None for 2 * jobs.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on other file systems. Defaults to
+            False.
+    Returns:
+        Integer number of files saved.
+    """
+    if not isinstance(base, str):
+        raise TypeError('base must be a string path to a directory.')
+    if not os.path.isdir(base):
+        raise ValueError('base must be a string path to a directory.')
+    if not isinstance(database, str):
+        raise TypeError('database must be a string path to a file.')
+    if len(database) <= 0:
+        raise ValueError('database must be a string path to a file.')
+    if not isinstance(name, str):
+        raise TypeError('name must be a string.')
+    name = name.strip().lower()
+    if name != 'name':
+        # Raise ValueError early for names hashlib does not support
+        hashlib.new(name)
+
+    def describe(path):
+        try:
+            status = os.stat(path)
+            if not stat.S_ISREG(status.st_mode):
+                return None
+            digest = None
+            if name != 'name':
+                digest = checksum(path, name, cache=cache, inodes=inodes)
+        except OSError as error:
+            return error
+        return status.st_size, status.st_mtime_ns, digest
+
+    def paths():
+        for path, dirs, files in tree_walk.walk_tree(
+                base, excludes, max_depth, one_filesystem,
+                onerror=_print_error):
+            for entry in files:
+                yield entry.path
+
+    def rows():
+        for path, described in _ordered_map(describe, paths(), jobs, depth):
+            if isinstance(described, OSError):
+                _print_error(described)
+            elif described is not None:
+                relative = '/'.join(_relative_parts(path, base))
+                yield (os.fsencode(relative),) + described
+
+    connection = sqlite3.connect(database)
+    try:
+        with connection:
+            connection.execute('DROP TABLE IF EXISTS meta')
+            connection.execute('DROP TABLE IF EXISTS files')
+            connection.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, '
+                               'value)')
+            connection.execute('CREATE TABLE files (path BLOB PRIMARY KEY, '
+                               'size INTEGER, mtime INTEGER, digest TEXT)')
+            connection.executemany(
+                'INSERT INTO meta VALUES (?, ?)',
+                [('name', name), ('base', os.fsencode(os.path.abspath(base)))])
+            connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?)',
+                                   rows())
+        return connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+    finally:
+        connection.close()
+
+def lookup_manifest(connection, relative):
+    """Return the saved size, modification time and digest of a file.
+
+    Args:
+        connection: sqlite3.Connection to a database from export_manifest().
+        relative: String path of the file relative to base with / as the
+            separator.
+    Returns:
+        Tuple of integer size, integer modification time in nanoseconds and
+        string digest or None. None if the file is not in the manifest.
+    """
+    return connection.execute(
+        'SELECT size, mtime, digest FROM files WHERE path = ?',
+        (os.fsencode(relative),)).fetchone()
+
+def _compare_entry(entry, path_in_copy, name, mtime=False, cache=None,
+                   inodes=None):
+    """Return a tuple of the result of comparing a copy with its entry.
+
+    The same tiers as _compare_files() are used with the size, modification
+    time and digest saved in a manifest standing in for the file in base.
+
+    Args:
+        entry: Tuple of integer size, integer modification time in
+            nanoseconds and string digest or None from a manifest.
+        path_in_copy: String path to the matching file in copy.
+        name: String name of the hash function in hashlib the digest was
+            calculated with or 'name' if there is none.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+    Returns:
+        Tuple of string result, one of _SAME, _DIFFERS and _MISSING, the
+        string tier that decided it, and the integer sizes of the files in
+        base and in copy or None if they were not needed.
+    """
+    size, modified, digest = entry
+    try:
+        copy_status = os.stat(path_in_copy)
+    except OSError:
+        return _MISSING, _TIER_EXISTENCE, size, None
+    if not stat.S_ISREG(copy_status.st_mode):
+        return _MISSING, _TIER_EXISTENCE, size, None
+    sizes = (size, copy_status.st_size)
+    if (name == 'name') or (digest is None):
+        return (_SAME, _TIER_EXISTENCE) + sizes
+
+    if size != copy_status.st_size:
+        return (_DIFFERS, _TIER_SIZE) + sizes
+    if mtime and (modified == copy_status.st_mtime_ns):
+        return (_SAME, _TIER_MTIME) + sizes
+    if checksum(path_in_copy, name, cache=cache, inodes=inodes) != digest:
+        return (_DIFFERS, _TIER_CONTENT) + sizes
+    return (_SAME, _TIER_CONTENT) + sizes
+
+def compare_to_manifest(database, copy, cache=None, mtime=False,
+                        jobs=_DEFAULT_JOBS, depth=None, both=False,
+                        moves=False, move_index='', inodes=None, excludes=(),
+                        max_depth=None, one_filesystem=False):
+    """Compare directory copy against a manifest saved by export_manifest().
+
+    The manifest is streamed from the database in path order so its size does
+    not matter, and base is never read. Files in base are given the path base
+    had when the manifest was saved.
+
+    Args:
+        database: String path to the SQLite database of the manifest.
+        copy: String path to the copy directory.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        jobs: Optional positive int number of files to compare concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of files queued or being
+            compared, at least jobs. Defaults to None for 2 * jobs.
+        both: Optional boolean flag indicating whether to also walk copy and
+            look up each file in the manifest to report the files only in
+            copy. Defaults to False.
+        moves: Optional boolean flag indicating whether to look for the
+            missing files elsewhere in copy by their saved digests. Defaults
+            to False.
+        move_index: Optional string path to an SQLite database to keep the
+            index of moves in. Defaults to the empty string for a temporary
+            file.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip in the manifest and in copy. Defaults to
+            ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to compare. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories of copy on other file systems. Defaults
+            to False.
+    Returns:
+        Generator of Result in manifest order, followed by the files only in
+        copy if both is True and the files found moved if moves is True.
+    """
+    if not isinstance(database, str):
+        raise TypeError('database must be a string path to a file.')
+    if not os.path.isfile(database):
+        raise ValueError('database must be a string path to a file.')
+    if not isinstance(copy, str):
+        raise TypeError('copy must be a string path to a directory.')
+    if not os.path.isdir(copy):
+        raise ValueError('copy must be a string path to a directory.')
+    excluded = tree_walk.compile_excludes(excludes)
+
+    def generate():
+        connection = sqlite3.connect(database)
+        finder = None
+        try:
+            meta = dict(connection.execute('SELECT key, value FROM meta'))
+            name, base = meta['name'], os.fsdecode(meta['base'])
+
+            def entries():
+                for relative, size, modified, digest in connection.execute(
+                        'SELECT path, size, mtime, digest FROM files '
+                        'ORDER BY path'):
+                    relative = os.fsdecode(relative)
+                    parts = relative.split('/')
+                    if tree_walk.excluded_path(excluded, relative) or (
+                            (max_depth is not None) and
+                            (len(parts) - 1 > max_depth)):
+                        continue
+                    yield (os.path.join(base, *parts),
+                           os.path.join(copy, *parts),
+                           (size, modified, digest))
+
+            def compare(item):
+                return _compare_entry(item[2], item[1], name, mtime, cache,
+                                      inodes)
+
+            def extras():
+                for path, dirs, files in tree_walk.walk_tree(
+                        copy, excludes, max_depth, one_filesystem,
+                        onerror=_print_error):
+                    for entry in files:
+                        path_in_copy = entry.path
+                        parts = _relative_parts(path_in_copy, copy)
+                        relative = '/'.join(parts)
+                        if lookup_manifest(connection, relative) is None:
+                            yield ((os.path.join(base, *parts), path_in_copy),
+                                   (_EXTRA, _TIER_EXISTENCE, None, None, None,
+                                    None))
+
+            results = _ordered_map(_timed(compare), entries(), jobs, depth)
+            if moves:
+                finder = MoveFinder(copy, name, cache, move_index, excludes,
+                                    max_depth, one_filesystem)
+                results = _record_missing(results, finder)
+            yield from _records(results)
+            if both:
+                yield from _records(extras())
+            if finder is not None:
+                yield from _moved_records(finder)
+        finally:
+            if finder is not None:
+                finder.close()
+            connection.close()
+
+    return generate()
+
+def compare_manifest(database, copy, verbose=False, cache=None, mtime=False,
+                     jobs=_DEFAULT_JOBS, depth=None, both=False, moves=False,
+                     move_index='', output='text', inodes=None, excludes=(),
+                     max_depth=None, one_filesystem=False):
+    """Compare directory copy against a manifest saved by export_manifest().
+
+    Prints the records of compare_to_manifest() as they are yielded.
+
+    Args:
+        database: String path to the SQLite database of the manifest.
+        copy: String path to the copy directory.
+        verbose: Optional boolean flag indicating whether to print the
+            filenames as they are being compared. Defaults to False.
+        cache: Optional DigestCache to reuse and store digests in.
+            Defaults to None to always read the files.
+        mtime: Optional boolean flag indicating whether equal sizes and
+            modification times are enough to skip hashing. Defaults to False.
+        jobs: Optional positive int number of files to compare concurrently.
+            Defaults to _DEFAULT_JOBS.
+        depth: Optional positive int maximum number of files queued or being
+            compared, at least jobs. Defaults to None for 2 * jobs.
+        both: Optional boolean flag indicating whether to also report the
+            files only in copy. Defaults to False.
+        moves: Optional boolean flag indicating whether to look for the
+            missing files elsewhere in copy by their saved digests. Defaults
+            to False.
+        move_index: Optional string path to an SQLite database to keep the
+            index of moves in. Defaults to the empty string for a temporary
+            file.
+        output: Optional string format to print in, 'text' or 'jsonl'.
+            Defaults to 'text'.
+        inodes: Optional InodeTable to hash each hard linked file once.
+            Defaults to None to read the files for every link.
+        excludes: Optional iterable of string glob patterns of the names or
+            relative paths to skip in the manifest and in copy. Defaults to
+            ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to compare. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories of copy on other file systems. Defaults
+            to False.
+    Returns:
+        collections.Counter of the number of files each tier decided.
+    """
+    records = compare_to_manifest(database, copy, cache, mtime, jobs, depth,
+                                  both, moves, move_index, inodes, excludes,
+                                  max_depth, one_filesystem)
+    return _print_results(records, verbose, output)
 
 
 class _UnitTest(unittest.TestCase):
+    def test_block_size(self):
+        """Test choosing the number of bytes to read at a time."""
+        status = os.stat('LICENSE')
+        self.assertGreaterEqual(_block_size(status), status.st_size)
+        self.assertGreaterEqual(_block_size(status), status.st_blksize)
+        self.assertEqual(_block_size(status, _MAX_SIZE * 4), _MAX_SIZE * 4)
+        status = os.stat_result((0,) * 6 + (_MAX_SIZE * 100,) + (0,) * 3)
+        self.assertEqual(_block_size(status), _MAX_SIZE)
+
     def test_checksum(self):
         """Test calculating the checksum for a file."""
         for value in [None, 42.0, []]:
@@ -191,6 +1549,318 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(TypeError, checksum, 'checksum.py', size=value)
         for value in range(-1, 1025):
             self.assertRaises(ValueError, checksum, 'checksum.py', size=value)
+        with open('LICENSE', 'rb') as f:
+            expected = hashlib.sha256(f.read()).hexdigest()
+        for value in [1025, 2048, 4096, _MAX_SIZE]:
+            self.assertEqual(checksum('LICENSE', size=value), expected)
+
+    def test_digest_cache(self):
+        """Test reusing digests stored in a DigestCache."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, DigestCache, value)
+            self.assertRaises(TypeError, DigestCache, 'cache.db', value)
+        self.assertRaises(ValueError, DigestCache, '')
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, DigestCache, 'cache.db', value)
+
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, 'cache.db')
+            path = os.path.join(directory, 'foobar.txt')
+            with open(path, 'w') as f:
+                f.write('foobar')
+            os.utime(path, ns=(0, 0))
+            expected = checksum(path)
+
+            with DigestCache(database) as cache:
+                self.assertEqual(checksum(path, cache=cache), expected)
+                self.assertEqual((cache.hits, cache.misses), (0, 1))
+            with DigestCache(database) as cache:
+                self.assertEqual(checksum(path, cache=cache), expected)
+                self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+                # A changed file must be rehashed
+                with open(path, 'a') as f:
+                    f.write('baz')
+                os.utime(path, ns=(0, 1))
+                expected = checksum(path)
+                self.assertEqual(checksum(path, cache=cache), expected)
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                self.assertEqual(checksum(path, cache=cache), expected)
+                self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_compare_bytes(self):
+        """Test comparing the contents of two files directly."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, compare_bytes, value, 'subset.py')
+            self.assertRaises(TypeError, compare_bytes, 'subset.py', value)
+            self.assertRaises(TypeError, compare_bytes, 'subset.py',
+                              'subset.py', value)
+        for value in ['', 'foobar', 'tests']:
+            self.assertRaises(ValueError, compare_bytes, value, 'subset.py')
+            self.assertRaises(ValueError, compare_bytes, 'subset.py', value)
+        for value in range(-1, 1025):
+            self.assertRaises(ValueError, compare_bytes, 'subset.py',
+                              'subset.py', value)
+
+        self.assertTrue(compare_bytes('subset.py', 'subset.py'))
+        self.assertFalse(compare_bytes('subset.py', 'LICENSE'))
+        with tempfile.TemporaryDirectory() as directory:
+            contents = bytes(range(256)) * 64
+            paths = []
+            for i, data in enumerate([contents, contents, contents[:-1],
+                                      contents[:-1] + b'\0',
+                                      b'\1' + contents[1:], b'', b'']):
+                paths.append(os.path.join(directory, str(i)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            for size in [1025, 2048, 4096, _MAX_SIZE]:
+                self.assertTrue(compare_bytes(paths[0], paths[1], size))
+                self.assertTrue(compare_bytes(paths[5], paths[6], size))
+                for other in paths[2:6]:
+                    self.assertFalse(compare_bytes(paths[0], other, size))
+                self.assertFalse(compare_bytes(paths[2], paths[3], size))
+
+    def test_merge_names(self):
+        """Test pairing two sorted lists of names."""
+        self.assertEqual(list(_merge_names([], [])), [])
+        self.assertEqual(list(_merge_names(['a'], [])), [('a', True, False)])
+        self.assertEqual(list(_merge_names([], ['a'])), [('a', False, True)])
+        self.assertEqual(list(_merge_names(['a', 'c', 'd'], ['b', 'c', 'e'])),
+                         [('a', True, False), ('b', False, True),
+                          ('c', True, True), ('d', True, False),
+                          ('e', False, True)])
+
+    def test_move_finder(self):
+        """Test finding files moved or renamed within copy."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, MoveFinder, value)
+            self.assertRaises(TypeError, MoveFinder, '.', value)
+            self.assertRaises(TypeError, MoveFinder, '.', database=value)
+        for value in ['', 'foobar', 'subset.py']:
+            self.assertRaises(ValueError, MoveFinder, value)
+
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                os.makedirs(os.path.join(tree, 'foo'))
+            for filename, contents in [('1', 'foo'), ('2', 'bar'),
+                                       ('3', 'bazqux'), ('4', 'quux')]:
+                with open(os.path.join(trees[0], filename), 'w') as f:
+                    f.write(contents)
+            # Empty files and more copies than one candidate are not moves
+            for filename in ['7', '8', '9']:
+                with open(os.path.join(trees[0], filename), 'w') as f:
+                    f.write('' if filename != '9' else 'foo')
+            # 1 is moved, 2 is renamed, 3 is edited and 4 is deleted
+            for filename, contents in [(os.path.join('foo', '1'), 'foo'),
+                                       ('5', 'bar'), ('3', 'bazquX'),
+                                       ('6', 'corge'), ('empty', '')]:
+                with open(os.path.join(trees[1], filename), 'w') as f:
+                    f.write(contents)
+
+            expected = [
+                '{0} not found!'.format(os.path.join(trees[1], '1')),
+                '{0} not found!'.format(os.path.join(trees[1], '2')),
+                '{0}: Files differ!'.format(os.path.join(trees[0], '3')),
+                '{0} not found!'.format(os.path.join(trees[1], '4')),
+                '{0} not found!'.format(os.path.join(trees[1], '7')),
+                '{0} not found!'.format(os.path.join(trees[1], '8')),
+                '{0} not found!'.format(os.path.join(trees[1], '9')),
+                '{0} moved to {1}'.format(os.path.join(trees[0], '2'),
+                                          os.path.join(trees[1], '5')),
+                '{0} moved to {1}'.format(os.path.join(trees[0], '1'),
+                                          os.path.join(trees[1], 'foo', '1'))]
+            index = os.path.join(directory, 'moves.db')
+            for move_index in ['', index]:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    walk_and_compare(*trees, moves=True, move_index=move_index)
+                lines = output.getvalue().splitlines()
+                self.assertCountEqual(lines[:7], expected[:7])
+                self.assertCountEqual(lines[7:], expected[7:])
+            self.assertTrue(os.path.isfile(index))
+
+            database = os.path.join(directory, 'base.db')
+            export_manifest(trees[0], database, 'md5')
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                compare_manifest(database, trees[1], moves=True)
+            lines = output.getvalue().splitlines()
+            base = os.path.abspath(trees[0])
+            self.assertCountEqual(lines[7:], [
+                line.replace(trees[0], base) for line in expected[7:]])
+
+            # Names that are not valid UTF-8 are kept
+            paths = [os.path.join(trees[0], os.fsdecode(b'\xff1')),
+                     os.path.join(trees[1], 'foo', os.fsdecode(b'\xff2'))]
+            for path in paths:
+                with open(path, 'w') as f:
+                    f.write('grault')
+            with MoveFinder(trees[1]) as finder:
+                finder.add(paths[0])
+                self.assertEqual(list(finder.find()), [tuple(paths)])
+
+    def test_manifest(self):
+        """Test comparing a copy against a manifest of base."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, export_manifest, value, 'foo.db')
+            self.assertRaises(TypeError, export_manifest, '.', value)
+            self.assertRaises(TypeError, export_manifest, '.', 'foo.db', value)
+            self.assertRaises(TypeError, compare_manifest, value, '.')
+            self.assertRaises(TypeError, compare_manifest, 'subset.py', value)
+        for value in ['', 'foobar', 'subset.py']:
+            self.assertRaises(ValueError, export_manifest, value, 'foo.db')
+        self.assertRaises(ValueError, export_manifest, '.', '')
+        self.assertRaises(ValueError, export_manifest, '.', 'foo.db', 'bytes')
+        self.assertRaises(ValueError, compare_manifest, 'foobar', '.')
+        self.assertRaises(ValueError, compare_manifest, 'subset.py',
+                          'subset.py')
+
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                os.makedirs(os.path.join(tree, 'foo'))
+                for filename, contents in [('1', 'foo'), ('2', 'bar'),
+                                           (os.path.join('foo', '3'), 'baz')]:
+                    with open(os.path.join(tree, filename), 'w') as f:
+                        f.write(contents)
+            with open(os.path.join(trees[1], '2'), 'w') as f:
+                f.write('qux')
+            os.remove(os.path.join(trees[1], 'foo', '3'))
+            with open(os.path.join(trees[1], 'foo', '4'), 'w') as f:
+                f.write('quux')
+
+            database = os.path.join(directory, 'base.db')
+            for name in ['md5', 'name']:
+                for jobs in range(1, 4):
+                    self.assertEqual(export_manifest(trees[0], database, name,
+                                                     jobs=jobs), 3)
+                    connection = sqlite3.connect(database)
+                    self.assertIsNotNone(lookup_manifest(connection, 'foo/3'))
+                    self.assertIsNone(lookup_manifest(connection, 'foo/4'))
+                    connection.close()
+
+            export_manifest(trees[0], database)
+            base = os.path.abspath(trees[0])
+            expected = [
+                '{0}: Files differ!'.format(os.path.join(base, '2')),
+                '{0} not found!'.format(os.path.join(trees[1], 'foo', '3'))]
+            for jobs in range(1, 4):
+                for both in [False, True]:
+                    output = io.StringIO()
+                    with contextlib.redirect_stdout(output):
+                        tiers = compare_manifest(database, trees[1],
+                                                 jobs=jobs, both=both)
+                    lines = output.getvalue().splitlines()
+                    if both:
+                        self.assertEqual(lines, expected + [
+                            '{0} not found!'.format(
+                                os.path.join(base, 'foo', '4'))])
+                        self.assertEqual(tiers, {_TIER_EXISTENCE: 2,
+                                                 _TIER_CONTENT: 2})
+                    else:
+                        self.assertEqual(lines, expected)
+                        self.assertEqual(tiers, {_TIER_EXISTENCE: 1,
+                                                 _TIER_CONTENT: 2})
+
+            # Special files are skipped and unreadable ones are reported
+            os.mkfifo(os.path.join(trees[0], 'fifo'))
+            os.symlink('missing', os.path.join(trees[0], 'dangling'))
+            os.symlink('loop', os.path.join(trees[0], 'loop'))
+            errors = io.StringIO()
+            with contextlib.redirect_stderr(errors):
+                self.assertEqual(export_manifest(trees[0], database,
+                                                 jobs=2), 3)
+            self.assertEqual(len(errors.getvalue().splitlines()), 2)
+
+            # Names that are not valid UTF-8 are kept
+            for tree in trees:
+                for filename in ['fifo', 'dangling', 'loop']:
+                    if os.path.lexists(os.path.join(tree, filename)):
+                        os.remove(os.path.join(tree, filename))
+                with open(os.path.join(tree, os.fsdecode(b'\xff.txt')),
+                          'w') as f:
+                    f.write('foo')
+            self.assertEqual(export_manifest(trees[0], database), 4)
+            connection = sqlite3.connect(database)
+            self.assertIsNotNone(lookup_manifest(connection,
+                                                 os.fsdecode(b'\xff.txt')))
+            connection.close()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                compare_manifest(database, trees[1], both=True)
+            self.assertEqual(len(output.getvalue().splitlines()), 3)
+
+    def test_sample_offsets(self):
+        """Test choosing the blocks to sample from a file."""
+        for length in [0, 1, 100, 200]:
+            self.assertEqual(_sample_offsets(length, 0, 100), [])
+        self.assertEqual(_sample_offsets(1000, 8, 100), [])
+        self.assertEqual(_sample_offsets(201, 0, 100), [0, 101])
+        self.assertEqual(_sample_offsets(1100, 1, 100), [0, 500, 1000])
+        self.assertEqual(_sample_offsets(1100, 4, 100),
+                         [0, 200, 400, 600, 800, 1000])
+
+    def test_sample_checksum(self):
+        """Test calculating the digest of samples of a file."""
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, sample_checksum, value)
+            self.assertRaises(TypeError, sample_checksum, 'subset.py', value)
+            self.assertRaises(TypeError, sample_checksum, 'subset.py',
+                              samples=value)
+            self.assertRaises(TypeError, sample_checksum, 'subset.py',
+                              size=value)
+        for value in ['', 'foobar', 'tests']:
+            self.assertRaises(ValueError, sample_checksum, value)
+        self.assertRaises(ValueError, sample_checksum, 'subset.py', 'foobar')
+        self.assertRaises(ValueError, sample_checksum, 'subset.py',
+                          samples=-1)
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, sample_checksum, 'subset.py',
+                              size=value)
+        self.assertIsNone(sample_checksum('LICENSE'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            contents = bytes(range(256)) * 4096
+            paths = []
+            for i, index in enumerate([None, None, 0, len(contents) - 1,
+                                       len(contents) * 2 // 5, 100000]):
+                data = bytearray(contents)
+                if index is not None:
+                    data[index] ^= 0xFF
+                paths.append(os.path.join(directory, str(i)))
+                with open(paths[-1], 'wb') as f:
+                    f.write(data)
+            expected = sample_checksum(paths[0], samples=4, size=4096)
+            self.assertIsNotNone(expected)
+            self.assertEqual(sample_checksum(paths[1], samples=4, size=4096),
+                             expected)
+            # The first, last and evenly spaced blocks are sampled, not 100000
+            for path in paths[2:5]:
+                self.assertNotEqual(sample_checksum(path, samples=4,
+                                                    size=4096), expected)
+            self.assertEqual(sample_checksum(paths[5], samples=4, size=4096),
+                             expected)
+
+            self.assertEqual(_compare_files(paths[0], paths[5])[:2],
+                             (_DIFFERS, _TIER_CONTENT))
+            self.assertEqual(_compare_files(paths[0], paths[5], samples=2)[:2],
+                             (_SAMPLED, _TIER_SAMPLE))
+            self.assertEqual(_compare_files(paths[0], paths[2], samples=2)[:2],
+                             (_DIFFERS, _TIER_SAMPLE))
+            # Small files are compared whole
+            with open('LICENSE', 'rb') as f:
+                text = f.read()
+            with open(paths[1], 'wb') as f:
+                f.write(text)
+            self.assertEqual(
+                _compare_files('LICENSE', paths[1], samples=2)[:2],
+                (_SAME, _TIER_CONTENT))
+            self.assertEqual(
+                _compare_files('LICENSE', 'LICENSE', samples=2)[:2],
+                (_SAME, _TIER_INODE))
 
     def test_break_apart(self):
         """Test the path is broken into component directories correctly."""
@@ -308,6 +1978,79 @@ class _UnitTest(unittest.TestCase):
             get_matching_path('/var/tmp/bar/', '/var/tmp/', 'foo/'),
             expected)
 
+    def test_inode_table(self):
+        """Test each hard linked file is hashed once with an InodeTable."""
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                os.makedirs(tree)
+            with open(os.path.join(trees[0], '0'), 'w') as f:
+                f.write('foo' * 1000)
+            os.link(os.path.join(trees[0], '0'), os.path.join(trees[0], '1'))
+            for i in range(2):
+                with open(os.path.join(trees[1], str(i)), 'w') as f:
+                    f.write('foo' * 1000)
+            # Snapshots sharing unchanged files like rsync --link-dest
+            os.link(os.path.join(trees[0], '0'), os.path.join(trees[1], '2'))
+            os.link(os.path.join(trees[0], '0'), os.path.join(trees[0], '2'))
+
+            inodes = InodeTable()
+            records = list(compare_directories(*trees, inodes=inodes))
+            self.assertEqual([(record.result, record.tier)
+                              for record in records],
+                             [(_SAME, _TIER_CONTENT), (_SAME, _TIER_CONTENT),
+                              (_SAME, _TIER_INODE)])
+            self.assertEqual((inodes.hits, inodes.saved), (1, 3000))
+            self.assertEqual(inodes.get(os.stat(os.path.join(trees[0], '2')),
+                                        ['sha256']),
+                             [checksum(os.path.join(trees[1], '0'))])
+            self.assertIsNone(inodes.get(os.stat(os.path.join(trees[1], '0')),
+                                         ['sha256']))
+
+    def test_compare_files(self):
+        """Test comparing two files with the cheapest deciding check."""
+        with tempfile.TemporaryDirectory() as directory:
+            paths = {}
+            for filename, contents in [('base', 'foobar'),
+                                       ('same', 'foobar'),
+                                       ('other', 'foobaz'),
+                                       ('long', 'foobarbaz')]:
+                paths[filename] = os.path.join(directory, filename)
+                with open(paths[filename], 'w') as f:
+                    f.write(contents)
+                os.utime(paths[filename], ns=(0, 0))
+            missing = os.path.join(directory, 'missing')
+            for name in [_DEFAULT_HASH, 'md5', 'name']:
+                for value in [missing, directory]:
+                    self.assertEqual(
+                        _compare_files(paths['base'], value, name)[:2],
+                        (_MISSING, _TIER_EXISTENCE))
+            self.assertEqual(_compare_files(paths['base'], paths['long'],
+                                            'name')[:2],
+                             (_SAME, _TIER_EXISTENCE))
+            for mtime in [False, True]:
+                self.assertEqual(_compare_files(paths['base'], paths['long'],
+                                                mtime=mtime)[:2],
+                                 (_DIFFERS, _TIER_SIZE))
+            self.assertEqual(_compare_files(paths['base'], paths['same'])[:2],
+                             (_SAME, _TIER_CONTENT))
+            self.assertEqual(_compare_files(paths['base'], paths['other'])[:2],
+                             (_DIFFERS, _TIER_CONTENT))
+            self.assertEqual(_compare_files(paths['base'], paths['other'],
+                                            mtime=True)[:2],
+                             (_SAME, _TIER_MTIME))
+            os.utime(paths['other'], ns=(0, 1))
+            self.assertEqual(_compare_files(paths['base'], paths['other'],
+                                            mtime=True)[:2],
+                             (_DIFFERS, _TIER_CONTENT))
+            self.assertEqual(_compare_files(paths['base'], paths['same'],
+                                            'bytes')[:2],
+                             (_SAME, _TIER_CONTENT))
+            self.assertEqual(_compare_files(paths['base'], paths['other'],
+                                            'bytes')[:2],
+                             (_DIFFERS, _TIER_CONTENT))
+
     def test_walk_and_compare(self):
         """Test the guard clauses in walk_and_compare()."""
         for value in [None, 42.0, []]:
@@ -316,27 +2059,314 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(TypeError, walk_and_compare, '.', '.', value)
         self.assertRaises(ValueError, walk_and_compare, 'subset.py', '.')
         self.assertRaises(ValueError, walk_and_compare, '.', 'subset.py')
+        for value in [None, 42.0, []]:
+            self.assertRaises(TypeError, walk_and_compare, '.', '.',
+                              jobs=value)
+        for value in [42.0, []]:
+            self.assertRaises(TypeError, walk_and_compare, '.', '.', jobs=2,
+                              depth=value)
+        for value in range(-1, 1):
+            self.assertRaises(ValueError, walk_and_compare, '.', '.',
+                              jobs=value)
+        self.assertRaises(ValueError, walk_and_compare, '.', '.', jobs=4,
+                          depth=3)
+
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                for i in range(4):
+                    os.makedirs(os.path.join(tree, str(i)))
+                    for j in range(4):
+                        with open(os.path.join(tree, str(i), str(j)),
+                                  'w') as f:
+                            f.write(str(i * j))
+            os.remove(os.path.join(trees[1], '1', '2'))
+            with open(os.path.join(trees[1], '2', '3'), 'w') as f:
+                f.write('foo')
+            with open(os.path.join(trees[1], '3', '3'), 'w') as f:
+                f.write('X')
+
+            outputs = []
+            for jobs, depth in [(1, None), (2, None), (4, 4), (3, 16)]:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    tiers = walk_and_compare(*trees, jobs=jobs, depth=depth)
+                outputs.append(output.getvalue())
+                self.assertEqual(tiers, {_TIER_EXISTENCE: 1, _TIER_SIZE: 1,
+                                         _TIER_CONTENT: 14})
+            self.assertEqual(len(outputs[0].splitlines()), 3)
+            for output in outputs[1:]:
+                self.assertEqual(output, outputs[0])
+
+            # Compare in both directions in a single walk
+            os.makedirs(os.path.join(trees[1], '4', '5'))
+            with open(os.path.join(trees[1], '4', '5', '6'), 'w') as f:
+                f.write('baz')
+            with open(os.path.join(trees[1], '7'), 'w') as f:
+                f.write('qux')
+            expected = sorted([
+                '{0} not found!'.format(os.path.join(trees[1], '1', '2')),
+                '{0}: Files differ!'.format(os.path.join(trees[0], '2', '3')),
+                '{0}: Files differ!'.format(os.path.join(trees[0], '3', '3')),
+                '{0} not found!'.format(os.path.join(trees[0], '4', '5', '6')),
+                '{0} not found!'.format(os.path.join(trees[0], '7'))])
+            for jobs in range(1, 4):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    tiers = walk_and_compare(*trees, jobs=jobs, both=True)
+                self.assertEqual(sorted(output.getvalue().splitlines()),
+                                 expected)
+                self.assertEqual(tiers, {_TIER_EXISTENCE: 3, _TIER_SIZE: 1,
+                                         _TIER_CONTENT: 14})
+
+    def test_compare_directories(self):
+        """Test the records yielded by compare_directories()."""
+        self.assertRaises(TypeError, compare_directories, None, '.')
+        self.assertRaises(ValueError, compare_directories, '.', 'subset.py')
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                os.makedirs(tree)
+                for i in range(3):
+                    with open(os.path.join(tree, str(i)), 'w') as f:
+                        f.write(str(i))
+            os.remove(os.path.join(trees[1], '1'))
+            with open(os.path.join(trees[1], '2'), 'w') as f:
+                f.write('foo')
+
+            for jobs in range(1, 3):
+                records = list(compare_directories(*trees, jobs=jobs))
+                self.assertEqual([(os.path.basename(record.path_in_base),
+                                   record.result, record.tier)
+                                  for record in records],
+                                 [('0', _SAME, _TIER_CONTENT),
+                                  ('1', _MISSING, _TIER_EXISTENCE),
+                                  ('2', _DIFFERS, _TIER_SIZE)])
+                self.assertEqual((records[0].base_size, records[0].copy_size),
+                                 (1, 1))
+                self.assertEqual((records[2].base_size, records[2].copy_size),
+                                 (1, 3))
+                for record in records:
+                    self.assertGreaterEqual(record.seconds, 0)
+                    self.assertIsNone(record.error)
+
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                tiers = walk_and_compare(*trees, output='jsonl')
+            lines = [json.loads(line)
+                     for line in output.getvalue().splitlines()]
+            self.assertEqual([Result(**line) for line in lines],
+                             [record._replace(seconds=line['seconds'])
+                              for record, line in zip(records, lines)])
+            self.assertEqual(tiers, {_TIER_EXISTENCE: 1, _TIER_SIZE: 1,
+                                     _TIER_CONTENT: 1})
+
+            # Unreadable files are reported instead of stopping the walk
+            if os.name == 'posix' and os.geteuid() != 0:
+                os.chmod(os.path.join(trees[1], '0'), 0)
+                records = list(compare_directories(*trees))
+                self.assertEqual(records[0].result, _ERROR)
+                self.assertIsNotNone(records[0].error)
+                self.assertEqual(len(records), 3)
+                os.chmod(os.path.join(trees[1], '0'), 0o644)
+
+            # A symbolic link loop is reported and the listing goes on
+            for tree in trees:
+                os.symlink('loop', os.path.join(tree, 'loop'))
+            output = io.StringIO()
+            for both in [False, True]:
+                with contextlib.redirect_stdout(output), \
+                     contextlib.redirect_stderr(output):
+                    records = list(compare_directories(*trees, both=both))
+                self.assertEqual([(os.path.basename(record.path_in_base),
+                                   record.result) for record in records],
+                                 [('0', _SAME), ('1', _MISSING),
+                                  ('2', _DIFFERS)])
+            self.assertIn('loop', output.getvalue())
+
+            # Errors go to stderr so every line on stdout is a JSON record
+            output = io.StringIO()
+            errors = io.StringIO()
+            with contextlib.redirect_stdout(output), \
+                 contextlib.redirect_stderr(errors):
+                walk_and_compare(*trees, both=True, moves=True,
+                                 output='jsonl')
+            lines = [json.loads(line)
+                     for line in output.getvalue().splitlines()]
+            self.assertEqual(len(lines), 3)
+            self.assertIn('loop', errors.getvalue())
+
+    def test_walk_options(self):
+        """Test excluding paths and limiting the depth of the comparisons."""
+        with tempfile.TemporaryDirectory() as directory:
+            trees = [os.path.join(directory, 'base'),
+                     os.path.join(directory, 'copy')]
+            for tree in trees:
+                for relative in ['a', 'b.tmp', 'c/d', 'c/e/f', 'g/h']:
+                    path = os.path.join(tree, *relative.split('/'))
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    with open(path, 'w') as f:
+                        f.write(relative + tree)
+            database = os.path.join(directory, 'manifest.db')
+            export_manifest(trees[0], database, 'md5')
+
+            def relatives(records):
+                return [os.path.relpath(record.path_in_base, trees[0])
+                        for record in records]
+
+            expected = ['a', os.path.join('c', 'd')]
+            for both in [False, True]:
+                records = list(compare_directories(
+                    *trees, both=both, excludes=['*.tmp', 'g'],
+                    max_depth=1))
+                self.assertEqual(relatives(records), expected)
+                self.assertEqual({record.result for record in records},
+                                 {_DIFFERS})
+                records = list(compare_to_manifest(
+                    database, trees[1], both=both, excludes=['*.tmp', 'g'],
+                    max_depth=1))
+                self.assertEqual(relatives(records), expected)
+
+            # Patterns with a / match the path relative to the root
+            records = list(compare_directories(*trees, both=True,
+                                               excludes=['c/e']))
+            self.assertEqual(relatives(records),
+                             ['a', 'b.tmp', os.path.join('c', 'd'),
+                              os.path.join('g', 'h')])
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-a', '--algorithm', default=_DEFAULT_HASH,
                         help='string name of the hash algorithm to use')
+    parser.add_argument('-b', '--both', action='store_true',
+                        help='also find the files in copy missing from base '
+                        'in the same walk')
+    parser.add_argument('-c', '--compare', choices=['hash', 'bytes'],
+                        default='hash',
+                        help='compare contents by hash or by reading both '
+                        'files in lockstep')
     parser.add_argument('-f', '--filename', action='store_true',
                         help='only compare the filenames')
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        help='glob pattern of the names or relative paths to '
+                        'skip, repeat for several')
+    parser.add_argument('-e', '--export', default='',
+                        help='save a manifest of base to the database at path '
+                        'instead of comparing')
+    parser.add_argument('--format', choices=['text', 'jsonl'],
+                        default='text',
+                        help='print a JSON object per file instead of text')
+    parser.add_argument('-j', '--jobs', type=int, default=_DEFAULT_JOBS,
+                        help='number of files to compare concurrently')
+    parser.add_argument('--max-depth', type=int, default=None,
+                        help='number of levels of subdirectories to descend '
+                        'into')
+    parser.add_argument('-M', '--manifest', default='',
+                        help='compare copy, the only directory given, against '
+                        'the manifest at path instead of base')
+    parser.add_argument('-k', '--quick', type=int, default=0,
+                        metavar='SAMPLES',
+                        help='only compare the first, last and SAMPLES evenly '
+                        'spaced blocks of large files')
+    parser.add_argument('--one-file-system', action='store_true',
+                        help='do not descend into other file systems')
+    parser.add_argument('-r', '--moves', action='store_true',
+                        help='look for missing files moved or renamed '
+                        'elsewhere in copy')
+    parser.add_argument('--move-index', default='',
+                        help='path to keep the index of moves in instead of '
+                        'a temporary file')
+    parser.add_argument('-q', '--queue-depth', type=int, default=None,
+                        help='maximum number of files queued for the jobs '
+                        '(default: 2 * jobs)')
+    parser.add_argument('-m', '--mtime', action='store_true',
+                        help='trust equal sizes and modification times '
+                        'instead of comparing the contents')
+    parser.add_argument('-s', '--stats', action='store_true',
+                        help='print how many files each check decided')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='verbose output')
+    parser.add_argument('--cache', default='',
+                        help='path to a database of digests to reuse for '
+                        'unchanged files')
+    parser.add_argument('--cache-size', type=int, default=_CACHE_SIZE,
+                        help='maximum number of digests to keep in the cache')
     parser.add_argument('base', nargs='?', default='',
                         help='directory to walk')
     parser.add_argument('copy', nargs='?', default='',
                         help='directory to match against base')
     args = parser.parse_args()
+    if (args.max_depth is not None) and (args.max_depth < 0):
+        parser.error('--max-depth must be a non-negative int')
+    if args.jobs < 1:
+        parser.error('--jobs must be a positive int')
+    if (args.queue_depth is not None) and (args.queue_depth < args.jobs):
+        parser.error('--queue-depth must be at least --jobs')
+    if args.quick < 0:
+        parser.error('--quick must be a non-negative int')
+    if (args.quick > 0) and (len(args.manifest) > 0):
+        # A manifest only has the digests of whole files to compare against
+        parser.error('--quick samples base, so not with --manifest')
 
-    if os.path.isdir(args.base) and os.path.isdir(args.copy):
+    if os.path.isdir(args.base) and ((len(args.export) > 0) or
+                                     (len(args.manifest) > 0) or
+                                     os.path.isdir(args.copy)):
         name = args.algorithm
+        if args.compare == 'bytes':
+            name = 'bytes'
         if args.filename:
             name = 'name'
-        walk_and_compare(args.base, args.copy, name, verbose=args.verbose)
+        cache = None
+        if len(args.cache) > 0:
+            cache = DigestCache(args.cache, args.cache_size)
+        inodes = InodeTable()
+
+        if len(args.export) > 0:
+            count = export_manifest(args.base, args.export, name, cache,
+                                    args.jobs, args.queue_depth, inodes,
+                                    args.exclude, args.max_depth,
+                                    args.one_file_system)
+            if args.verbose:
+                print('Saved {0} files to {1}'.format(count, args.export))
+        else:
+            if len(args.manifest) > 0:
+                # The only directory given is the copy
+                tiers = compare_manifest(args.manifest, args.base,
+                                         args.verbose, cache, args.mtime,
+                                         args.jobs, args.queue_depth,
+                                         args.both, args.moves,
+                                         args.move_index, args.format,
+                                         inodes, args.exclude, args.max_depth,
+                                         args.one_file_system)
+            else:
+                tiers = walk_and_compare(args.base, args.copy, name,
+                                         verbose=args.verbose, cache=cache,
+                                         mtime=args.mtime, jobs=args.jobs,
+                                         depth=args.queue_depth,
+                                         both=args.both, moves=args.moves,
+                                         move_index=args.move_index,
+                                         samples=args.quick,
+                                         output=args.format, inodes=inodes,
+                                         excludes=args.exclude,
+                                         max_depth=args.max_depth,
+                                         one_filesystem=args.one_file_system)
+            if args.stats:
+                # Keep the records on stdout parseable
+                stream = sys.stderr if args.format == 'jsonl' else sys.stdout
+                for tier in _TIERS:
+                    print('Decided by {0}: {1}'.format(tier, tiers[tier]),
+                          file=stream)
+
+        if cache is not None:
+            cache.close()
+            print('Cache hits: {0} misses: {1}'.format(
+                cache.hits, cache.misses), file=sys.stderr)
+        if inodes.hits > 0:
+            print('Hard links: {0} files not read, {1} bytes saved'.format(
+                inodes.hits, inodes.saved), file=sys.stderr)
     else:
         import doctest
         tests = [doctest.DocTestSuite(),
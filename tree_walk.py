@@ -0,0 +1,260 @@
+"""Walk directory trees with os.scandir().
+
+The walker behind walk.py, chmod_walk.py and subset.py. Entries are
+os.DirEntry objects so their types come from the listing, subtrees can be
+pruned by glob patterns, depth or file system, and directories can be listed
+ahead of the walk by a pool of threads.
+"""
+
+import concurrent.futures
+import fnmatch
+import os
+import os.path
+import re
+import tempfile
+import unittest
+
+def compile_excludes(excludes):
+    """Return a regular expression matching any glob in excludes or None.
+
+    Args:
+        excludes: Iterable of string glob patterns.
+    Returns:
+        Compiled regular expression matching all the patterns at once or
+        None if there are none.
+    """
+    patterns = [fnmatch.translate(pattern) for pattern in excludes]
+    if len(patterns) <= 0:
+        return None
+    return re.compile('|'.join(patterns))
+
+def is_excluded(excluded, relative):
+    """Return whether an entry is excluded by its name or relative path.
+
+    Args:
+        excluded: Compiled regular expression from compile_excludes() or
+            None.
+        relative: String path of the entry relative to the root of a walk
+            with / as the separator.
+    Returns:
+        Boolean whether the name or the relative path matches excluded.
+    """
+    if excluded is None:
+        return False
+    return bool(excluded.match(relative.rpartition('/')[2]) or
+                excluded.match(relative))
+
+def excluded_path(excluded, relative):
+    """Return whether relative or any directory above it is excluded.
+
+    Args:
+        excluded: Compiled regular expression from compile_excludes() or
+            None.
+        relative: String path relative to the root of a walk with / as the
+            separator.
+    Returns:
+        Boolean whether walk_tree() would skip the path.
+    """
+    if excluded is None:
+        return False
+    parts = relative.split('/')
+    return any(is_excluded(excluded, '/'.join(parts[:i + 1]))
+               for i in range(len(parts)))
+
+def scan_directory(path):
+    """Return a tuple of the os.DirEntry list of path and OSError or None."""
+    try:
+        with os.scandir(path) as iterator:
+            return list(iterator), None
+    except OSError as error:
+        return None, error
+
+def walk_tree(path, excludes=(), max_depth=None, one_filesystem=False,
+               follow_symlinks=False, jobs=1, onerror=None):
+    """Yield a tuple for each directory in the tree at path, top-down.
+
+    Like os.walk(), but the subdirectories and files are the os.DirEntry
+    objects os.scandir() returns. Their types come from the directory listing
+    and each one caches its stat() result, so no other system call is needed
+    to tell files from directories. Removing entries from the list of
+    subdirectories prunes them from the walk.
+
+    Args:
+        path: String path to the directory to walk.
+        excludes: Optional iterable of string glob patterns. Entries whose
+            name or path relative to path with / as the separator matches
+            one are skipped along with everything below them. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to not
+            descend into directories on other file systems. Defaults to
+            False.
+        follow_symlinks: Optional boolean flag indicating whether to descend
+            into symbolic links to directories. Each directory is visited once
+            so cycles end. Defaults to False to leave them out.
+        jobs: Optional positive int number of directories to list
+            concurrently ahead of the walk, with at most 2 * jobs listed
+            ahead at a time. Defaults to 1.
+        onerror: Optional callable taking the OSError of a directory that
+            cannot be listed. Defaults to None to ignore them.
+    Yields:
+        Tuple of string path to a directory, list of os.DirEntry of its
+        subdirectories and list of os.DirEntry of its other entries.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a string path to a directory.')
+    if (max_depth is not None) and (not isinstance(max_depth, int)):
+        raise TypeError('max_depth must be a non-negative int.')
+    if (max_depth is not None) and (max_depth < 0):
+        raise ValueError('max_depth must be a non-negative int.')
+    if not isinstance(jobs, int):
+        raise TypeError('jobs must be a positive int.')
+    if jobs <= 0:
+        raise ValueError('jobs must be a positive int.')
+
+    excluded = compile_excludes(excludes)
+    device = None
+    if one_filesystem:
+        device = os.stat(path).st_dev
+    visited = set()
+    if follow_symlinks:
+        status = os.stat(path)
+        visited.add((status.st_dev, status.st_ino))
+
+    executor = None
+    if jobs > 1:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        # At most 2 * jobs listings are in flight
+        in_flight = 0
+        stack = [[path, '', 0, None]]
+        while len(stack) > 0:
+            directory, relative, depth, future = stack.pop()
+            if executor is not None:
+                # List the directories next in line ahead of the walk
+                for item in reversed(stack):
+                    if in_flight >= 2 * jobs:
+                        break
+                    if item[3] is None:
+                        item[3] = executor.submit(scan_directory, item[0])
+                        in_flight += 1
+            if future is None:
+                entries, error = scan_directory(directory)
+            else:
+                in_flight -= 1
+                entries, error = future.result()
+            if error is not None:
+                if onerror is not None:
+                    onerror(error)
+                continue
+
+            prefix = relative + '/' if len(relative) > 0 else ''
+            dirs = []
+            nondirs = []
+            for entry in entries:
+                if is_excluded(excluded, prefix + entry.name):
+                    continue
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    nondirs.append(entry)
+                elif follow_symlinks or not entry.is_symlink():
+                    dirs.append(entry)
+            yield directory, dirs, nondirs
+
+            if (max_depth is not None) and (depth >= max_depth):
+                continue
+            # Reverse so the stack pops the subdirectories in listing order
+            for entry in reversed(dirs):
+                if one_filesystem or follow_symlinks:
+                    try:
+                        status = entry.stat()
+                    except OSError as error:
+                        if onerror is not None:
+                            onerror(error)
+                        continue
+                    if one_filesystem and (status.st_dev != device):
+                        continue
+                    if follow_symlinks:
+                        key = (status.st_dev, status.st_ino)
+                        if key in visited:
+                            continue
+                        visited.add(key)
+                stack.append([entry.path, prefix + entry.name, depth + 1,
+                              None])
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+class _UnitTest(unittest.TestCase):
+    def test_excluded_path(self):
+        """Test matching glob patterns against relative paths."""
+        self.assertIsNone(compile_excludes([]))
+        self.assertFalse(is_excluded(None, 'a'))
+        excluded = compile_excludes(['*.tmp', 'a/b'])
+        for relative, expected in [('x.tmp', True), ('a/x.tmp', True),
+                                   ('a', False), ('a/b', True),
+                                   ('c/a/b', False), ('b', False)]:
+            self.assertEqual(is_excluded(excluded, relative), expected)
+        for relative, expected in [('a/b/c', True), ('d.tmp/e', True),
+                                   ('a/c', False), ('c/a/b', False)]:
+            self.assertEqual(excluded_path(excluded, relative), expected)
+
+    def testwalk_tree(self):
+        """Test walking a tree with os.scandir()."""
+        for value in [None, 42, []]:
+            self.assertRaises(TypeError, list, walk_tree(value))
+        for value in [42.0, '1']:
+            self.assertRaises(TypeError, list,
+                              walk_tree('.', max_depth=value))
+            self.assertRaises(TypeError, list, walk_tree('.', jobs=value))
+        self.assertRaises(ValueError, list, walk_tree('.', max_depth=-1))
+        self.assertRaises(ValueError, list, walk_tree('.', jobs=0))
+
+        with tempfile.TemporaryDirectory() as directory:
+            for parts in [('a', 'b', 'c'), ('a', 'd'), ('e',)]:
+                os.makedirs(os.path.join(directory, *parts))
+                with open(os.path.join(directory, *parts, 'f.txt'), 'w') as f:
+                    f.write('foo')
+            os.symlink(os.path.join(directory, 'a'),
+                       os.path.join(directory, 'e', 'link'))
+
+            def walk(**kwargs):
+                result = {}
+                for parent, dirs, files in walk_tree(directory, **kwargs):
+                    relative = os.path.relpath(parent, directory)
+                    result[relative] = (sorted(entry.name for entry in dirs),
+                                        sorted(entry.name for entry in files))
+                return result
+
+            expected = {
+                '.': (['a', 'e'], []),
+                'a': (['b', 'd'], []),
+                os.path.join('a', 'b'): (['c'], []),
+                os.path.join('a', 'b', 'c'): ([], ['f.txt']),
+                os.path.join('a', 'd'): ([], ['f.txt']),
+                'e': ([], ['f.txt'])}
+            for jobs in range(1, 4):
+                self.assertEqual(walk(jobs=jobs), expected)
+            self.assertEqual(walk(max_depth=1),
+                             {key: value for key, value in expected.items()
+                              if key in ['.', 'a', 'e']})
+            self.assertEqual(walk(excludes=['b', 'e']),
+                             {'.': (['a'], []), 'a': (['d'], []),
+                              os.path.join('a', 'd'): ([], ['f.txt'])})
+            self.assertEqual(walk(excludes=['a/*']),
+                             {'.': (['a', 'e'], []), 'a': ([], []),
+                              'e': ([], ['f.txt'])})
+            self.assertEqual(walk(one_filesystem=True), expected)
+
+            # The link is followed but a itself is only visited once
+            result = walk(follow_symlinks=True)
+            self.assertEqual(result['e'], (['link'], ['f.txt']))
+            self.assertEqual(len(result), len(expected))
+
+if __name__ == '__main__':
+    suite = unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)
+    unittest.TextTestRunner(verbosity=2).run(suite)
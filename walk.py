@@ -1,8 +1,74 @@
 """Walk a directory for files with the specified extensions."""
 
+import array
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import ctypes
+import errno
+import functools
+import io
+import itertools
+import operator
 import os
 import os.path
+import re
+import select
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import zlib
+
+import tree_walk
+
+_DEFAULT_JOBS = 1
+"""Positive integer number of files to search concurrently."""
+
+_SIZE = 64 * 1024
+"""Positive integer number of bytes to read from a file at a time."""
+
+_POSTINGS = 4 * 1024 * 1024
+"""Positive integer number of postings to buffer before writing a chunk."""
+
+_OVERLAP = 4 * 1024
+"""Positive integer number of bytes of a block searched again with the next."""
+
+_MAX_CHUNKS = 16
+"""Positive integer number of chunks of postings before compacting them."""
+
+_INDEX_FORMAT = 1
+"""Positive integer version of the layout of the trigram index database."""
+
+_PROBE_RATIO = 64
+"""Positive integer ratio of a posting list to candidates to bisect it."""
+
+_GLOBAL_FLAGS = re.compile(rb'\(\?([aiLmsux]+)\)')
+"""Compiled regular expression of a group of global inline flags."""
+
+# inotify event bits from <sys/inotify.h>
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+
+_WATCH_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+               _IN_ONLYDIR)
+"""Integer mask of the inotify events to watch directories for."""
+
+_MOVE_WAIT = 0.1
+"""Positive number of seconds to wait for where a directory was moved to."""
+
+_EVENT = struct.Struct('iIII')
+"""Struct of the header of an inotify event before its name."""
 
 def _clean_extensions(extensions):
     """Remove whitespace and prepend a period to extensions."""
@@ -17,41 +83,886 @@ def _clean_extensions(extensions):
             result.append('.' + cleaned)
     return result
 
-def _has_query(path, query):
-    """Return True if the file at path contains query."""
+def _has_query(path, query, size=_SIZE):
+    """Return True if the file at path contains query.
+
+    The bytes of the file are searched a block at a time without decoding
+    them, so memory does not grow with the size of the file and files in any
+    encoding can be searched. The last len(query) - 1 bytes of each block are
+    kept in front of the next one to find matches across blocks. Files with
+    a NUL byte in their first block are binary and never match.
+
+    Args:
+        path: String path to a file.
+        query: String query encoded as UTF-8 or bytes query to look for.
+        size: Optional positive int number of bytes to read at a time.
+            Defaults to _SIZE.
+    Returns:
+        Boolean whether the file contains query.
+    """
     if not isinstance(path, str):
         raise TypeError('path must be a valid string path to a file.')
     if not os.path.isfile(path):
         raise ValueError('path must be a valid string path to a file.')
+    if isinstance(query, str):
+        query = query.encode('utf-8')
+    if not isinstance(query, bytes):
+        raise TypeError('query must be a string or bytes.')
+    if not isinstance(size, int):
+        raise TypeError('size must be a positive int.')
+    if size <= 0:
+        raise ValueError('size must be a positive int.')
 
-    with open(path, 'r', encoding='utf-8') as f:
-        source = f.read()
-    return query in source
+    overlap = max(len(query) - 1, 0)
+    buffer = bytearray(overlap + size)
+    view = memoryview(buffer)
+    kept = 0
+    first = True
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            count = f.readinto(view[kept:])
+            if not count:
+                return False
+            end = kept + count
+            if first and (buffer.find(b'\0', 0, end) >= 0):
+                return False
+            first = False
+            if buffer.find(query, 0, end) >= 0:
+                return True
+            # Move the bytes a match could start in to the front
+            kept = min(overlap, end)
+            buffer[:kept] = buffer[end - kept:end]
+
+def _compile_patterns(queries=(), regexes=()):
+    """Return a list of bytes regular expression sources for the patterns.
+
+    Args:
+        queries: Optional iterable of string literal queries. Defaults to ().
+        regexes: Optional iterable of string regular expressions.
+            Defaults to ().
+    Returns:
+        List of bytes regular expression sources, the escaped queries
+        followed by the regexes, all encoded as UTF-8. Global inline flags
+        at the start of a regex, like (?i), are turned into a group scoped
+        to it so the sources can be combined.
+    """
+    sources = [re.escape(query.encode('utf-8')) for query in queries]
+    for regex in regexes:
+        source = regex.encode('utf-8')
+        # Raise re.error now instead of in the middle of the walk
+        re.compile(source)
+        flags = b''
+        match = _GLOBAL_FLAGS.match(source)
+        while match is not None:
+            flags += match.group(1)
+            source = source[match.end():]
+            match = _GLOBAL_FLAGS.match(source)
+        if len(flags) > 0:
+            # A comment in verbose mode must not hide the closing paren
+            newline = b'\n' if b'x' in flags else b''
+            source = b'(?' + flags + b':' + source + newline + b')'
+        sources.append(source)
+    _combine(tuple(sources))
+    return sources
+
+@functools.lru_cache(maxsize=1024)
+def _combine(sources):
+    """Return a compiled regular expression matching any of sources."""
+    return re.compile(b'|'.join(b'(?:' + source + b')' for source in sources))
+
+def _matching_patterns(path, sources, size=_SIZE):
+    """Return a list of the indices of the patterns found in the file at path.
+
+    All the patterns are combined into one regular expression so the file is
+    scanned once. Each time it matches, the patterns found at that position
+    are removed and the scan resumes there with the rest, so every pattern is
+    reported once and the scan stops as soon as all are found. Like
+    _has_query(), the file is read a block at a time so memory does not grow
+    with its size, and files with a NUL byte in their first block are binary
+    and match nothing. The last _OVERLAP bytes of each block are searched
+    again with the next one. A match ending in the last line of a block, or
+    in its last _OVERLAP bytes if that line is longer, waits for the next
+    block, so anchors and lookaheads see the bytes after it. Matches across
+    more than _OVERLAP bytes at the end of a block can be missed. Numbered
+    backreferences in the patterns are not supported because they are
+    renumbered when combined.
+
+    Args:
+        path: String path to a file.
+        sources: Sequence of bytes regular expression sources from
+            _compile_patterns().
+        size: Optional positive int number of bytes to read at a time.
+            Defaults to _SIZE.
+    Returns:
+        Sorted list of int indices in sources of the patterns found.
+    """
+    if not isinstance(path, str):
+        raise TypeError('path must be a valid string path to a file.')
+    if not os.path.isfile(path):
+        raise ValueError('path must be a valid string path to a file.')
+
+    remaining = list(range(len(sources)))
+    found = []
+    data = b''
+    first = True
+    with open(path, 'rb', buffering=0) as f:
+        while len(remaining) > 0:
+            block = f.read(size)
+            if first and (b'\0' in block):
+                return []
+            first = False
+            data = data[-_OVERLAP:] + block
+            # Matches ending after end are left for the next block
+            kept = max(len(data) - _OVERLAP, 0)
+            end = len(data)
+            # A short read is the end of a regular file
+            last = len(block) < size
+            if not last:
+                end = max(data.rfind(b'\n', 0, len(data) - 1) + 1, kept)
+            position = 0
+            while len(remaining) > 0:
+                match = _combine(tuple(sources[i] for i in remaining)).search(
+                    data, position)
+                if (match is None) or ((match.end() > end) and
+                                       (match.start() >= kept)):
+                    break
+                position = match.start()
+                matched = [i for i in remaining
+                           if re.compile(sources[i]).match(data, position)]
+                if len(matched) <= 0:
+                    # Only the combined expression matches here
+                    position += 1
+                    continue
+                found.extend(matched)
+                remaining = [i for i in remaining if i not in matched]
+            if last:
+                break
+    return sorted(found)
 
 def _print_error(error):
-    """Print the OSError generated by os.walk()."""
-    print(error)
+    """Print an error of the walk to stderr, keeping stdout for results."""
+    print(error, file=sys.stderr)
+
+def _ordered_map(function, items, jobs=_DEFAULT_JOBS):
+    """Yield a tuple of item and function(item) for each item in items.
+
+    The tuples are yielded in the same order as items. With more than one job,
+    function is called by a pool of threads. At most 2 * jobs items are in
+    flight at a time so items can be a lazy iterable of any length. Items not
+    started yet are cancelled if the generator is closed early.
+
+    Args:
+        function: Callable taking one item.
+        items: Iterable of items to pass to function.
+        jobs: Optional positive int number of items to process concurrently.
+            Defaults to _DEFAULT_JOBS.
+    Yields:
+        Tuple of item and the return value of function(item).
+    """
+    if not isinstance(jobs, int):
+        raise TypeError('jobs must be a positive int.')
+    if jobs <= 0:
+        raise ValueError('jobs must be a positive int.')
+
+    if jobs == 1:
+        for item in items:
+            yield item, function(item)
+        return
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = collections.deque()
+        try:
+            for item in items:
+                pending.append((item, executor.submit(function, item)))
+                if len(pending) >= 2 * jobs:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while len(pending) > 0:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            for item, future in pending:
+                future.cancel()
+
+def _open_index(database):
+    """Return an sqlite3.Connection to the trigram index at database.
+
+    The files table has the path of each indexed file relative to the walked
+    directory with / as the separator, as bytes so names that are not valid
+    UTF-8 are kept, and the size and modification time it had when it was
+    read. Files that could not be read have no modification time, so they
+    are read again by the next update and are candidates of every query
+    meanwhile. Files get a new id whenever they are read again. The postings
+    table has, for each trigram, chunks of the sorted ids of the files
+    containing it, each written by one update. Ids of files that were removed
+    or read again stay in the chunks until _compact_index(). An index written
+    in another format than _INDEX_FORMAT is emptied and built again.
+    """
+    connection = sqlite3.connect(database)
+    # Let _update_index() give the pages compaction frees back
+    connection.execute('PRAGMA auto_vacuum=INCREMENTAL')
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('CREATE TABLE IF NOT EXISTS meta '
+                       '(key TEXT PRIMARY KEY, value INTEGER)')
+    if connection.execute("SELECT value FROM meta WHERE key = 'format'"
+                          ).fetchone() != (_INDEX_FORMAT,):
+        with connection:
+            for table in ['files', 'postings', 'meta']:
+                connection.execute('DROP TABLE IF EXISTS {0}'.format(table))
+            connection.execute('CREATE TABLE meta '
+                               '(key TEXT PRIMARY KEY, value INTEGER)')
+            connection.execute("INSERT INTO meta VALUES ('format', ?)",
+                               (_INDEX_FORMAT,))
+        # Rewrite the file so the auto_vacuum setting takes effect
+        connection.execute('VACUUM')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY '
+        'AUTOINCREMENT, path BLOB UNIQUE, size INTEGER, mtime INTEGER, '
+        'seen INTEGER)')
+    # A rowid table keeps more of each list on its own page than WITHOUT
+    # ROWID, which spills anything past a quarter page into overflow pages
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS postings (trigram INTEGER, chunk INTEGER, '
+        'ids BLOB, PRIMARY KEY (trigram, chunk))')
+    connection.executemany('INSERT OR IGNORE INTO meta VALUES (?, 0)',
+                           [('chunks',), ('dead',)])
+    return connection
+
+def _encode_ids(ids):
+    """Return bytes of the sorted int ids packed and compressed.
+
+    The gaps between consecutive ids are packed instead of the ids. They are
+    small and repeat, so they compress to less than half the size.
+    """
+    gaps = array.array('I', map(operator.sub, ids, itertools.chain([0], ids)))
+    return zlib.compress(gaps.tobytes(), 1)
+
+def _decode_ids(data):
+    """Return an array of the int ids in bytes from _encode_ids()."""
+    gaps = array.array('I')
+    gaps.frombytes(zlib.decompress(data))
+    return array.array('I', itertools.accumulate(gaps))
+
+def _has_id(ids, id_):
+    """Return whether the sorted array of int ids contains the int id_."""
+    i = bisect.bisect_left(ids, id_)
+    return (i < len(ids)) and (ids[i] == id_)
+
+def _pack_trigrams(data):
+    """Return the set of int trigrams of three consecutive bytes in data.
+
+    Each trigram is packed into an int as a big-endian number. Instead of a
+    Python loop over every byte, data is read as big-endian 32-bit words from
+    offsets 0 and 2, and each word holds the trigrams at its first and second
+    byte. Those are unpacked with map() over the whole array at C speed.
+
+    Args:
+        data: Bytes to take the trigrams of.
+    Returns:
+        Set of int trigrams.
+    """
+    # The words do not reach the trigrams in the last few bytes
+    tail = data[-6:]
+    trigrams = {(a << 16) | (b << 8) | c
+                for a, b, c in zip(tail, tail[1:], tail[2:])}
+    for offset in [0, 2]:
+        count = (len(data) - offset) // 4
+        if count <= 0:
+            continue
+        words = array.array('I', data[offset:offset + 4 * count])
+        if sys.byteorder == 'little':
+            words.byteswap()
+        trigrams.update(map(operator.rshift, words, itertools.repeat(8)))
+        trigrams.update(map(operator.and_, words,
+                            itertools.repeat(0xFFFFFF)))
+    return trigrams
+
+def _trigrams(path, size=_SIZE):
+    """Return the set of int trigrams in the file at path or None.
+
+    Args:
+        path: String path to a file.
+        size: Optional positive int number of bytes to read at a time.
+            Defaults to _SIZE.
+    Returns:
+        Set of int trigrams of three consecutive bytes of the file, or None
+        if the file is binary like _has_query() decides.
+    """
+    trigrams = set()
+    tail = b''
+    first = True
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(size)
+            if not block:
+                return trigrams
+            if first and (b'\0' in block):
+                return None
+            first = False
+            # Keep the last two bytes for the trigrams across blocks
+            data = tail + block
+            trigrams.update(_pack_trigrams(data))
+            tail = data[-2:]
+
+def _write_postings(connection, postings):
+    """Write postings as a new chunk of each of its trigrams and clear it.
+
+    Args:
+        connection: sqlite3.Connection from _open_index().
+        postings: Dictionary of int trigram to array of sorted int ids.
+    """
+    chunk = connection.execute(
+        "SELECT value FROM meta WHERE key = 'chunks'").fetchone()[0]
+    connection.executemany(
+        'INSERT INTO postings VALUES (?, ?, ?)',
+        ((trigram, chunk, _encode_ids(ids))
+         for trigram, ids in postings.items()))
+    connection.execute(
+        "UPDATE meta SET value = value + 1 WHERE key = 'chunks'")
+    postings.clear()
+
+def _compact_index(connection):
+    """Merge the chunks of each trigram and drop the ids of dead files."""
+    live = set(row[0] for row in connection.execute('SELECT id FROM files'))
+    connection.execute('DROP TABLE IF EXISTS compacted')
+    connection.execute(
+        'CREATE TABLE compacted (trigram INTEGER PRIMARY KEY, ids BLOB)')
+
+    def merged():
+        # Ids only grow, so a later chunk only has ids above an earlier one
+        # and the chunks of a trigram are concatenated in order
+        for trigram, rows in itertools.groupby(connection.execute(
+                'SELECT trigram, ids FROM postings ORDER BY trigram, chunk'),
+                                               operator.itemgetter(0)):
+            ids = array.array('I', filter(live.__contains__, (
+                itertools.chain.from_iterable(
+                    _decode_ids(row[1]) for row in rows))))
+            if len(ids) > 0:
+                yield trigram, _encode_ids(ids)
+
+    connection.executemany('INSERT INTO compacted VALUES (?, ?)', merged())
+    connection.execute('DELETE FROM postings')
+    connection.execute(
+        'INSERT INTO postings SELECT trigram, 0, ids FROM compacted')
+    connection.execute('DROP TABLE compacted')
+    connection.execute("UPDATE meta SET value = 1 WHERE key = 'chunks'")
+    connection.execute("UPDATE meta SET value = 0 WHERE key = 'dead'")
+
+def _update_index(connection, path, files, jobs=_DEFAULT_JOBS):
+    """Bring the trigram index up to date with the files below path.
+
+    Only the files that are new or whose size or modification time changed
+    since they were indexed are read. Files that were not found this time are
+    removed from the index. Postings are buffered in memory and written in
+    chunks of at most _POSTINGS postings. Once there are more than
+    _MAX_CHUNKS chunks or more dead ids than files, the index is compacted
+    and the pages that frees are given back to the file system.
 
-def _walk(path, accepted=('.html',), query=''):
+    Args:
+        connection: sqlite3.Connection from _open_index().
+        path: String path to the walked directory.
+        files: Iterable of os.DirEntry of the files to index.
+        jobs: Optional positive int number of files to read concurrently.
+            Defaults to _DEFAULT_JOBS.
+    Returns:
+        Tuple of int number of files read and int number of files removed.
+    """
+    generation = time.time_ns()
+
+    def changed():
+        for entry in files:
+            relative = os.fsencode(
+                os.path.relpath(entry.path, path).replace(os.sep, '/'))
+            try:
+                status = entry.stat()
+            except OSError as error:
+                _print_error(error)
+                continue
+            row = connection.execute(
+                'SELECT id, size, mtime FROM files WHERE path = ?',
+                (relative,)).fetchone()
+            if (row is not None) and (row[1:] == (status.st_size,
+                                                  status.st_mtime_ns)):
+                connection.execute('UPDATE files SET seen = ? WHERE id = ?',
+                                   (generation, row[0]))
+                continue
+            yield entry.path, relative, status
+
+    def read(item):
+        try:
+            return _trigrams(item[0])
+        except OSError as error:
+            return error
+
+    count = 0
+    postings = collections.defaultdict(functools.partial(array.array, 'I'))
+    buffered = 0
+    with connection:
+        for (file_path, relative, status), trigrams in _ordered_map(
+                read, changed(), jobs):
+            mtime = status.st_mtime_ns
+            if isinstance(trigrams, OSError):
+                _print_error(trigrams)
+                mtime = trigrams = None
+            dead = connection.execute('DELETE FROM files WHERE path = ?',
+                                      (relative,)).rowcount
+            cursor = connection.execute(
+                'INSERT INTO files (path, size, mtime, seen) '
+                'VALUES (?, ?, ?, ?)',
+                (relative, status.st_size, mtime, generation))
+            connection.execute(
+                "UPDATE meta SET value = value + ? WHERE key = 'dead'",
+                (dead,))
+            count += 1
+            if trigrams is None:
+                continue
+            # Append the id to the posting of each trigram at C speed
+            collections.deque(map(array.array.append,
+                                  map(postings.__getitem__, trigrams),
+                                  itertools.repeat(cursor.lastrowid)),
+                              maxlen=0)
+            buffered += len(trigrams)
+            if buffered >= _POSTINGS:
+                _write_postings(connection, postings)
+                buffered = 0
+        if len(postings) > 0:
+            _write_postings(connection, postings)
+
+        removed = connection.execute('DELETE FROM files WHERE seen != ?',
+                                     (generation,)).rowcount
+        connection.execute(
+            "UPDATE meta SET value = value + ? WHERE key = 'dead'", (removed,))
+        chunks, dead = [connection.execute(
+            'SELECT value FROM meta WHERE key = ?', (key,)).fetchone()[0]
+                        for key in ['chunks', 'dead']]
+        live = connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+        compact = (chunks > _MAX_CHUNKS) or (dead > live)
+        if compact:
+            _compact_index(connection)
+    if compact:
+        # execute() only frees one page per call while a script runs it out
+        connection.executescript('PRAGMA incremental_vacuum;')
+    return count, removed
+
+def _index_candidates(connection, queries=(), regexes=()):
+    """Return a sorted list of the indexed files that may contain a pattern.
+
+    A file can only contain a query if it has every trigram of the query, so
+    the posting lists of those trigrams are intersected, shortest first. The
+    shortest list is read into a set. Each longer list is streamed through
+    it, or once the candidates are few, searched for each of them by
+    bisection, so no set of every file with a common trigram is built. The
+    candidates of several queries are united. Regexes and queries shorter
+    than three bytes have no trigrams to look up and make every file a
+    candidate, and so does a file that could not be read when it was indexed.
+
+    Args:
+        connection: sqlite3.Connection from _open_index().
+        queries: Optional iterable of string literal queries. Defaults to ().
+        regexes: Optional iterable of string regular expressions.
+            Defaults to ().
+    Returns:
+        Sorted list of string paths relative to the walked directory with /
+        as the separator.
+    """
+    queries = [query.encode('utf-8') for query in queries]
+    if ((len(regexes) > 0) or (len(queries) <= 0) or
+        any(len(query) < 3 for query in queries)):
+        return [os.fsdecode(row[0]) for row in
+                connection.execute('SELECT path FROM files ORDER BY path')]
+
+    candidates = set(row[0] for row in connection.execute(
+        'SELECT id FROM files WHERE mtime IS NULL'))
+    for query in queries:
+        # Start from the shortest posting list and only probe the others
+        sizes = {trigram: connection.execute(
+                     'SELECT SUM(LENGTH(ids)) FROM postings WHERE trigram = ?',
+                     (trigram,)).fetchone()[0]
+                 for trigram in _pack_trigrams(query)}
+        if None in sizes.values():
+            # No file has one of the trigrams
+            continue
+        ids = None
+        for trigram in sorted(sizes, key=sizes.get):
+            chunks = [_decode_ids(row[0]) for row in connection.execute(
+                'SELECT ids FROM postings WHERE trigram = ?', (trigram,))]
+            if ids is None:
+                ids = set(itertools.chain.from_iterable(chunks))
+            elif len(ids) * _PROBE_RATIO < sum(map(len, chunks)):
+                ids = {id_ for id_ in ids
+                       if any(_has_id(chunk, id_) for chunk in chunks)}
+            else:
+                ids.intersection_update(itertools.chain.from_iterable(chunks))
+            if len(ids) <= 0:
+                break
+        candidates.update(ids)
+
+    # Look up the ids in batches that stay under the SQLite parameter limit
+    candidates = sorted(candidates)
+    paths = []
+    for i in range(0, len(candidates), 500):
+        batch = candidates[i:i + 500]
+        paths.extend(os.fsdecode(row[0]) for row in connection.execute(
+            'SELECT path FROM files WHERE id IN ({0})'.format(
+                ', '.join('?' * len(batch))), batch))
+    return sorted(paths)
+
+def _clean_queries(query):
+    """Return the list of the non-empty queries in a string or iterable."""
+    if isinstance(query, str):
+        query = [query]
+    return [value for value in query if len(value) > 0]
+
+def _searcher(queries, regexes):
+    """Return a function from a file path to its line to print or None.
+
+    A single query is encoded once and searched for as bytes. Several
+    queries or any regexes are compiled into one pattern, scanned for once
+    per file and printed with the ones each file contains. A file that
+    cannot be read, like a dangling symbolic link, is reported and skipped.
+    """
+    if (len(queries) == 1) and (len(regexes) <= 0):
+        # Encode the query once instead of once per file
+        encoded = queries[0].encode('utf-8')
+        search = lambda file_path: (
+            file_path if _has_query(file_path, encoded) else None)
+    else:
+        patterns = list(queries) + list(regexes)
+        sources = _compile_patterns(queries, regexes)
+
+        def search(file_path):
+            found = _matching_patterns(file_path, sources)
+            if len(found) <= 0:
+                return None
+            if len(patterns) == 1:
+                return file_path
+            return '{0}: {1}'.format(
+                file_path, ', '.join(patterns[i] for i in found))
+
+    def checked(file_path):
+        try:
+            return search(file_path)
+        except OSError as error:
+            _print_error(error)
+        except ValueError:
+            # Raised for paths that are not regular files
+            _print_error('{0}: not a readable file'.format(file_path))
+        return None
+    return checked
+
+def _walk(path, accepted=('.html',), query='', excludes=(), max_depth=None,
+          one_filesystem=False, follow_symlinks=False, list_jobs=1,
+          jobs=_DEFAULT_JOBS, regexes=(), index='', update=True):
     """Walk the directory at path and print files with extensions in accepted.
 
+    With more than one job, the files are searched for query by a pool of
+    threads while they are still printed in the order of the walk. At most
+    2 * jobs files are in flight at a time. With several queries or regexes,
+    each file is scanned once for all of them and printed with the ones it
+    contains.
+
+    With an index, only the files whose trigrams include those of a query
+    are scanned and they are printed in path order. The index is updated
+    from the walk first unless update is False, which skips the walk.
+
     Args:
         path: String path to a directory to walk.
         accepted: Iterable containing string lowercase extensions to accept.
             Defaults to ('.html',).
-        query: String query to look for in matching files.
-            Defaults to the empty string.
+        query: String query or iterable of string queries to look for in
+            matching files. Defaults to the empty string.
+        excludes: Optional iterable of string glob patterns of the entries
+            to skip. Defaults to ().
+        max_depth: Optional non-negative int number of levels of
+            subdirectories to descend into. Defaults to None for no limit.
+        one_filesystem: Optional boolean flag indicating whether to stay on
+            the file system of path. Defaults to False.
+        follow_symlinks: Optional boolean flag indicating whether to descend
+            into symbolic links to directories. Defaults to False.
+        list_jobs: Optional positive int number of directories to list
+            concurrently. Defaults to 1.
+        jobs: Optional positive int number of files to search concurrently.
+            Defaults to _DEFAULT_JOBS.
+        regexes: Optional iterable of string regular expressions to look for
+            in matching files. Defaults to ().
+        index: Optional string path to an SQLite database of a trigram
+            index of the accepted files. Defaults to the empty string to
+            read every file.
+        update: Optional boolean flag indicating whether to update the index
+            before using it. Defaults to True.
+    """
+    def entries():
+        for parent, dirs, files in tree_walk.walk_tree(
+                path, excludes, max_depth, one_filesystem, follow_symlinks,
+                list_jobs, _print_error):
+            for entry in files:
+                name, extension = os.path.splitext(entry.name)
+                # Filter for accepted extensions
+                if extension.strip().lower() in accepted:
+                    yield entry
+
+    queries = _clean_queries(query)
+    regexes = list(regexes)
+    paths = (entry.path for entry in entries())
+    if len(index) > 0:
+        connection = _open_index(index)
+        try:
+            if update:
+                _update_index(connection, path, entries(), jobs)
+            candidates = _index_candidates(connection, queries, regexes)
+        finally:
+            connection.close()
+        paths = (os.path.join(path, *relative.split('/'))
+                 for relative in candidates)
+        # Without updating, files may be gone since they were indexed
+        paths = (file_path for file_path in paths if os.path.isfile(file_path))
+
+    if len(queries) + len(regexes) <= 0:
+        for file_path in paths:
+            print(file_path)
+        return
+    for file_path, line in _ordered_map(_searcher(queries, regexes), paths,
+                                        jobs):
+        if line is not None:
+            print(line)
+
+def _inotify():
+    """Return the C library of the process with its inotify functions."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1
+    except (AttributeError, OSError, TypeError):
+        raise OSError(errno.ENOSYS, 'inotify is not available') from None
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_init1.restype = ctypes.c_int
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                       ctypes.c_uint32]
+    libc.inotify_add_watch.restype = ctypes.c_int
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    libc.inotify_rm_watch.restype = ctypes.c_int
+    return libc
+
+def _watch(path, accepted=('.html',), query='', excludes=(), max_depth=None,
+           one_filesystem=False, follow_symlinks=False, list_jobs=1,
+           jobs=_DEFAULT_JOBS, regexes=(), index='', update=True,
+           timeout=None):
+    """Walk the directory at path and then print files as they are written.
+
+    Every directory in the tree is watched with inotify before the initial
+    _walk() so no file written during it is missed. Afterwards, each file
+    with an extension in accepted that is closed after writing or moved
+    into a watched directory is searched for the queries and regexes again
+    and printed if it still matches. New directories are watched and their
+    files checked, so the cost is per change instead of per tree. Renamed
+    directories keep their watches under the new path and directories moved
+    out of the tree are no longer watched.
+
+    The arguments are those of _walk() and the optional timeout is the
+    number of seconds without events to stop after. Defaults to None to
+    watch until interrupted.
     """
-    for parent, dirnames, filenames in os.walk(path, onerror=_print_error):
-        for filename in filenames:
-            name, extension = os.path.splitext(filename)
-            # Filter for accepted extensions
-            if extension.strip().lower() in accepted:
-                path = os.path.join(parent, filename)
-                if len(query) <= 0:
-                    print(path)
-                elif _has_query(path, query):
-                    print(path)
+    libc = _inotify()
+    excluded = tree_walk.compile_excludes(excludes)
+    device = None
+    if one_filesystem:
+        device = os.stat(path).st_dev
+    queries = _clean_queries(query)
+    regexes = list(regexes)
+    search = _searcher(queries, regexes)
+
+    def check(file_path):
+        name, extension = os.path.splitext(file_path)
+        if extension.strip().lower() not in accepted:
+            return
+        if not os.path.isfile(file_path):
+            # Gone or replaced since the event
+            return
+        line = search(file_path)
+        if line is not None:
+            print(line, flush=True)
+
+    def relocate(parent):
+        # Return the relative prefix and depth of a directory in the tree
+        relative = os.path.relpath(parent, path).replace(os.sep, '/')
+        if relative == '.':
+            return '', 0
+        return relative + '/', relative.count('/') + 1
+
+    def is_watched(key, parent):
+        # Whether the directory with key is watched through another path
+        if (key not in keys) or (keys[key] not in watches):
+            return False
+        other = watches[keys[key]][0]
+        if other == parent:
+            return False
+        try:
+            status = os.stat(other)
+        except OSError:
+            # The other path is stale, like after a missed rename
+            return False
+        return (status.st_dev, status.st_ino) == key
+
+    def register(directory):
+        # Watch the tree at directory and return the paths of its files
+        prefix, depth = relocate(directory)
+        remaining = None
+        if max_depth is not None:
+            remaining = max_depth - depth
+        file_paths = []
+        for parent, dirs, files in tree_walk.walk_tree(
+                directory, (), remaining, one_filesystem, follow_symlinks,
+                list_jobs, _print_error):
+            try:
+                status = os.stat(parent)
+            except OSError as error:
+                _print_error(error)
+                dirs[:] = []
+                continue
+            key = (status.st_dev, status.st_ino)
+            if is_watched(key, parent):
+                # Already watched through another path, so a cycle
+                dirs[:] = []
+                continue
+            wd = libc.inotify_add_watch(fd, os.fsencode(parent), _WATCH_MASK)
+            if wd < 0:
+                number = ctypes.get_errno()
+                _print_error(OSError(number, os.strerror(number), parent))
+                dirs[:] = []
+                continue
+            prefix, depth = relocate(parent)
+            watches[wd] = (parent, prefix, depth, key)
+            keys[key] = wd
+            dirs[:] = [entry for entry in dirs if not tree_walk.is_excluded(
+                excluded, prefix + entry.name)]
+            file_paths.extend(entry.path for entry in files
+                              if not tree_walk.is_excluded(
+                                  excluded, prefix + entry.name))
+        return file_paths
+
+    def below(directory):
+        # Return the watch descriptors of directory and its subdirectories
+        start = directory + os.sep
+        return [wd for wd, (parent, prefix, depth, key) in watches.items()
+                if (parent == directory) or parent.startswith(start)]
+
+    def forget(wd):
+        parent, prefix, depth, key = watches.pop(wd)
+        if keys.get(key) == wd:
+            del keys[key]
+        libc.inotify_rm_watch(fd, wd)
+
+    def move(old, new):
+        # Rewrite the paths of the watches of a directory renamed in the tree
+        for wd in below(old):
+            parent, prefix, depth, key = watches[wd]
+            parent = new + parent[len(old):]
+            watches[wd] = (parent,) + relocate(parent) + (key,)
+            if (max_depth is not None) and (watches[wd][2] > max_depth):
+                forget(wd)
+
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        number = ctypes.get_errno()
+        raise OSError(number, os.strerror(number))
+    try:
+        # Map each watch descriptor to its path, relative prefix, depth and
+        # (st_dev, st_ino) key, and each key back to its watch descriptor
+        watches = {}
+        keys = {}
+        # Map the cookies of directories moved away to their old paths
+        moves = {}
+        register(path)
+        _walk(path, accepted, query, excludes, max_depth, one_filesystem,
+              follow_symlinks, list_jobs, jobs, regexes, index, update)
+        sys.stdout.flush()
+
+        while True:
+            wait = timeout
+            if len(moves) > 0:
+                # The other half of a rename follows right away if at all
+                wait = _MOVE_WAIT if timeout is None else min(timeout,
+                                                              _MOVE_WAIT)
+            if wait is not None:
+                ready, _, _ = select.select([fd], [], [], wait)
+                if (len(ready) <= 0) and (len(moves) > 0):
+                    # Moved out of the tree, so stop watching them
+                    for old in moves.values():
+                        for wd in below(old):
+                            forget(wd)
+                    moves.clear()
+                    continue
+                if len(ready) <= 0:
+                    return
+            data = os.read(fd, _SIZE)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+                offset += length
+                if mask & _IN_Q_OVERFLOW:
+                    # Events were lost, so check every file again
+                    print('inotify queue overflowed, walking again',
+                          file=sys.stderr)
+                    moves.clear()
+                    for file_path in register(path):
+                        check(file_path)
+                    continue
+                if mask & _IN_IGNORED:
+                    if wd in watches:
+                        parent, prefix, depth, key = watches.pop(wd)
+                        if keys.get(key) == wd:
+                            del keys[key]
+                    continue
+                if wd not in watches:
+                    continue
+                parent, prefix, depth, key = watches[wd]
+                file_path = os.path.join(parent, name)
+                is_dir = mask & _IN_ISDIR
+                if mask & _IN_MOVED_FROM:
+                    if is_dir:
+                        moves[cookie] = file_path
+                    continue
+                old = None
+                if is_dir and (mask & _IN_MOVED_TO):
+                    old = moves.pop(cookie, None)
+                if (old is not None) and (len(below(old)) <= 0):
+                    # Moved from where it was not watched, like a new one
+                    old = None
+                if old is not None:
+                    move(old, file_path)
+                if tree_walk.is_excluded(excluded, prefix + name):
+                    if old is not None:
+                        for moved in below(file_path):
+                            forget(moved)
+                    continue
+                if (not is_dir) and (mask & _IN_CREATE):
+                    # Only a symbolic link to a directory needs its creation
+                    if not (follow_symlinks and os.path.isdir(file_path)):
+                        continue
+                    is_dir = True
+                if not is_dir:
+                    check(file_path)
+                    continue
+                if (max_depth is not None) and (depth >= max_depth):
+                    continue
+                if (not follow_symlinks) and os.path.islink(file_path):
+                    continue
+                try:
+                    if one_filesystem and (
+                            os.stat(file_path).st_dev != device):
+                        continue
+                except OSError as error:
+                    _print_error(error)
+                    continue
+                # Files may have been written before the watch was added,
+                # while a renamed directory only gains the levels it can now
+                # reach below max_depth
+                for new_path in register(file_path):
+                    if old is None:
+                        check(new_path)
+    finally:
+        os.close(fd)
 
 
 class _UnitTest(unittest.TestCase):
@@ -80,22 +991,390 @@ class _UnitTest(unittest.TestCase):
             self.assertRaises(TypeError, _has_query, value, 'foobar')
         for value in ['', 'foobar', 'foobar.py']:
             self.assertRaises(ValueError, _has_query, value, 'foobar')
+        self.assertRaises(TypeError, _has_query, 'LICENSE', None)
+        for value in [None, 42.0]:
+            self.assertRaises(TypeError, _has_query, 'LICENSE', 'MIT', value)
+        for value in [-1, 0]:
+            self.assertRaises(ValueError, _has_query, 'LICENSE', 'MIT', value)
         self.assertFalse(_has_query('LICENSE', 'foobar'))
         self.assertTrue(_has_query('LICENSE', 'MIT'))
+        self.assertTrue(_has_query('LICENSE', b'MIT'))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            with open(path, 'wb') as f:
+                f.write(b'a' * 100 + 'caf\xe9 foobar'.encode('latin-1'))
+            # Matches across the blocks read are found
+            for size in range(1, 120):
+                self.assertTrue(_has_query(path, 'foobar', size))
+                self.assertTrue(_has_query(path, 'a' * 100, size))
+                self.assertFalse(_has_query(path, 'foobaz', size))
+            self.assertTrue(_has_query(path, 'caf\xe9'.encode('latin-1')))
+            self.assertFalse(_has_query(path, 'caf\xe9'))
+
+            # Binary files never match
+            with open(path, 'wb') as f:
+                f.write(b'foo\0bar')
+            self.assertFalse(_has_query(path, 'foo'))
+            with open(path, 'wb') as f:
+                f.write(b'foo' * 10 + b'\0bar')
+            self.assertTrue(_has_query(path, 'bar', 8))
+
+    def test_matching_patterns(self):
+        """Test looking for several patterns in a file in one pass."""
+        self.assertRaises(re.error, _compile_patterns, regexes=['('])
+        self.assertRaises(re.error, _compile_patterns, regexes=['a(?i)b'])
+        sources = _compile_patterns(['foo', 'foob', 'a.c'],
+                                    [r'ba[rz]\d+', '^MIT', 'missing'])
+        for value in [None, 42, []]:
+            self.assertRaises(TypeError, _matching_patterns, value, sources)
+        for value in ['', 'foobar', 'foobar.py']:
+            self.assertRaises(ValueError, _matching_patterns, value, sources)
+        self.assertEqual(_matching_patterns('LICENSE', sources), [4])
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'log')
+            with open(path, 'wb') as f:
+                f.write(b'foobar baz42 abc')
+            # Patterns starting at the same position are all found
+            self.assertEqual(_matching_patterns(path, sources), [0, 1, 3])
+            self.assertEqual(_matching_patterns(path, sources[4:]), [])
+            with open(path, 'wb') as f:
+                pass
+            self.assertEqual(_matching_patterns(path, sources), [])
+            with open(path, 'wb') as f:
+                f.write(b'\0foobar')
+            self.assertEqual(_matching_patterns(path, sources), [])
+
+            # Blocks are searched with the end of the one before
+            with open(path, 'wb') as f:
+                f.write(b'foobar baz42 abc')
+            for size in range(1, 5):
+                self.assertEqual(_matching_patterns(path, sources, size),
+                                 [0, 1, 3])
+            with open(path, 'wb') as f:
+                f.write(b'x' * 10000 + b'needle\nfoo\nbar\n')
+            anchored = _compile_patterns(['needle'],
+                                         [r'e\nfoo', 'foo$', 'bar$'])
+            for size in [1, 4, 1024, _SIZE]:
+                self.assertEqual(_matching_patterns(path, anchored, size),
+                                 [0, 1, 3])
+
+            path = os.path.join(directory, 'log.txt')
+            with open(path, 'w') as f:
+                f.write('foo bar1')
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                _walk(directory, ['.txt'], ['foo', 'baz'], regexes=['r\\d'])
+            self.assertEqual(output.getvalue(),
+                             '{0}: foo, r\\d\n'.format(path))
+
+            # Leading global flags only apply to their own regex
+            regexes = ['(?i)FOO', '(?x) b a r  # comment', 'BAR']
+            sources = _compile_patterns(['1'], regexes)
+            self.assertEqual(_matching_patterns(path, sources), [0, 1, 2])
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                _walk(directory, ['.txt'], regexes=regexes)
+            self.assertEqual(output.getvalue(),
+                             '{0}: (?i)FOO, (?x) b a r  # comment\n'.format(
+                                 path))
+
+    def test_index(self):
+        """Test answering queries with a trigram index."""
+        self.assertEqual(_pack_trigrams(b'abcd'),
+                         {0x616263, 0x626364})
+        self.assertEqual(_pack_trigrams(b'ab'), set())
+        ids = array.array('I', [1, 3, 5])
+        self.assertEqual([_has_id(ids, id_) for id_ in range(7)],
+                         [False, True, False, True, False, True, False])
+        self.assertEqual(_decode_ids(_encode_ids(ids)), ids)
+        with tempfile.TemporaryDirectory() as directory:
+            tree = os.path.join(directory, 'tree')
+            os.makedirs(os.path.join(tree, 'sub'))
+            contents = {'a.txt': 'foobar', os.path.join('sub', 'b.txt'): 'baz',
+                        'c.txt': 'x' * 100 + 'foo', 'd.bin': 'foobar'}
+            for name, text in contents.items():
+                with open(os.path.join(tree, name), 'w') as f:
+                    f.write(text)
+            with open(os.path.join(tree, 'e.txt'), 'wb') as f:
+                f.write(b'\0foobar')
+            self.assertEqual(_trigrams(os.path.join(tree, 'e.txt')), None)
+            self.assertEqual(_trigrams(os.path.join(tree, 'c.txt'), 4),
+                             _pack_trigrams(b'x' * 100 + b'foo'))
+
+            database = os.path.join(directory, 'index.db')
+            connection = _open_index(database)
+            try:
+                files = [entry for parent, dirs, files
+                         in tree_walk.walk_tree(tree)
+                         for entry in files if entry.name.endswith('.txt')]
+                self.assertEqual(_update_index(connection, tree, files),
+                                 (4, 0))
+                self.assertEqual(_update_index(connection, tree, files),
+                                 (0, 0))
+                self.assertEqual(_index_candidates(connection, ['foobar']),
+                                 ['a.txt'])
+                self.assertEqual(_index_candidates(connection, ['foo', 'az']),
+                                 ['a.txt', 'c.txt', 'e.txt', 'sub/b.txt'])
+                self.assertEqual(_index_candidates(connection, ['foo', 'baz']),
+                                 ['a.txt', 'c.txt', 'sub/b.txt'])
+                self.assertEqual(_index_candidates(connection, ['nope']), [])
+                self.assertEqual(len(_index_candidates(connection,
+                                                       regexes=['f.o'])), 4)
+                os.remove(os.path.join(tree, 'a.txt'))
+                with open(os.path.join(tree, 'c.txt'), 'w') as f:
+                    f.write('foobar')
+                os.utime(os.path.join(tree, 'c.txt'), ns=(0, 0))
+                files = [entry for parent, dirs, files
+                         in tree_walk.walk_tree(tree)
+                         for entry in files if entry.name.endswith('.txt')]
+                self.assertEqual(_update_index(connection, tree, files),
+                                 (1, 1))
+                self.assertEqual(_index_candidates(connection, ['foobar']),
+                                 ['c.txt'])
+                with connection:
+                    _compact_index(connection)
+                self.assertEqual(connection.execute(
+                    'SELECT COUNT(*) FROM postings WHERE chunk != 0'
+                    ).fetchone()[0], 0)
+                self.assertEqual(_index_candidates(connection, ['foo']),
+                                 ['c.txt'])
+                self.assertEqual(_index_candidates(connection, ['baz']),
+                                 ['sub/b.txt'])
+
+                # Names that are not valid UTF-8 are kept
+                name = os.fsdecode(b'\xff.txt')
+                with open(os.path.join(tree, name), 'w') as f:
+                    f.write('qux')
+                files = [entry for parent, dirs, files
+                         in tree_walk.walk_tree(tree)
+                         for entry in files if entry.name.endswith('.txt')]
+                self.assertEqual(_update_index(connection, tree, files),
+                                 (1, 0))
+                self.assertEqual(_index_candidates(connection, ['qux']),
+                                 [name])
+
+                # Unreadable files are candidates until they are read
+                if os.name == 'posix' and os.geteuid() != 0:
+                    os.utime(os.path.join(tree, name), ns=(0, 0))
+                    for mode, expected in [(0, [name]), (0o644, [])]:
+                        os.chmod(os.path.join(tree, name), mode)
+                        files = [entry for parent, dirs, files
+                                 in tree_walk.walk_tree(tree) for entry
+                                 in files if entry.name.endswith('.txt')]
+                        with contextlib.redirect_stderr(io.StringIO()):
+                            self.assertEqual(_update_index(connection, tree,
+                                                           files), (1, 0))
+                        self.assertEqual(_index_candidates(connection,
+                                                           ['nope']), expected)
+            finally:
+                connection.close()
+
+            # An index in another format is built again
+            connection = sqlite3.connect(database)
+            with connection:
+                connection.execute(
+                    "UPDATE meta SET value = 0 WHERE key = 'format'")
+            connection.close()
+            connection = _open_index(database)
+            try:
+                self.assertEqual(connection.execute(
+                    'SELECT COUNT(*) FROM files').fetchone()[0], 0)
+            finally:
+                connection.close()
+
+            for update in [True, False]:
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    _walk(tree, ['.txt'], ['foo', 'baz'], index=database,
+                          update=update)
+                self.assertEqual(output.getvalue().splitlines(), [
+                    '{0}: foo'.format(os.path.join(tree, 'c.txt')),
+                    '{0}: baz'.format(os.path.join(tree, 'sub', 'b.txt'))])
+
+    def test_walk(self):
+        """Test printing the matching files in walk order."""
+        self.assertRaises(TypeError, _walk, '.', query='foo', jobs=None)
+        self.assertRaises(ValueError, _walk, '.', query='foo', jobs=0)
+        with tempfile.TemporaryDirectory() as directory:
+            for i in range(20):
+                name = '{0}.{1}'.format(i, 'txt' if i % 4 else 'html')
+                with open(os.path.join(directory, name), 'w') as f:
+                    f.write('foo' if i % 3 else 'bar')
+
+            outputs = []
+            for jobs in range(1, 5):
+                output = io.StringIO()
+                with contextlib.redirect_stdout(output):
+                    _walk(directory, ['.txt'], 'foo', jobs=jobs)
+                outputs.append(output.getvalue())
+            names = [os.path.basename(line)
+                     for line in outputs[0].splitlines()]
+            self.assertEqual(sorted(names),
+                             sorted('{0}.txt'.format(i) for i in range(20)
+                                    if (i % 4) and (i % 3)))
+            for output in outputs[1:]:
+                self.assertEqual(output, outputs[0])
+
+            # A dangling symbolic link is reported and the walk goes on
+            os.symlink('missing', os.path.join(directory, 'gone.txt'))
+            for query in ['foo', ['foo', 'baz']]:
+                output = io.StringIO()
+                errors = io.StringIO()
+                with contextlib.redirect_stdout(output), \
+                     contextlib.redirect_stderr(errors):
+                    _walk(directory, ['.txt'], query, jobs=2)
+                self.assertEqual(
+                    sorted(os.path.basename(line.partition(':')[0])
+                           for line in output.getvalue().splitlines()),
+                    sorted(names))
+                self.assertIn('gone.txt', errors.getvalue())
+
+    @unittest.skipUnless(sys.platform.startswith('linux'),
+                         'inotify is only on Linux')
+    def test_watch(self):
+        """Test printing the matching files as they are written."""
+        with tempfile.TemporaryDirectory() as directory:
+            for name in ['old', 'skip']:
+                os.mkdir(os.path.join(directory, name))
+            with open(os.path.join(directory, 'old', 'a.txt'), 'w') as f:
+                f.write('foo')
+
+            def write():
+                for parts, data in [(('b.txt',), 'foo'),
+                                    (('c.txt',), 'bar'),
+                                    (('d.html',), 'foo'),
+                                    (('old', 'e.txt'), 'foo'),
+                                    (('skip', 'f.txt'), 'foo'),
+                                    (('new', 'sub', 'g.txt'), 'foo')]:
+                    file_path = os.path.join(directory, *parts)
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    with open(file_path, 'w') as f:
+                        f.write(data)
+                os.rename(os.path.join(directory, 'c.txt'),
+                          os.path.join(directory, 'h.txt'))
+
+            def move():
+                # Renamed directories are still watched under the new name
+                os.rename(os.path.join(directory, 'old'),
+                          os.path.join(directory, 'renamed'))
+                os.rename(os.path.join(directory, 'new'),
+                          os.path.join(outside.name, 'new'))
+                for parts in [('renamed', 'i.txt'), ('renamed', 'j.txt')]:
+                    with open(os.path.join(directory, *parts), 'w') as f:
+                        f.write('foo')
+                path = os.path.join(outside.name, 'new', 'k.txt')
+                with open(path, 'w') as f:
+                    f.write('foo')
+
+            outside = tempfile.TemporaryDirectory()
+            self.addCleanup(outside.cleanup)
+            output = io.StringIO()
+            errors = []
+
+            def watch():
+                try:
+                    _watch(directory, ['.txt'], 'foo', ['skip'], timeout=1.0)
+                except Exception as error:
+                    errors.append(error)
+
+            def wait_for(*parts):
+                # Poll the output for the files instead of sleeping a guess
+                expected = {os.path.join(directory, *path) for path in parts}
+                deadline = time.monotonic() + 10.0
+                while not expected.issubset(output.getvalue().splitlines()):
+                    self.assertTrue(thread.is_alive(), errors)
+                    self.assertLess(time.monotonic(), deadline,
+                                    output.getvalue())
+                    time.sleep(0.01)
+
+            thread = threading.Thread(target=watch)
+            with contextlib.redirect_stdout(output):
+                thread.start()
+                try:
+                    # Everything is watched once the initial walk printed
+                    wait_for(('old', 'a.txt'))
+                    write()
+                    wait_for(('b.txt',), ('old', 'e.txt'),
+                             ('new', 'sub', 'g.txt'))
+                    move()
+                    wait_for(('renamed', 'i.txt'), ('renamed', 'j.txt'))
+                finally:
+                    thread.join(10.0)
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(errors, [])
+            lines = output.getvalue().splitlines()
+            self.assertEqual(os.path.basename(lines[0]), 'a.txt')
+            names = {os.path.relpath(line, directory) for line in lines}
+            self.assertEqual(names, {os.path.join('old', 'a.txt'), 'b.txt',
+                                     os.path.join('old', 'e.txt'),
+                                     os.path.join('new', 'sub', 'g.txt'),
+                                     os.path.join('renamed', 'i.txt'),
+                                     os.path.join('renamed', 'j.txt')})
 
 if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('-e', '--extensions', nargs='+', default=['.html'],
                         help='string extensions to accept')
-    parser.add_argument('-q', '--query', default='',
-                        help='string query to find')
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help='string query to find, repeat to find several '
+                        'in one pass')
+    parser.add_argument('-r', '--regex', action='append', default=[],
+                        help='regular expression to find, repeat to find '
+                        'several in one pass')
+    parser.add_argument('-x', '--exclude', action='append', default=[],
+                        help='glob pattern of the names or relative paths to '
+                        'skip, repeat for several')
+    parser.add_argument('-d', '--max-depth', type=int, default=None,
+                        help='number of levels of subdirectories to descend '
+                        'into')
+    parser.add_argument('--one-file-system', action='store_true',
+                        help='do not descend into other file systems')
+    parser.add_argument('-L', '--follow-symlinks', action='store_true',
+                        help='descend into symbolic links to directories')
+    parser.add_argument('--list-jobs', type=int, default=1,
+                        help='number of directories to list concurrently')
+    parser.add_argument('-j', '--jobs', type=int, default=_DEFAULT_JOBS,
+                        help='number of files to search concurrently')
+    parser.add_argument('--index', default='',
+                        help='path to a database of a trigram index of the '
+                        'accepted files to narrow the files searched')
+    parser.add_argument('--stale', action='store_true',
+                        help='use the index without walking to update it')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep printing the matching files as they are '
+                        'written after the walk')
     parser.add_argument('path', nargs='?', default='',
                         help='path to the directory to walk')
     args = parser.parse_args()
+    if (args.max_depth is not None) and (args.max_depth < 0):
+        parser.error('--max-depth must be a non-negative int')
+    if args.list_jobs < 1:
+        parser.error('--list-jobs must be a positive int')
+    if args.jobs < 1:
+        parser.error('--jobs must be a positive int')
 
     if os.path.isdir(args.path):
-        _walk(args.path, _clean_extensions(args.extensions), args.query)
+        try:
+            _compile_patterns(regexes=args.regex)
+        except re.error as error:
+            parser.error('invalid regex: {0}'.format(error))
+        walk = _walk
+        if args.watch:
+            try:
+                _inotify()
+            except OSError as error:
+                parser.error(error.strerror)
+            walk = _watch
+        try:
+            walk(args.path, _clean_extensions(args.extensions), args.query,
+                 args.exclude, args.max_depth, args.one_file_system,
+                 args.follow_symlinks, args.list_jobs, args.jobs, args.regex,
+                 args.index, not args.stale)
+        except KeyboardInterrupt:
+            pass
     else:
         suite = unittest.defaultTestLoader.loadTestsFromTestCase(_UnitTest)
         unittest.TextTestRunner(verbosity=2).run(suite)